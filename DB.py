@@ -1,69 +1,497 @@
 import sqlite3
 import os
+import sys
+import asyncio
 import csv
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import Iterator
+
+from transcript import Transcript
+from metrics import DB_SECONDS, DB_WRITE_BATCH_ROWS, DB_PENDING_WRITES, DB_WRITES_LOST, timeSpan
+
+
+DB_PATH = "conversation_history.db"
+DEFAULT_SESSION = "default"
+MAX_CACHED_TRANSCRIPTS = 1024
+INSERT_MESSAGE = "INSERT INTO history (session_id, speaker, content, created_at) VALUES (?, ?, ?, ?)"
+
+
+class ConnectionPool:
+    def __init__(self, path: str, size: int = 8):
+        self.path = path
+        self.size = size
+        self.idle = queue.LifoQueue(maxsize=size)  # : Queue[sqlite3.Connection]
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def createConnection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        # set before WAL writes the header, so only a new file takes it, older ones are converted by retention
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # WAL lets readers run alongside the writer, NORMAL skips the fsync per commit
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            can_create = self.created < self.size
+            if can_create:
+                self.created += 1
+
+        if not can_create:
+            return self.idle.get()
+
+        try:
+            return self.createConnection()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def release(self, conn: sqlite3.Connection):
+        self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            # commit on success, rollback on error
+            with conn:
+                yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self.lock:
+                self.created -= 1
+
+
+pool = ConnectionPool(DB_PATH)
+
+# in-memory transcripts of recently used sessions, loaded from the DB on cold start
+transcripts = OrderedDict()  # : OrderedDict[str, Transcript]
+transcripts_lock = threading.Lock()
+# operations of each session queued in the writer, their transcripts are the only up-to-date copy
+pending_sessions = Counter()  # : Counter[str]
+
+
+# write-behind: messages are queued and committed by one thread in batches, a transaction per
+# batch_size operations or per flush_interval seconds after the first queued one (group commit)
+class MessageWriter:
+    def __init__(
+        self,
+        batch_size: int = 256,
+        flush_interval: float = 0.05,
+        max_pending: int = 100000,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # past this many queued operations, writers wait for the disk instead of growing the queue
+        self.max_pending = max_pending
+        self.operations = []  # : list[tuple[str, str | None, str | None, str | None, float]], (kind, session, speaker, content, time)
+        self.first_queued_at = None  # : float, when the oldest queued operation was added
+        self.queued_count = 0  # : int, operations ever queued
+        self.written_count = 0  # : int, operations ever committed (or given up)
+        self.stopping = False
+        self.flushing = 0  # : int, callers waiting in flush, the batch is committed without waiting for more
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="message-writer", daemon=True)
+        self.thread.start()
+
+    def isBacklogged(self) -> bool:
+        with self.condition:
+            return len(self.operations) >= self.max_pending
+
+    # threads wait for room, the event loop never does: admitted turns queue past max_pending, and the
+    # admission control turns new ones away while isBacklogged
+    def put(self, kind: str, session_id: str | None, speaker: str | None = None, content: str | None = None):
+        try:
+            asyncio.get_running_loop()
+            blocking = False
+        except RuntimeError:
+            blocking = True
+        with self.condition:
+            while blocking and len(self.operations) >= self.max_pending and not self.stopping:
+                self.condition.wait()
+            if self.stopping:
+                raise RuntimeError("message writer is stopped.")
+            if not self.operations:
+                self.first_queued_at = time.monotonic()
+            self.operations.append((kind, session_id, speaker, content, time.time()))
+            self.queued_count += 1
+            DB_PENDING_WRITES.set(len(self.operations))
+            # the thread wakes up for the first operation of a batch and for a full one
+            if len(self.operations) == 1 or len(self.operations) >= self.batch_size:
+                self.condition.notify_all()
+
+    def takeBatch(self) -> list[tuple[str, str | None, str | None, str | None, float]] | None:
+        with self.condition:
+            while not self.operations and not self.stopping:
+                self.condition.wait()
+            if not self.operations:
+                return None
+            # wait for more operations to share the commit, up to the flush interval
+            while len(self.operations) < self.batch_size and not (self.stopping or self.flushing):
+                remaining = self.first_queued_at + self.flush_interval - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = self.operations[: self.batch_size]
+            del self.operations[: self.batch_size]
+            self.first_queued_at = time.monotonic() if self.operations else None
+            DB_PENDING_WRITES.set(len(self.operations))
+            # room for the writers waiting on max_pending
+            self.condition.notify_all()
+
+            return batch
+
+    def writeBatch(self, batch: list[tuple[str, str | None, str | None, str | None, float]]):
+        with timeSpan(DB_SECONDS, operation="write_batch"), pool.connection() as conn:
+            rows = []
+            for kind, session_id, speaker, content, created_at in batch:
+                if kind == "insert":
+                    rows.append((session_id, speaker, content, created_at))
+                    continue
+                # deletions keep their place between the insertions
+                if rows:
+                    conn.executemany(INSERT_MESSAGE, rows)
+                    rows = []
+                if session_id is None:
+                    conn.execute("DELETE FROM history")
+                else:
+                    conn.execute("DELETE FROM history WHERE session_id = ?", (session_id,))
+            if rows:
+                conn.executemany(INSERT_MESSAGE, rows)
+        DB_WRITE_BATCH_ROWS.observe(len(batch))
+
+    def run(self):
+        while True:
+            batch = self.takeBatch()
+            if batch is None:
+                return
+
+            # a busy or locked database is retried until the batch goes through (the queue backs up and
+            # new turns get 503 meanwhile), except on stop; any other error drops the batch
+            attempt = 0
+            lost = False
+            while True:
+                try:
+                    self.writeBatch(batch)
+                    break
+                except Exception as e:
+                    attempt += 1
+                    if isTransient(e) and not (self.stopping and attempt >= 8):
+                        print(f"message batch of {len(batch)} not written (attempt {attempt}): {e}")
+                        time.sleep(min(2.0, 0.05 * 2 ** min(attempt, 6)))
+                        continue
+                    print(f"ERROR: {len(batch)} queued messages lost: {e!r}", file=sys.stderr)
+                    DB_WRITES_LOST.inc(len(batch))
+                    lost = True
+                    break
+
+            with transcripts_lock:
+                for kind, session_id, speaker, content, _ in batch:
+                    if session_id is not None:
+                        if lost:
+                            forgetOperation(kind, session_id, speaker, content)
+                        pending_sessions[session_id] -= 1
+                        if pending_sessions[session_id] <= 0:
+                            del pending_sessions[session_id]
+            with self.condition:
+                self.written_count += len(batch)
+                self.condition.notify_all()
+
+    # wait until every operation queued before the call is committed
+    def flush(self, timeout: float | None = None) -> bool:
+        with self.condition:
+            target = self.queued_count
+            self.flushing += 1
+            self.condition.notify_all()
+            try:
+                return self.condition.wait_for(lambda: self.written_count >= target, timeout)
+            finally:
+                self.flushing -= 1
+
+    # commit what is left and stop the thread
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+writer = None  # : MessageWriter, None while messages are written synchronously
+
+
+# errors of a database that is busy for now, the write goes through once the other connection is done
+def isTransient(error: Exception) -> bool:
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    message = str(error).lower()
+
+    return "locked" in message or "busy" in message
+
+
+# called with transcripts_lock held, for an operation of the writer that was dropped:
+# the transcript gives the row back, so the conversation goes on from what the DB has
+def forgetOperation(kind: str, session_id: str, speaker: str | None, content: str | None):
+    transcript = transcripts.get(session_id)
+    if transcript is None:
+        return
+    if kind == "insert":
+        # the row is one of the session's queued ones, which are at the end of the transcript
+        transcript.remove(speaker, content, pending_sessions[session_id])
+    elif pending_sessions[session_id] <= 1:
+        # the delete didn't happen, the rows are read from the DB again
+        del transcripts[session_id]
+
+
+# from now on, addMessage and reset only queue their writes (e.g. inside the server's event loop)
+def startWriter(batch_size: int = 256, flush_interval: float = 0.05) -> MessageWriter:
+    global writer
+    if writer is None:
+        writer = MessageWriter(batch_size, flush_interval)
+
+    return writer
+
+
+# drain the queue and go back to synchronous writes
+def stopWriter():
+    global writer
+    if writer is not None:
+        writer.stop()
+        writer = None
+
+
+# the writer is max_pending operations behind, new turns should wait
+def isWriterBacklogged() -> bool:
+
+    return writer is not None and writer.isBacklogged()
+
+
+def flushMessages(timeout: float | None = None) -> bool:
+    if writer is None:
+        return True
+
+    return writer.flush(timeout)
+
+
+# point the store at another database file, e.g. a scratch database for benchmarks
+def setDatabase(path: str):
+    global pool
+    flushMessages()
+    pool.close()
+    pool = ConnectionPool(path)
+    with transcripts_lock:
+        transcripts.clear()
 
 
 def initialize():
-    conn = sqlite3.connect("conversation_history.db")
-    cursor = conn.cursor()
-    cursor.execute(
+    with pool.connection() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL DEFAULT 'default',
+                speaker TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL
+            )
         """
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            speaker TEXT NOT NULL,
-            content TEXT NOT NULL
         )
-    """
-    )
-    conn.commit()
-    conn.close()
 
+        # migrate history tables created before sessions existed
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(history)")]
+        if "session_id" not in columns:
+            conn.execute(
+                "ALTER TABLE history ADD COLUMN session_id TEXT NOT NULL DEFAULT 'default'"
+            )
+        # rows from before the column have no time, retention treats them as the oldest
+        if "created_at" not in columns:
+            conn.execute("ALTER TABLE history ADD COLUMN created_at REAL")
+
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_history_session ON history (session_id, id)"
+        )
 
-def addMessage(speaker: str, content: str):
+
+def addMessage(speaker: str, content: str, session_id: str = DEFAULT_SESSION):
     if speaker not in ["USER", "AI", "PHASE"]:
         raise ValueError("speaker should be one of 'USER', 'AI', 'PHASE'.")
-    conn = sqlite3.connect("conversation_history.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO history (speaker, content) VALUES (?, ?)", (speaker, content)
+    if writer is not None:
+        with timeSpan(DB_SECONDS, operation="add_message"):
+            # the transcript takes the row right away, reads see it before it is committed
+            with transcripts_lock:
+                transcript = loadTranscript(session_id)
+                transcript.append(speaker, content)
+                pending_sessions[session_id] += 1
+            writer.put("insert", session_id, speaker, content)
+        return
+
+    with timeSpan(DB_SECONDS, operation="add_message"), pool.connection() as conn:
+        conn.execute(INSERT_MESSAGE, (session_id, speaker, content, time.time()))
+
+    # cold sessions are left alone, they are loaded with this row on the next read
+    with transcripts_lock:
+        transcript = transcripts.get(session_id)
+        if transcript is not None:
+            transcript.append(speaker, content)
+
+
+# called with transcripts_lock held
+def loadTranscript(session_id: str) -> Transcript:
+    transcript = transcripts.get(session_id)
+    if transcript is not None:
+        transcripts.move_to_end(session_id)
+        return transcript
+
+    with pool.connection() as conn:
+        rows = conn.execute(
+            "SELECT speaker, content FROM history WHERE session_id = ? ORDER BY id",
+            (session_id,),
+        ).fetchall()
+    transcript = Transcript(rows)
+    transcripts[session_id] = transcript
+    # sessions with queued writes stay cached, the DB doesn't have their rows yet
+    for cached_session_id in list(transcripts):
+        if len(transcripts) <= MAX_CACHED_TRANSCRIPTS:
+            break
+        if cached_session_id not in pending_sessions and cached_session_id != session_id:
+            del transcripts[cached_session_id]
+
+    return transcript
+
+
+def getTranscript(session_id: str = DEFAULT_SESSION) -> Transcript:
+    with transcripts_lock:
+        return loadTranscript(session_id)
+
+
+def getMessages(session_id: str = DEFAULT_SESSION) -> list[tuple[str, str]]:
+    transcript = getTranscript(session_id)
+    with transcripts_lock:
+        return transcript.getRows()
+
+
+def getHistory(session_id: str = DEFAULT_SESSION) -> str:
+    with timeSpan(DB_SECONDS, operation="get_history"):
+        transcript = getTranscript(session_id)
+        with transcripts_lock:
+            return transcript.render()
+
+
+# a pooled connection, or one of its own with the archive file of retention attached when there is one
+@contextmanager
+def historyConnection(archive_path: str | None = None) -> Iterator[tuple[sqlite3.Connection, bool]]:
+    if archive_path is None or not os.path.exists(archive_path):
+        with pool.connection() as conn:
+            yield conn, False
+        return
+
+    conn = sqlite3.connect(pool.path, timeout=30, check_same_thread=False)
+    try:
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+        yield conn, True
+    finally:
+        conn.close()
+
+
+# the rows of the history table, with the archived ones after a UNION on id (AUTOINCREMENT never reuses an id)
+def selectHistory(columns: str, where: str, params: tuple, archived: bool) -> tuple[str, tuple]:
+    if not archived:
+        return f"SELECT {columns} FROM history WHERE {where}", params
+
+    return (
+        f"SELECT {columns} FROM main.history WHERE {where} UNION SELECT {columns} FROM archive.history WHERE {where}",
+        params + params,
     )
-    conn.commit()
-    conn.close()
 
 
-def getHistory() -> str:
-    conn = sqlite3.connect("conversation_history.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT speaker, content FROM history")
-    rows = cursor.fetchall()
-    conn.close()
+# rows after the given id in (session, id) order, fetched batch_size at a time from one read snapshot,
+# the archived ones included if archive_path is given
+def streamMessages(
+    after_id: int = 0, batch_size: int = 10000, archive_path: str | None = None
+) -> Iterator[list[tuple[int, str, str, str]]]:
+    with historyConnection(archive_path) as (conn, archived):
+        query, params = selectHistory("id, session_id, speaker, content", "id > ?", (after_id,), archived)
+        cursor = conn.execute(f"{query} ORDER BY session_id, id", params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+
+# number of rows and last phase of a session up to the given id
+def getSessionPosition(
+    session_id: str, until_id: int, archive_path: str | None = None
+) -> tuple[int, str | None]:
+    with historyConnection(archive_path) as (conn, archived):
+        query, params = selectHistory("id", "session_id = ? AND id <= ?", (session_id, until_id), archived)
+        count = conn.execute(f"SELECT COUNT(*) FROM ({query})", params).fetchone()[0]
+        query, params = selectHistory(
+            "id, content", "session_id = ? AND speaker = 'PHASE' AND id <= ?", (session_id, until_id), archived
+        )
+        row = conn.execute(f"SELECT content FROM ({query}) ORDER BY id DESC LIMIT 1", params).fetchone()
+
+    return count, row[0] if row else None
 
-    temp = []
-    for speaker, content in rows:
-        if speaker == "PHASE":
-            temp.append(f"\n[{content}]")
+
+# the highest id ever given, AUTOINCREMENT never reuses it even after the rows are deleted or archived
+def getLastMessageId() -> int:
+    with pool.connection() as conn:
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'history'").fetchone()
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM history").fetchone()[0]
+
+    return max(row[0] if row else 0, last_id)
+
+
+def reset(session_id: str | None = None):
+    if writer is not None and session_id is not None:
+        # queued behind the session's own writes, an empty transcript stands in until it is committed
+        with transcripts_lock:
+            transcripts[session_id] = Transcript()
+            pending_sessions[session_id] += 1
+        writer.put("delete", session_id)
+        return
+    # every conversation is removed in place, after the queued writes
+    flushMessages()
+
+    with timeSpan(DB_SECONDS, operation="reset"), pool.connection() as conn:
+        # without a session id, every conversation is removed
+        if session_id is None:
+            # the ids keep growing, so incremental exports can tell new rows apart
+            conn.execute("DELETE FROM history")
         else:
-            temp.append(f"{speaker}: {content}")
-
-    return "\n".join(temp)
-
-
-def reset():
-    conn = sqlite3.connect("conversation_history.db")
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM history")
-    cursor.execute("DELETE FROM sqlite_sequence WHERE name='history'")
-    conn.commit()
-    conn.close()
-    
-    
-def saveConversation(index: int, filepath: str):
-    conn = sqlite3.connect("conversation_history.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT speaker, content FROM history")
-    rows = cursor.fetchall()
-    conn.close()
-    
+            conn.execute("DELETE FROM history WHERE session_id = ?", (session_id,))
+
+    with transcripts_lock:
+        if session_id is None:
+            transcripts.clear()
+        else:
+            transcripts.pop(session_id, None)
+
+
+def saveConversation(index: int, filepath: str, session_id: str = DEFAULT_SESSION):
+    rows = getMessages(session_id)
+
     file_exists = os.path.exists(filepath)
 
     with open(filepath, mode='a', newline='', encoding='utf-8') as csv_file:
@@ -75,4 +503,4 @@ def saveConversation(index: int, filepath: str):
         for row in rows:
             role, message = row
             if role != "PHASE":
-                writer.writerow([index, role, message])
\ No newline at end of file
+                writer.writerow([index, role, message])
@@ -0,0 +1,170 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable
+from metrics import ADMISSION_QUEUE_DEPTH, ADMISSION_WAIT_SECONDS, ADMISSION_REJECTED
+
+
+# a request turned away, answered right away with its status and Retry-After
+class Overloaded(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class Ticket:
+    __slots__ = ("session_id", "admitted_at", "released")
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.admitted_at = time.perf_counter()
+        self.released = False
+
+
+# turns of one session run one at a time in arrival order, and at most max_in_flight turns run at once;
+# past max_queue waiting turns, max_session_queue waiting turns of a session, or queue_timeout seconds
+# of waiting, or while the message writer is backlogged, requests are rejected instead of piling up
+class AdmissionController:
+    def __init__(
+        self,
+        max_in_flight: int = 64,
+        max_queue: int = 256,
+        max_session_queue: int = 4,
+        queue_timeout: float = 10.0,
+        is_backlogged: Callable[[], bool] | None = None,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_session_queue = max_session_queue
+        self.queue_timeout = queue_timeout
+        # e.g. DB.isWriterBacklogged, new turns are turned away while the message writer catches up
+        self.is_backlogged = is_backlogged
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.session_locks = {}  # : dict[str, list[asyncio.Lock, int]], lock and turns holding or waiting for it
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = {"session_busy": 0, "queue_full": 0, "queue_timeout": 0, "db_backlog": 0}
+        self.waits = deque(maxlen=1000)  # : deque[float], recent queue waits in seconds
+        self.durations = deque(maxlen=200)  # : deque[float], recent turn durations in seconds
+
+    # seconds until a slot is likely free, from the recent turn durations and the queue ahead
+    def getRetryAfter(self) -> int:
+        duration = sum(self.durations) / len(self.durations) if self.durations else 1.0
+
+        return max(1, math.ceil(duration * (self.queued + 1) / self.max_in_flight))
+
+    def reject(self, reason: str, status_code: int, detail: str):
+        self.rejected[reason] += 1
+        ADMISSION_REJECTED.inc(reason=reason)
+
+        raise Overloaded(status_code, detail, self.getRetryAfter())
+
+    async def acquireSession(self, session_id: str, bounded: bool = True):
+        entry = self.session_locks.get(session_id)
+        if entry is None:
+            entry = [asyncio.Lock(), 0]
+            self.session_locks[session_id] = entry
+        # the running turn holds the lock and is not counted as waiting
+        elif bounded and entry[1] - entry[0].locked() >= self.max_session_queue:
+            self.reject(
+                "session_busy", 429, f"Too many turns of conversation {session_id} are waiting."
+            )
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self.releaseSession(session_id, locked=False)
+            raise
+
+    def releaseSession(self, session_id: str, locked: bool = True):
+        entry = self.session_locks[session_id]
+        if locked:
+            entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.session_locks[session_id]
+
+    # only the session, for requests that change a conversation without calling the LLM
+    @asynccontextmanager
+    async def lockSession(self, session_id: str, bounded: bool = True) -> AsyncIterator[None]:
+        await self.acquireSession(session_id, bounded)
+        try:
+            yield
+        finally:
+            self.releaseSession(session_id)
+
+    async def acquireSlot(self):
+        if self.is_backlogged is not None and self.is_backlogged():
+            self.reject("db_backlog", 503, "Server is busy, try again later.")
+        if self.in_flight >= self.max_in_flight and self.queued >= self.max_queue:
+            self.reject("queue_full", 503, "Server is busy, try again later.")
+
+        start = time.perf_counter()
+        self.queued += 1
+        ADMISSION_QUEUE_DEPTH.set(self.queued)
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except TimeoutError:
+            self.reject("queue_timeout", 503, "Server is busy, try again later.")
+        finally:
+            self.queued -= 1
+            ADMISSION_QUEUE_DEPTH.set(self.queued)
+
+        wait = time.perf_counter() - start
+        self.waits.append(wait)
+        ADMISSION_WAIT_SECONDS.observe(wait)
+        self.in_flight += 1
+
+    # hold the session and an in-flight slot, until release for turns that outlive the handler (streams)
+    async def enter(self, session_id: str) -> Ticket:
+        await self.acquireSession(session_id)
+        try:
+            await self.acquireSlot()
+        except BaseException:
+            self.releaseSession(session_id)
+            raise
+
+        return Ticket(session_id)
+
+    # released once, whichever of the handler and the response finishes the turn
+    def release(self, ticket: Ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        self.durations.append(time.perf_counter() - ticket.admitted_at)
+        self.in_flight -= 1
+        self.slots.release()
+        self.releaseSession(ticket.session_id)
+
+    @asynccontextmanager
+    async def admit(self, session_id: str) -> AsyncIterator[Ticket]:
+        ticket = await self.enter(session_id)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def getStats(self) -> dict[str, Any]:
+        waits = sorted(self.waits)
+
+        def percentile(ratio: float) -> float | None:
+            if not waits:
+                return None
+            return round(waits[min(len(waits) - 1, int(ratio * len(waits)))], 4)
+
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "sessions": len(self.session_locks),
+            "rejected": dict(self.rejected),
+            "wait_p50_s": percentile(0.5),
+            "wait_p95_s": percentile(0.95),
+            "wait_p99_s": percentile(0.99),
+        }
+
@@ -0,0 +1,315 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from typing import Iterator
+import numpy as np
+import pandas as pd
+
+
+# columns of "evaluation results.csv", score1 judges the Intent-Cumpa dialogue and score2 the LLM-Cumpa one
+SCORE_COLUMNS = {"index": "index", "intent score": "intent", "LLM score": "llm", "run": "run"}
+FINISH_PHASE = "FINISH"
+TRAJECTORY_SEPARATOR = " > "
+
+
+def readResultChunks(filepath: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    header = pd.read_csv(filepath, nrows=0).columns
+    # the reasons are the bulk of the file and aren't needed
+    columns = [column for column in SCORE_COLUMNS if column in header]
+    offset = 0
+    last_index = None
+    for chunk in pd.read_csv(filepath, usecols=columns, chunksize=chunksize):
+        chunk = chunk.rename(columns=SCORE_COLUMNS)
+        if "run" not in chunk:
+            # every eval appends its indices in increasing order, a run starts where they go back
+            previous = chunk["index"].shift(1)
+            if last_index is not None:
+                previous.iloc[0] = last_index
+            restarts = (chunk["index"] <= previous).cumsum() + offset
+            offset = int(restarts.iloc[-1])
+            last_index = chunk["index"].iloc[-1]
+            chunk["run"] = os.path.basename(filepath) + "#" + (restarts + 1).astype(str)
+        yield chunk
+
+
+# paired judgments counted per group and score pair; the counts are all the statistics below need,
+# so any number of result files is reduced to a few rows per run
+def countJudgments(
+    filepaths: list[str],
+    trajectories: pd.Series | None = None,
+    chunksize: int = 100000,
+) -> tuple[pd.DataFrame, int]:
+    keys = ["run", "trajectory", "intent", "llm"]
+    counts = []
+    skipped = 0
+    for filepath in filepaths:
+        for chunk in readResultChunks(filepath, chunksize):
+            chunk["intent"] = pd.to_numeric(chunk["intent"], errors="coerce")
+            chunk["llm"] = pd.to_numeric(chunk["llm"], errors="coerce")
+            valid = chunk["intent"].notna() & chunk["llm"].notna()
+            skipped += int((~valid).sum())
+            chunk = chunk[valid].assign(run=chunk["run"].astype(str))
+            if trajectories is None:
+                chunk["trajectory"] = ""
+            else:
+                chunk["trajectory"] = chunk["index"].map(trajectories).fillna("unknown")
+            counts.append(chunk.groupby(keys).size())
+
+    if not counts:
+        return pd.DataFrame(columns=keys + ["count"]), skipped
+
+    return pd.concat(counts).groupby(level=keys).sum().rename("count").reset_index(), skipped
+
+
+# the lower and upper middle values of counted scores, averaged
+def getMedian(values: np.ndarray, counts: np.ndarray) -> float:
+    order = np.argsort(values)
+    values = values[order]
+    cumulative = np.cumsum(counts[order])
+    total = cumulative[-1]
+    lower = values[np.searchsorted(cumulative, (total - 1) // 2 + 1)]
+    upper = values[np.searchsorted(cumulative, total // 2 + 1)]
+
+    return float((lower + upper) / 2)
+
+
+# two-sided exact sign test of the wins against the losses, ties left out
+def getSignTestPvalue(wins: int, losses: int) -> float:
+    trials = wins + losses
+    if trials == 0:
+        return 1.0
+    log_factorials = np.concatenate([[0.0], np.cumsum(np.log(np.arange(1, trials + 1)))])
+    k = np.arange(0, min(wins, losses) + 1)
+    log_pmf = log_factorials[trials] - log_factorials[k] - log_factorials[trials - k] - trials * np.log(2)
+
+    return float(min(1.0, 2 * np.exp(log_pmf).sum()))
+
+
+# resampling the n judgments with replacement is drawing n times from their distinct score pairs, so a
+# bootstrap sample is one multinomial row of counts: B samples cost B x pairs, not B x n
+def bootstrap(
+    intent: np.ndarray,
+    llm: np.ndarray,
+    counts: np.ndarray,
+    rng: np.random.Generator,
+    samples: int,
+    block_cells: int = 2000000,
+) -> dict[str, np.ndarray]:
+    total = counts.sum()
+    probabilities = counts / total
+    wins = (llm > intent).astype(float)
+    ties = (llm == intent).astype(float)
+    statistics = {"intent_mean": [], "llm_mean": [], "diff_mean": [], "llm_win_rate": []}
+    # blocks of samples keep the count matrix small when the scores take many values
+    block = max(1, block_cells // len(counts))
+    for start in range(0, samples, block):
+        draws = rng.multinomial(total, probabilities, size=min(block, samples - start)) / total
+        intent_mean = draws @ intent
+        llm_mean = draws @ llm
+        statistics["intent_mean"].append(intent_mean)
+        statistics["llm_mean"].append(llm_mean)
+        statistics["diff_mean"].append(llm_mean - intent_mean)
+        statistics["llm_win_rate"].append(draws @ (wins + 0.5 * ties))
+
+    return {name: np.concatenate(values) for name, values in statistics.items()}
+
+
+# paired permutation test of the mean difference: under no difference every pair's sign is a coin flip,
+# and the positive signs among the c pairs differing by v are Binomial(c, 1/2), drawn for all at once
+def getPermutationPvalue(
+    differences: np.ndarray, counts: np.ndarray, rng: np.random.Generator, samples: int
+) -> float:
+    total = counts.sum()
+    observed = abs((differences * counts).sum()) / total
+    magnitudes = np.abs(differences)
+    nonzero = magnitudes > 0
+    if not nonzero.any():
+        return 1.0
+    values = magnitudes[nonzero]
+    value_counts = counts[nonzero]
+
+    positives = rng.binomial(value_counts, 0.5, size=(samples, len(values)))
+    permuted = np.abs((2 * positives - value_counts) @ values) / total
+    # the tolerance keeps exact ties with the observed mean on the extreme side
+    extreme = (permuted >= observed - 1e-12).sum()
+
+    return float((1 + extreme) / (1 + samples))
+
+
+def summarizeGroup(
+    group: pd.DataFrame, rng: np.random.Generator, samples: int, confidence: float
+) -> dict:
+    intent = group["intent"].to_numpy(dtype=float)
+    llm = group["llm"].to_numpy(dtype=float)
+    counts = group["count"].to_numpy(dtype=np.int64)
+    total = int(counts.sum())
+    wins = int(counts[llm > intent].sum())
+    losses = int(counts[llm < intent].sum())
+    ties = total - wins - losses
+
+    summary = {
+        "n": total,
+        "intent_mean": float((intent * counts).sum() / total),
+        "intent_median": getMedian(intent, counts),
+        "llm_mean": float((llm * counts).sum() / total),
+        "llm_median": getMedian(llm, counts),
+    }
+    summary["diff_mean"] = summary["llm_mean"] - summary["intent_mean"]
+    summary["llm_win_rate"] = (wins + 0.5 * ties) / total
+    summary["wins"] = wins
+    summary["ties"] = ties
+    summary["losses"] = losses
+
+    alpha = (1 - confidence) / 2
+    for name, values in bootstrap(intent, llm, counts, rng, samples).items():
+        low, high = np.quantile(values, [alpha, 1 - alpha])
+        summary[f"{name}_low"] = float(low)
+        summary[f"{name}_high"] = float(high)
+    summary["permutation_p"] = getPermutationPvalue(llm - intent, counts, rng, samples)
+    summary["sign_test_p"] = getSignTestPvalue(wins, losses)
+
+    return summary
+
+
+# mean and median scores, the LLM-Cumpa win rate (ties count half), bootstrap confidence intervals
+# and paired tests of each group, e.g. by=["run"] or by=["run", "trajectory"]
+def summarize(
+    counts: pd.DataFrame,
+    by: list[str],
+    samples: int = 10000,
+    confidence: float = 0.95,
+    seed: int = 0,
+) -> pd.DataFrame:
+    if not 0 < confidence < 1:
+        raise ValueError("confidence should be between 0 and 1.")
+    rng = np.random.default_rng(seed)
+    rows = []
+    for key, group in counts.groupby(by, sort=True):
+        pairs = group.groupby(["intent", "llm"], as_index=False)["count"].sum()
+        row = dict(zip(by, key))
+        row.update(summarizeGroup(pairs, rng, samples, confidence))
+        rows.append(row)
+
+    return pd.DataFrame(rows)
+
+
+def readPhaseRowChunks(source: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    columns = ["session_id", "message_id", "speaker", "content"]
+    if source.endswith(".db"):
+        conn = sqlite3.connect(source)
+        try:
+            # a file from before sessions has no autotest dialogues
+            if "session_id" not in [row[1] for row in conn.execute("PRAGMA table_info(history)")]:
+                return
+            yield from pd.read_sql_query(
+                "SELECT session_id, id AS message_id, speaker, content FROM history "
+                "WHERE speaker = 'PHASE' AND session_id LIKE 'autotest-%'",
+                conn,
+                chunksize=chunksize,
+            )
+        finally:
+            conn.close()
+    elif source.endswith(".parquet"):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("parquet trajectories need pyarrow, install it with 'pip install pyarrow'")
+        for batch in pyarrow.parquet.ParquetFile(source).iter_batches(chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_json(source, lines=True, chunksize=chunksize, dtype=False):
+            yield chunk[columns]
+
+
+# the phases each simulated dialogue went through, by its index ("autotest-<index>" sessions), from
+# the history DB or exports of it; only the last run of a session counts, a run restarts after FINISH
+def loadTrajectories(sources: list[str], chunksize: int = 100000) -> pd.Series:
+    phases = []
+    for source in sources:
+        for chunk in readPhaseRowChunks(source, chunksize):
+            chunk = chunk[
+                (chunk["speaker"] == "PHASE") & chunk["session_id"].str.startswith("autotest-")
+            ]
+            phases.append(chunk[["session_id", "message_id", "content"]])
+    if not phases:
+        return pd.Series(dtype=str)
+
+    phases = pd.concat(phases).drop_duplicates("message_id").sort_values(["session_id", "message_id"])
+    previous = phases.groupby("session_id")["content"].shift(1)
+    phases["attempt"] = (previous == FINISH_PHASE).groupby(phases["session_id"]).cumsum()
+    phases = phases[phases["attempt"] == phases.groupby("session_id")["attempt"].transform("max")]
+    # a phase logged twice in a row is one step
+    repeated = phases["content"] == phases.groupby("session_id")["content"].shift(1)
+    phases = phases[~repeated]
+
+    trajectories = phases.groupby("session_id")["content"].agg(TRAJECTORY_SEPARATOR.join)
+    indices = pd.to_numeric(trajectories.index.str.removeprefix("autotest-"), errors="coerce")
+    trajectories = trajectories[~np.isnan(indices)]
+    trajectories.index = indices[~np.isnan(indices)].astype(int)
+
+    return trajectories
+
+
+def analyze(
+    filepaths: list[str],
+    trajectory_sources: list[str] | None = None,
+    samples: int = 10000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    chunksize: int = 100000,
+) -> dict:
+    start_time = time.perf_counter()
+    trajectories = loadTrajectories(trajectory_sources, chunksize) if trajectory_sources else None
+    counts, skipped = countJudgments(filepaths, trajectories, chunksize)
+    report = {
+        "judgments": int(counts["count"].sum()),
+        "skipped": skipped,
+        "runs": summarize(counts, ["run"], samples, confidence, seed),
+    }
+    if trajectories is not None:
+        report["trajectories"] = summarize(counts, ["run", "trajectory"], samples, confidence, seed)
+    report["seconds"] = round(time.perf_counter() - start_time, 3)
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="naturalness scores of Intent-Cumpa and LLM-Cumpa per evaluation run")
+    parser.add_argument(
+        "results", nargs="*", default=["./evaluation results.csv"], help="evaluation result csv files of main.py --eval"
+    )
+    parser.add_argument(
+        "--trajectories",
+        nargs="+",
+        metavar="SOURCE",
+        help="history DB (.db) or JSONL/Parquet exports with the autotest sessions, to break the scores down by phase trajectory",
+    )
+    parser.add_argument("--samples", type=int, default=10000, help="bootstrap and permutation samples")
+    parser.add_argument("--confidence", type=float, default=0.95, help="confidence level of the bootstrap intervals")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the resampling")
+    parser.add_argument("--chunksize", type=int, default=100000, help="rows read at a time")
+    parser.add_argument("--output", help="JSON file for the summaries")
+    args = parser.parse_args()
+
+    report = analyze(args.results, args.trajectories, args.samples, args.confidence, args.seed, args.chunksize)
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.precision", 3):
+        print(report["runs"].to_string(index=False))
+        if "trajectories" in report:
+            print()
+            print(report["trajectories"].to_string(index=False))
+    print(f"{report['judgments']} judgments ({report['skipped']} without scores skipped) analyzed in {report['seconds']}s")
+
+    if args.output:
+        tables = {
+            name: value.to_dict(orient="records") if isinstance(value, pd.DataFrame) else value
+            for name, value in report.items()
+        }
+        with open(args.output, mode="w", encoding="utf-8") as file:
+            json.dump(tables, file, indent=2, ensure_ascii=False)
+        print(f"summaries saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
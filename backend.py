@@ -0,0 +1,244 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import types
+import typing
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Literal
+from langchain_core.messages import AIMessageChunk
+from ratelimit import getLimiter, estimateTokens
+
+
+# live: call the providers, record: call them and save every response into the cassette,
+# replay: answer from the cassette only, fake: answer with generated outputs after a simulated latency
+BACKEND_MODES = ["live", "record", "replay", "fake"]
+
+
+class Cassette:
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}  # : dict[str, list[str]], outputs recorded for each key in order
+        self.replayed = {}  # : dict[str, int]
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, mode="r", encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries.setdefault(entry["key"], []).append(entry["output"])
+
+    def record(self, key: str, site: str | None, model: str, prompt: str, output: str):
+        entry = {"key": key, "site": site, "model": model, "prompt": prompt, "output": output}
+        with self.lock:
+            self.entries.setdefault(key, []).append(output)
+            with open(self.path, mode="a", encoding="utf-8") as file:
+                file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    # the same prompt gets its recorded outputs back in recording order, then cycles
+    def replay(self, key: str) -> str:
+        with self.lock:
+            outputs = self.entries.get(key)
+            if not outputs:
+                raise KeyError(f"no recorded response in {self.path} for prompt key {key}")
+            count = self.replayed.get(key, 0)
+            self.replayed[key] = count + 1
+
+            return outputs[count % len(outputs)]
+
+
+class FakeRateLimitError(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after: float):
+        super().__init__("fake provider rate limit")
+        self.retry_after = retry_after
+
+
+class ModelBackend:
+    def __init__(
+        self,
+        mode: str = "live",
+        cassette_path: str = "./llm cassette.jsonl",
+        fake_latency: float = 0.5,
+        fake_jitter: float = 0.1,
+        fake_transition: float = 0.3,
+        fake_finish: float = 0.1,
+        fake_tail: float = 0.0,
+        fake_tail_latency: float = 5.0,
+        fake_error: float = 0.0,
+        fake_capacity: int | None = None,
+        seed: int | None = None,
+    ):
+        if mode not in BACKEND_MODES:
+            raise ValueError(f"backend mode should be one of {BACKEND_MODES}.")
+        self.mode = mode
+        self.cassette = Cassette(cassette_path) if mode in ["record", "replay"] else None
+        self.fake_latency = fake_latency
+        self.fake_jitter = fake_jitter
+        # chance that a fake selector leaves the phase, and that a fake user ends the dialogue
+        self.fake_transition = fake_transition
+        self.fake_finish = fake_finish
+        # chance of a slow call (fake_tail_latency seconds instead), and of a failed one
+        self.fake_tail = fake_tail
+        self.fake_tail_latency = fake_tail_latency
+        self.fake_error = fake_error
+        # concurrent fake calls above the capacity are rejected as rate limited
+        self.fake_capacity = fake_capacity
+        self.fake_in_flight = 0
+        self.random = random.Random(seed)
+
+    async def sleepFakeLatency(self):
+        latency = self.fake_latency + self.random.uniform(-self.fake_jitter, self.fake_jitter)
+        if self.random.random() < self.fake_tail:
+            latency = self.fake_tail_latency
+        failed = self.random.random() < self.fake_error
+        if self.fake_capacity is not None and self.fake_in_flight >= self.fake_capacity:
+            await asyncio.sleep(0.001)
+            raise FakeRateLimitError(max(0.01, self.fake_latency))
+        self.fake_in_flight += 1
+        try:
+            await asyncio.sleep(max(0.0, latency))
+        finally:
+            self.fake_in_flight -= 1
+        if failed:
+            raise RuntimeError("fake provider error")
+
+    def fakeValue(self, name: str, annotation: Any) -> Any:
+        options = typing.get_args(annotation)
+        if typing.get_origin(annotation) in (typing.Union, types.UnionType):
+            choices = [option for option in options if option is not type(None)]
+            if type(None) in options and self.random.random() >= self.fake_transition:
+                return None
+            return self.fakeValue(name, choices[0])
+        if typing.get_origin(annotation) is Literal:
+            return self.random.choice(options)
+        if annotation is int:
+            return self.random.randint(1, 5)
+        if annotation is bool:
+            return self.random.random() < 0.5
+
+        return f"fake {name}"
+
+    def fakeOutput(self, chain) -> str:
+        if chain.schema is not None:
+            values = {
+                name: self.fakeValue(name, field.annotation)
+                for name, field in chain.schema.model_fields.items()
+            }
+            return chain.schema.model_validate(values).model_dump_json()
+
+        if chain.site == "agent" and self.random.random() < self.fake_finish:
+            return "<COMPLETE_CONVERSATION>"
+
+        return f"({chain.site or chain.model} 가짜 응답 {self.random.randint(0, 9999)})"
+
+    # every call that reaches a provider (or the fake one) goes through its rate limiter
+    async def invoke(self, chain, rendered_prompt: str) -> Any:
+        if self.mode == "replay":
+            return await self.callModel(chain, rendered_prompt)
+
+        return await getLimiter(chain.provider, chain.model).call(
+            estimateTokens(rendered_prompt), lambda: self.callModel(chain, rendered_prompt)
+        )
+
+    async def stream(self, chain, rendered_prompt: str) -> AsyncIterator[AIMessageChunk]:
+        if self.mode == "replay":
+            async for chunk in self.streamModel(chain, rendered_prompt):
+                yield chunk
+            return
+
+        # closed right away when the caller stops early, so the slot is released with it
+        async with aclosing(
+            getLimiter(chain.provider, chain.model).stream(
+                estimateTokens(rendered_prompt), lambda: self.streamModel(chain, rendered_prompt)
+            )
+        ) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    async def callModel(self, chain, rendered_prompt: str) -> Any:
+        if self.mode == "live":
+            return await chain.getLLM().ainvoke(rendered_prompt)
+
+        if self.mode == "fake":
+            await self.sleepFakeLatency()
+            return chain.loadOutput(self.fakeOutput(chain))
+
+        key = chain.getCacheKey(rendered_prompt)
+        if self.mode == "replay":
+            return chain.loadOutput(self.cassette.replay(key))
+
+        output = await chain.getLLM().ainvoke(rendered_prompt)
+        self.cassette.record(
+            key, chain.site, chain.model, rendered_prompt, chain.dumpOutput(output)
+        )
+
+        return output
+
+    async def streamModel(self, chain, rendered_prompt: str) -> AsyncIterator[AIMessageChunk]:
+        if self.mode == "live":
+            async for chunk in chain.getLLM().astream(rendered_prompt):
+                yield chunk
+            return
+
+        if self.mode in ["fake", "replay"]:
+            if self.mode == "fake":
+                await self.sleepFakeLatency()
+                output = self.fakeOutput(chain)
+            else:
+                output = self.cassette.replay(chain.getCacheKey(rendered_prompt))
+            for position in range(0, len(output), 4):
+                yield AIMessageChunk(content=output[position : position + 4])
+                await asyncio.sleep(0)
+            return
+
+        contents = []
+        async for chunk in chain.getLLM().astream(rendered_prompt):
+            contents.append(chunk.content)
+            yield chunk
+        self.cassette.record(
+            chain.getCacheKey(rendered_prompt),
+            chain.site,
+            chain.model,
+            rendered_prompt,
+            "".join(contents),
+        )
+
+
+backend = None  # : ModelBackend
+
+
+def configureBackend(mode: str, cassette_path: str | None = None, **fake_options):
+    global backend
+
+    # e.g. CUMPA_FAKE_LATENCY=0.8 CUMPA_FAKE_JITTER=0.2 CUMPA_FAKE_SEED=0
+    options = {
+        "fake_latency": float(os.getenv("CUMPA_FAKE_LATENCY", "0.5")),
+        "fake_jitter": float(os.getenv("CUMPA_FAKE_JITTER", "0.1")),
+        "fake_transition": float(os.getenv("CUMPA_FAKE_TRANSITION", "0.3")),
+        "fake_finish": float(os.getenv("CUMPA_FAKE_FINISH", "0.1")),
+        "fake_tail": float(os.getenv("CUMPA_FAKE_TAIL", "0.0")),
+        "fake_tail_latency": float(os.getenv("CUMPA_FAKE_TAIL_LATENCY", "5.0")),
+        "fake_error": float(os.getenv("CUMPA_FAKE_ERROR", "0.0")),
+        "fake_capacity": (
+            int(os.getenv("CUMPA_FAKE_CAPACITY")) if os.getenv("CUMPA_FAKE_CAPACITY") else None
+        ),
+        "seed": int(os.getenv("CUMPA_FAKE_SEED")) if os.getenv("CUMPA_FAKE_SEED") else None,
+    }
+    options.update(fake_options)
+    backend = ModelBackend(
+        mode,
+        cassette_path or os.getenv("CUMPA_LLM_CASSETTE", "./llm cassette.jsonl"),
+        **options,
+    )
+
+
+def getBackend() -> ModelBackend:
+    if backend is None:
+        # e.g. CUMPA_LLM_BACKEND=replay CUMPA_LLM_CASSETTE="./llm cassette.jsonl"
+        configureBackend(os.getenv("CUMPA_LLM_BACKEND", "live"))
+
+    return backend
@@ -0,0 +1,422 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import DB
+from backend import configureBackend
+from retention import RetentionPolicy
+
+
+def summarize(samples: list[float]) -> dict:
+    ordered = sorted(samples)
+
+    def percentile(ratio: float) -> float:
+        return ordered[min(len(ordered) - 1, int(ratio * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(1000 * sum(ordered) / len(ordered), 3),
+        "p50_ms": round(1000 * percentile(0.50), 3),
+        "p95_ms": round(1000 * percentile(0.95), 3),
+        "p99_ms": round(1000 * percentile(0.99), 3),
+    }
+
+
+def loadPhaseManager(turn_mode: str = "two_call", models: dict | None = None):
+    import main
+
+    setting = main.getTestSettingData()
+    setting.turn_mode = turn_mode
+    if models is not None:
+        setting.models = type(setting.models).model_validate(models)
+    # the setting printouts are not part of the measurement
+    with contextlib.redirect_stdout(io.StringIO()):
+        return main.saveTestSetting(setting)
+
+
+# latency of executeChatbot turns, played as simulated dialogues against the fake backend
+async def benchTurns(
+    turns: int, mode: str, turn_mode: str = "two_call", models: dict | None = None
+) -> dict:
+    from chatbot import executeChatbot
+
+    phase_manager = loadPhaseManager(turn_mode, models)
+    samples = []
+    dialogue = 0
+    while len(samples) < turns:
+        dialogue += 1
+        session = phase_manager.createSession()
+        session_id = f"bench-turn-{turn_mode}-{mode}-{dialogue}"
+        DB.addMessage("PHASE", session.getStartPhase().getName(), session_id)
+        for _ in range(20):
+            DB.addMessage("USER", "요즘 기분이 좀 복잡해요.", session_id)
+            start = time.perf_counter()
+            response, changed = await executeChatbot(
+                session, DB.getHistory(session_id), mode=mode
+            )
+            samples.append(time.perf_counter() - start)
+            DB.addMessage("AI", response, session_id)
+            if changed:
+                DB.addMessage("PHASE", session.getCurrPhase().getName(), session_id)
+            if session.isFinished() or len(samples) >= turns:
+                break
+
+    return {"mode": mode, "turn_mode": turn_mode, "dialogues": dialogue, **summarize(samples)}
+
+
+# turn latency when a share of the calls is slow, on the primary only and hedged to a secondary
+def benchHedge(turns: int, tail: float, tail_latency: float) -> list[dict]:
+    from hedge import getHedgeStats
+
+    primary = {"provider": "openai", "model": "gpt-4o"}
+    routes = {
+        "primary": {"primary": primary},
+        "hedged": {
+            "primary": primary,
+            "secondaries": [{"provider": "anthropic", "model": "claude-3-5-sonnet-latest"}],
+            "hedge_delay": tail_latency / 2,
+        },
+    }
+    configureBackend(
+        "fake",
+        fake_latency=0.01,
+        fake_jitter=0.002,
+        fake_tail=tail,
+        fake_tail_latency=tail_latency,
+        seed=0,
+    )
+    results = []
+    for name, models in routes.items():
+        result = asyncio.run(benchTurns(turns, "default", models=models))
+        results.append({"route": name, "fake_tail": tail, "fake_tail_latency": tail_latency, **result})
+    results[-1]["hedge_stats"] = getHedgeStats()
+
+    return results
+
+
+# sustained calls per second against a fake provider that rejects calls above its capacity
+def benchRateLimit(calls: int, capacity: int) -> dict:
+    from llm import ModelChain
+    from langchain_core.prompts import PromptTemplate
+    from ratelimit import configureRateLimits, getLimiter
+
+    configureBackend("fake", fake_latency=0.02, fake_jitter=0.005, fake_capacity=capacity, seed=0)
+    configureRateLimits({}, 4 * capacity)
+    chain = ModelChain(PromptTemplate.from_template("{x}"), "openai", "gpt-4o", site="generator")
+
+    async def run() -> float:
+        start = time.perf_counter()
+        await asyncio.gather(*(chain.ainvoke({"x": index}) for index in range(calls)))
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(run())
+    stats = getLimiter("openai", "gpt-4o").getStats()
+    configureRateLimits()
+
+    return {
+        "calls": calls,
+        "fake_capacity": capacity,
+        "calls_per_s": round(calls / elapsed, 1),
+        "rate_limited": stats["rate_limited"],
+        "concurrency_limit": stats["concurrency_limit"],
+    }
+
+
+# addMessage and getHistory throughput while one session's history grows
+def benchDB(sizes: list[int], write_behind: bool = False) -> list[dict]:
+    if write_behind:
+        DB.startWriter()
+    results = []
+    for size in sizes:
+        session_id = f"bench-db-{size}-{'queued' if write_behind else 'direct'}"
+        DB.reset(session_id)
+        DB.getHistory(session_id)
+
+        add_samples = []
+        history_samples = []
+        for index in range(size):
+            start = time.perf_counter()
+            DB.addMessage("USER" if index % 2 == 0 else "AI", f"message {index} " * 8, session_id)
+            add_samples.append(time.perf_counter() - start)
+            # the turn pipeline reads the history after each message
+            start = time.perf_counter()
+            DB.getHistory(session_id)
+            history_samples.append(time.perf_counter() - start)
+
+        # a cold read goes to SQLite, as after a restart
+        start = time.perf_counter()
+        DB.flushMessages()
+        flush = time.perf_counter() - start
+        DB.transcripts.clear()
+        start = time.perf_counter()
+        DB.getHistory(session_id)
+        cold_read = time.perf_counter() - start
+
+        results.append(
+            {
+                "write_behind": write_behind,
+                "messages": size,
+                "add_per_s": round(size / sum(add_samples), 1),
+                "add": summarize(add_samples),
+                "history_per_s": round(size / sum(history_samples), 1),
+                "history": summarize(history_samples),
+                "cold_history_ms": round(1000 * cold_read, 3),
+                "flush_ms": round(1000 * flush, 3),
+            }
+        )
+    DB.stopWriter()
+
+    return results
+
+
+# a retention run over a history of finished and active conversations: how long the message writes
+# next to it stall, and the cold read of an active conversation before and after
+def benchRetention(sessions: int, messages: int, archive_path: str) -> dict:
+    DB.reset()
+    now = time.time()
+    with DB.pool.connection() as conn:
+        for index in range(sessions):
+            finished = index % 2 == 0
+            session_id = f"bench-retention-{'finished' if finished else 'active'}-{index}"
+            created_at = now - 3600 if finished else now
+            rows = [("PHASE", "Start")]
+            rows += [("USER" if turn % 2 == 0 else "AI", f"message {turn} " * 8) for turn in range(messages)]
+            if finished:
+                rows.append(("PHASE", "FINISH"))
+            conn.executemany(
+                DB.INSERT_MESSAGE,
+                [(session_id, speaker, content, created_at) for speaker, content in rows],
+            )
+    active_session = f"bench-retention-active-{sessions - 1}"
+
+    def coldRead() -> float:
+        DB.transcripts.clear()
+        start = time.perf_counter()
+        DB.getHistory(active_session)
+        return time.perf_counter() - start
+
+    cold_before = coldRead()
+    with DB.pool.connection() as conn:
+        hot_rows_before = conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    # synchronous writes, so every sample waits for the database's write lock
+    add_samples = []
+    running = True
+
+    def addMessages():
+        while running:
+            start = time.perf_counter()
+            DB.addMessage("USER", "message during retention", "bench-retention-writes")
+            add_samples.append(time.perf_counter() - start)
+
+    writer = threading.Thread(target=addMessages)
+    writer.start()
+    try:
+        summary, _ = RetentionPolicy(archive_path, archive_after=60).run()
+    finally:
+        running = False
+        writer.join()
+
+    return {
+        "sessions": sessions,
+        "messages": hot_rows_before,
+        "run_s": summary["seconds"],
+        "archived_rows": summary["archived_rows"],
+        "hot_rows": summary["hot_rows"],
+        "freed_pages": summary["freed_pages"],
+        "add_during_run": summarize(add_samples),
+        "max_add_ms": round(1000 * max(add_samples), 3),
+        "cold_history_before_ms": round(1000 * cold_before, 3),
+        "cold_history_after_ms": round(1000 * coldRead(), 3),
+    }
+
+
+# construction cost of the structured output models of every phase
+def benchResponseFormat(repeats: int) -> dict:
+    phase_manager = loadPhaseManager()
+    phases = [phase for phase in phase_manager.getPhases() if phase.router_list]
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for phase in phases:
+            phase.buildResponseFormat()
+    build = (time.perf_counter() - start) / (repeats * len(phases))
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for phase in phases:
+            phase.getResponseFormat()
+    cached = (time.perf_counter() - start) / (repeats * len(phases))
+
+    return {
+        "phases": len(phases),
+        "build_us": round(1e6 * build, 2),
+        "cached_us": round(1e6 * cached, 3),
+    }
+
+
+# /execute requests per second with concurrent clients, each one in its own session
+async def benchHTTP(clients: int, requests: int) -> dict:
+    import httpx
+    import main
+    import server
+
+    samples = []
+    errors = 0
+
+    async def client(index: int, http: httpx.AsyncClient):
+        nonlocal errors
+        for turn in range(requests):
+            start = time.perf_counter()
+            response = await http.post(
+                "/execute",
+                json={"input": f"안녕하세요 {turn}", "session_id": f"bench-http-{index}"},
+            )
+            samples.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+            elif response.json()["finished"]:
+                await http.post("/reset-DB", json={"session_id": f"bench-http-{index}"})
+
+    async with server.lifespan(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+            with contextlib.redirect_stdout(io.StringIO()):
+                await http.post(
+                    "/save-settings", json=main.getTestSettingData().model_dump()
+                )
+            start = time.perf_counter()
+            await asyncio.gather(*(client(index, http) for index in range(clients)))
+            elapsed = time.perf_counter() - start
+
+    return {
+        "clients": clients,
+        "requests": len(samples),
+        "errors": errors,
+        "requests_per_s": round(len(samples) / elapsed, 1),
+        **summarize(samples),
+    }
+
+
+# wall time of fresh interpreters loading what each mode of main.py needs
+def benchStartup(repeats: int) -> list[dict]:
+    commands = {
+        "import main": [sys.executable, "-c", "import main"],
+        "main.py --help": [sys.executable, "main.py", "--help"],
+        "import server": [sys.executable, "-c", "import server"],
+        "import chatbot, simulator": [sys.executable, "-c", "import chatbot, simulator"],
+        "import exporter": [sys.executable, "-c", "import exporter"],
+    }
+    results = []
+    for name, command in commands.items():
+        samples = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run(command, capture_output=True, check=True)
+            samples.append(time.perf_counter() - start)
+        results.append(
+            {
+                "command": name,
+                "median_ms": round(1000 * statistics.median(samples), 1),
+                "min_ms": round(1000 * min(samples), 1),
+            }
+        )
+
+    return results
+
+
+def getCommit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmarks against the fake LLM backend")
+    parser.add_argument("--output", default="./benchmark results.json", help="JSON result file")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake LLM latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="fake LLM latency jitter in seconds")
+    parser.add_argument("--turns", type=int, default=500, help="turns for the turn latency benchmark")
+    parser.add_argument(
+        "--db-sizes", default="100,1000,5000", help="comma separated history sizes for the DB benchmark"
+    )
+    parser.add_argument("--format-repeats", type=int, default=50, help="repeats for the response format benchmark")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients for the HTTP benchmark")
+    parser.add_argument("--requests", type=int, default=25, help="requests per client for the HTTP benchmark")
+    parser.add_argument("--tail", type=float, default=0.05, help="share of slow fake calls for the hedging benchmark")
+    parser.add_argument("--tail-latency", type=float, default=0.25, help="seconds of a slow fake call for the hedging benchmark")
+    parser.add_argument("--capacity", type=int, default=12, help="concurrent calls the fake provider accepts in the rate limit benchmark")
+    parser.add_argument("--startup-repeats", type=int, default=5, help="fresh interpreters per startup command")
+    parser.add_argument(
+        "--retention-sessions", type=int, default=5000, help="conversations in the history for the retention benchmark"
+    )
+    args = parser.parse_args()
+
+    # no network: every LLM call is answered by the fake backend, with a fixed seed
+    configureBackend("fake", fake_latency=args.latency, fake_jitter=args.jitter, seed=0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        DB.setDatabase(os.path.join(directory, "benchmark.db"))
+        DB.initialize()
+        # the HTTP benchmark's server archives the history at startup
+        archive_path = os.path.join(directory, "archive.db")
+        os.environ["CUMPA_ARCHIVE_PATH"] = archive_path
+
+        results = {}
+        print("startup time...")
+        results["startup"] = benchStartup(args.startup_repeats)
+        print("turn latency...")
+        results["turns"] = [
+            asyncio.run(benchTurns(args.turns, mode, turn_mode))
+            for turn_mode in ["two_call", "fused"]
+            for mode in ["default", "routed"]
+        ]
+        print("hedged turn latency...")
+        results["hedge"] = benchHedge(args.turns, args.tail, args.tail_latency)
+        configureBackend("fake", fake_latency=args.latency, fake_jitter=args.jitter, seed=0)
+        print("rate limited throughput...")
+        results["rate_limit"] = benchRateLimit(max(args.turns, 100), args.capacity)
+        configureBackend("fake", fake_latency=args.latency, fake_jitter=args.jitter, seed=0)
+        print("DB throughput...")
+        sizes = [int(size) for size in args.db_sizes.split(",")]
+        results["db"] = benchDB(sizes) + benchDB(sizes, write_behind=True)
+        print("retention...")
+        results["retention"] = benchRetention(args.retention_sessions, 40, archive_path)
+        print("response format construction...")
+        results["response_format"] = benchResponseFormat(args.format_repeats)
+        print("HTTP /execute...")
+        results["http"] = asyncio.run(benchHTTP(args.clients, args.requests))
+
+        DB.pool.close()
+
+    report = {
+        "commit": getCommit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "fake_latency": args.latency,
+        "fake_jitter": args.jitter,
+        "results": results,
+    }
+    with open(args.output, mode="w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    print(f"results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import sys
+from types import MappingProxyType
+from phase import Phase
+from historywindow import HistoryWindow
+from router import LocalRouter
+from hedge import ModelRoute, DEFAULT_MODEL_ROUTE
+
+
+# the terminal phase every conversation ends in, entered from one of the finish phases
+FINISH_PHASE = "FINISH"
+TURN_MODES = ["two_call", "fused"]
+
+
+# the validated, read-only definition of one chatbot, shared by all of its sessions
+class BotGraph:
+    __slots__ = (
+        "bot_name",
+        "bot_desc",
+        "phases",
+        "phase_index",
+        "start_index",
+        "finish_index",
+        "finish_phases",
+        "topics",
+        "phase_topics",
+        "adjacency",
+        "turn_mode",
+        "history_windows",
+        "router",
+        "model_route",
+        "frozen",
+    )
+
+    def __init__(
+        self,
+        bot_name: str,
+        bot_desc: str,
+        phases: list[Phase],
+        start_phase: str,
+        finish_phases: list[str],
+        topics: dict[str, str],
+        turn_mode: str = "two_call",
+        history_windows: dict[str, HistoryWindow] | None = None,
+        router: LocalRouter | None = None,
+        model_route: ModelRoute | None = None,
+    ):
+        if turn_mode not in TURN_MODES:
+            raise ValueError(f"turn mode should be one of {TURN_MODES}.")
+        for role in history_windows or {}:
+            if role not in ["selector", "generator"]:
+                raise ValueError("role should be one of 'selector', 'generator'.")
+
+        phases = list(phases) + [Phase(FINISH_PHASE, "", [], "", [])]
+        phase_index = {}
+        for index, phase in enumerate(phases):
+            # names are compared on every turn, so each one is stored once
+            phase.name = sys.intern(phase.name)
+            phase.topic_list = [sys.intern(topic) for topic in phase.topic_list]
+            if phase.name in phase_index:
+                raise ValueError(f"Phase named {phase.name} is already added")
+            phase_index[phase.name] = index
+        if start_phase not in phase_index or start_phase == FINISH_PHASE:
+            raise ValueError(f"Phase named {start_phase} is not added.")
+
+        phase_topics = []
+        adjacency = []
+        for phase in phases:
+            for topic in phase.topic_list:
+                if topic not in topics:
+                    raise ValueError(f"Action named {topic} of phase {phase.name} is not added.")
+            phase_topics.append(
+                MappingProxyType({topic: topics[topic] for topic in phase.topic_list})
+            )
+
+            next_phases = {}
+            for route in phase.router_list:
+                next_phase = route["next_phase"]
+                if next_phase not in phase_index:
+                    raise ValueError(
+                        f"Phase {phase.name} routes to {next_phase}, which is not added."
+                    )
+                next_phases[sys.intern(next_phase)] = phase_index[next_phase]
+            adjacency.append(MappingProxyType(next_phases))
+
+            # a phase without routers could never be left
+            if phase.name != FINISH_PHASE and not next_phases:
+                raise ValueError(f"Phase {phase.name} has no router.")
+
+        finish_index = phase_index[FINISH_PHASE]
+        for name in finish_phases:
+            if name not in phase_index or name == FINISH_PHASE:
+                raise ValueError(f"Finish phase named {name} is not added.")
+            if FINISH_PHASE not in adjacency[phase_index[name]]:
+                raise ValueError(f"Finish phase {name} has no router to {FINISH_PHASE}.")
+        for phase, next_phases in zip(phases, adjacency):
+            if FINISH_PHASE in next_phases and phase.name not in finish_phases:
+                raise ValueError(
+                    f"Phase {phase.name} routes to {FINISH_PHASE}, but it is not a finish phase."
+                )
+
+        # every phase is reachable from the start phase, and every phase can still reach FINISH
+        reached = self.walk([phase_index[start_phase]], adjacency)
+        unreachable = [phase.name for index, phase in enumerate(phases) if index not in reached]
+        if unreachable:
+            raise ValueError(f"Phases {unreachable} can't be reached from {start_phase}.")
+        reverse = [{} for _ in phases]
+        for index, next_phases in enumerate(adjacency):
+            for next_index in next_phases.values():
+                reverse[next_index][phases[index].name] = index
+        finishing = self.walk([finish_index], reverse)
+        trapped = [phase.name for index, phase in enumerate(phases) if index not in finishing]
+        if trapped:
+            raise ValueError(f"Phases {trapped} can't reach {FINISH_PHASE}.")
+
+        self.bot_name = bot_name
+        self.bot_desc = bot_desc
+        self.phases = tuple(phases)
+        self.phase_index = MappingProxyType(phase_index)
+        self.start_index = phase_index[start_phase]
+        self.finish_index = finish_index
+        self.finish_phases = frozenset(finish_phases)
+        self.topics = MappingProxyType(dict(topics))
+        self.phase_topics = tuple(phase_topics)
+        self.adjacency = tuple(adjacency)
+        self.turn_mode = turn_mode
+        self.history_windows = MappingProxyType(dict(history_windows or {}))
+        # the router keeps learning, the graph only holds it
+        self.router = router
+        self.model_route = model_route or DEFAULT_MODEL_ROUTE
+        self.frozen = True
+
+    def __setattr__(self, name: str, value):
+        if getattr(self, "frozen", False):
+            raise AttributeError("a compiled bot graph can't be changed.")
+        object.__setattr__(self, name, value)
+
+    @staticmethod
+    def walk(starts: list[int], edges: list) -> set[int]:
+        reached = set(starts)
+        stack = list(starts)
+        while stack:
+            for next_index in edges[stack.pop()].values():
+                if next_index not in reached:
+                    reached.add(next_index)
+                    stack.append(next_index)
+
+        return reached
+
+    def getPhase(self, name: str) -> Phase:
+        if name not in self.phase_index:
+            raise ValueError(f"Phase named {name} is not added.")
+
+        return self.phases[self.phase_index[name]]
+
+    def getPhases(self) -> list[Phase]:
+
+        return list(self.phases)
+
+    def getStartPhase(self) -> Phase:
+
+        return self.phases[self.start_index]
+
+    def getTopics(self, phase: Phase) -> MappingProxyType:
+
+        return self.phase_topics[self.phase_index[phase.name]]
+
+    def getHistoryWindow(self, role: str) -> HistoryWindow | None:
+
+        return self.history_windows.get(role)
+
+    def getTurnMode(self) -> str:
+
+        return self.turn_mode
+
+    def getRouter(self) -> LocalRouter | None:
+
+        return self.router
+
+    def getModelRoute(self) -> ModelRoute:
+
+        return self.model_route
+
+    def getBotInfo(self) -> tuple[str, str]:
+
+        return self.bot_name, self.bot_desc
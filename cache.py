@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# call sites that can be cached, generation with temperature=1 is only cached when asked for
+CACHE_SITES = ["selector", "generator", "fused", "agent", "evaluation", "summary"]
+
+
+class LLMCache:
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        path: str | None = None,
+        ttl: float | None = None,
+        max_disk_entries: int = 100000,
+    ):
+        self.max_entries = max_entries
+        self.path = path
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.memory = OrderedDict()  # : OrderedDict[str, tuple[str, float]]
+        self.lock = threading.Lock()
+        self.conn = None  # : sqlite3.Connection
+        self.puts_since_eviction = 0
+        self.stats = {"hits": 0, "misses": 0, "memory_hits": 0, "disk_hits": 0}
+
+        if path is not None:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache (accessed_at)"
+            )
+            self.conn.commit()
+
+    @staticmethod
+    def makeKey(model_id: str, params: dict, prompt: str, schema_id: str = "") -> str:
+        payload = json.dumps(
+            [model_id, params, schema_id, prompt], sort_keys=True, ensure_ascii=False
+        )
+
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def isExpired(self, created_at: float, now: float) -> bool:
+
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and not self.isExpired(entry[1], now):
+                self.memory.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["memory_hits"] += 1
+                return entry[0]
+
+            if self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and not self.isExpired(row[1], now):
+                    self.conn.execute(
+                        "UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key)
+                    )
+                    self.conn.commit()
+                    self.putMemory(key, row[0], row[1])
+                    self.stats["hits"] += 1
+                    self.stats["disk_hits"] += 1
+                    return row[0]
+
+            self.stats["misses"] += 1
+
+        return None
+
+    def putMemory(self, key: str, value: str, created_at: float):
+        self.memory[key] = (value, created_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        with self.lock:
+            self.putMemory(key, value, now)
+
+            if self.conn is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, value, now, now),
+                )
+                self.conn.commit()
+                self.puts_since_eviction += 1
+                if self.puts_since_eviction >= 100:
+                    self.evict()
+
+    # drop expired rows, then the least recently used rows over max_disk_entries
+    def evict(self):
+        self.puts_since_eviction = 0
+        if self.ttl is not None:
+            self.conn.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.ttl,)
+            )
+        self.conn.execute(
+            """
+            DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+        """,
+            (self.max_disk_entries,),
+        )
+        self.conn.commit()
+
+    def getStats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.stats)
+
+
+caches = {}  # : dict[str, LLMCache], keyed by call site
+env_loaded = False
+
+
+def configureCache(
+    sites: list[str],
+    path: str | None = None,
+    ttl: float | None = None,
+    max_entries: int = 1024,
+):
+    global env_loaded
+    # an explicit configuration takes precedence over the environment
+    env_loaded = True
+
+    for site in sites:
+        if site not in CACHE_SITES:
+            raise ValueError(f"cache site should be one of {CACHE_SITES}.")
+
+    # each call site counts its own hits, the disk tier can still be one shared file
+    caches.clear()
+    for site in sites:
+        caches[site] = LLMCache(max_entries=max_entries, path=path, ttl=ttl)
+
+
+def loadCacheEnv():
+    global env_loaded
+    env_loaded = True
+
+    # e.g. CUMPA_LLM_CACHE="selector,evaluation", CUMPA_LLM_CACHE_PATH="llm_cache.db"
+    sites = [site for site in os.getenv("CUMPA_LLM_CACHE", "").split(",") if site]
+    if sites and not caches:
+        ttl = os.getenv("CUMPA_LLM_CACHE_TTL")
+        configureCache(
+            sites,
+            path=os.getenv("CUMPA_LLM_CACHE_PATH"),
+            ttl=float(ttl) if ttl else None,
+        )
+
+
+def getCache(site: str | None) -> LLMCache | None:
+    if not env_loaded:
+        loadCacheEnv()
+
+    return caches.get(site)
+
+
+def getCacheStats() -> dict[str, dict[str, int]]:
+
+    return {site: cache.getStats() for site, cache in caches.items()}
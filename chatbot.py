@@ -1,20 +1,16 @@
+import time
 from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-from typing import Any
+from typing import Any, AsyncIterator
+from phase import Phase
 from phasemanager import PhaseManager
+from botgraph import BotGraph
+from metrics import TURN_SECONDS, TURN_STAGE_SECONDS, timeSpan
 
 
-async def selectTopic(phase_manager: PhaseManager, conversation_history: str) -> Any:
-    bot_name, bot_desc = phase_manager.getBotInfo()
-    actions = phase_manager.getTopics()
-    phase_info = phase_manager.getCurrPhase().getInfo()
-    response_format = phase_manager.getCurrPhase().getResponseFormat()
-
-    llm = ChatOpenAI(model="gpt-4o", temperature=1)
-    llm = llm.with_structured_output(response_format)
+TURN_MODES = ["default", "routed"]
 
-    prompt_template = PromptTemplate.from_template(
-        """
+SELECTOR_PROMPT = PromptTemplate.from_template(
+    """
     [Task]
     You are an action selector of the {bot_name}, which is {bot_desc}. 
     Your role is to do two things with reference to the "Context".
@@ -28,37 +24,10 @@ async def selectTopic(phase_manager: PhaseManager, conversation_history: str) ->
     - current phase instruction: {phase_instruction}
     - conversation history: {conversation_history}
     """
-    )
-
-    chain = prompt_template | llm
-    response = await chain.ainvoke(
-        {
-            "bot_name": bot_name,
-            "bot_desc": bot_desc,
-            "phase_name": phase_info["name"],
-            "phase_goal": phase_info["goal"],
-            "phase_actions": actions,
-            "phase_instruction": phase_info["instruction"],
-            "conversation_history": conversation_history,
-        }
-    )
-
-    return response
-
+)
 
-async def generateResponse(
-    phase_manager: PhaseManager,
-    conversation_history: str,
-    action: str,
-    action_reason: str,
-) -> str:
-    bot_name, bot_desc = phase_manager.getBotInfo()
-    phase_info = phase_manager.getCurrPhase().getInfo()
-    
-    llm = ChatOpenAI(model="gpt-4o", temperature=1)
-
-    prompt_template = PromptTemplate.from_template(
-        """
+GENERATOR_PROMPT = PromptTemplate.from_template(
+    """
     [Task]
     You are a response generator of the {bot_name}, which is {bot_desc}.
     To achieve the "phase goal" within the total conversation, one "action" is selected for the current conversation turn.
@@ -73,34 +42,249 @@ async def generateResponse(
     - reason for the action selection: {action_reason}
     - conversation history: {conversation_history}
     """
+)
+
+FUSED_PROMPT = PromptTemplate.from_template(
+    """
+    [Task]
+    You are the {bot_name}, which is {bot_desc}.
+    Your role is to do three things with reference to the "Context".
+    1. Decide whether the main goal of the current phase is achieved. And if it is achieved, select which phase to go next.
+    2. Decide which action to use for the current conversation turn. You can only select one action from the available actions below.
+    3. Make a chatbot response for this turn with the selected action, to achieve the "phase goal" within the total conversation.
+    You MUST ask or respond about one subject at a time.
+    The response MUST be in KOREAN.
+
+    [Context]
+    - current phase name: {phase_name}
+    - current phase goal: {phase_goal}
+    - available actions: {phase_actions}
+    - current phase instruction: {phase_instruction}
+    - conversation history: {conversation_history}
+    """
+)
+
+
+# build the selector, generator and fused chains of one phase, with the phase context filled in
+def compilePhase(graph: BotGraph, phase: Phase):
+    bot_name, bot_desc = graph.getBotInfo()
+    phase_info = phase.getInfo()
+
+    selector_prompt = SELECTOR_PROMPT.partial(
+        bot_name=bot_name,
+        bot_desc=bot_desc,
+        phase_name=phase_info["name"],
+        phase_goal=phase_info["goal"],
+        phase_actions=str(dict(graph.getTopics(phase))),
+        phase_instruction=phase_info["instruction"],
+    )
+    generator_prompt = GENERATOR_PROMPT.partial(
+        bot_name=bot_name,
+        bot_desc=bot_desc,
+        phase_name=phase_info["name"],
+        phase_goal=phase_info["goal"],
+    )
+    fused_prompt = FUSED_PROMPT.partial(
+        bot_name=bot_name,
+        bot_desc=bot_desc,
+        phase_name=phase_info["name"],
+        phase_goal=phase_info["goal"],
+        phase_actions=str(dict(graph.getTopics(phase))),
+        phase_instruction=phase_info["instruction"],
+    )
+
+    # every chain is called on the models of the bot, hedged when it has secondaries
+    model_route = graph.getModelRoute()
+    phase.setChains(
+        model_route.makeChain(
+            selector_prompt,
+            temperature=1,
+            schema=phase.getResponseFormat(),
+            site="selector",
+        ),
+        model_route.makeChain(generator_prompt, temperature=1, site="generator"),
+        model_route.makeChain(
+            fused_prompt,
+            temperature=1,
+            schema=phase.getFusedResponseFormat(),
+            site="fused",
+        ),
+    )
+
+
+# compile every phase that can answer, called once when the chatbot setting is saved
+def compileChatbot(graph: BotGraph):
+    for phase in graph.getPhases():
+        # terminal phases (e.g. FINISH) have no router, so they never answer
+        if phase.router_list:
+            compilePhase(graph, phase)
+
+
+def getCompiledPhase(phase_manager: PhaseManager, phase: Phase | None = None) -> Phase:
+    if phase is None:
+        phase = phase_manager.getCurrPhase()
+    if not phase.isCompiled():
+        compilePhase(phase_manager.getGraph(), phase)
+
+    return phase
+
+
+# apply the token budget of the selector or the generator, if the chatbot has one
+async def windowHistory(
+    phase_manager: PhaseManager, role: str, conversation_history: str
+) -> str:
+    window = phase_manager.getHistoryWindow(role)
+    if window is None:
+        return conversation_history
+
+    with timeSpan(TURN_STAGE_SECONDS, stage=f"{role}_window"):
+        return await window.apply(conversation_history)
+
+
+async def selectTopic(phase_manager: PhaseManager, conversation_history: str) -> Any:
+    phase = getCompiledPhase(phase_manager)
+    # a confident local router answers without the selector LLM
+    router = phase_manager.getRouter()
+    local_response = None
+    if router is not None:
+        with timeSpan(TURN_STAGE_SECONDS, stage="route"):
+            local_response = router.route(phase, conversation_history)
+        if local_response is not None and not router.shadow:
+            return local_response
+
+    windowed_history = await windowHistory(
+        phase_manager, "selector", conversation_history
+    )
+    with timeSpan(TURN_STAGE_SECONDS, stage="select"):
+        response = await phase.getSelectorChain().ainvoke(
+            {"conversation_history": windowed_history}
+        )
+
+    if router is not None:
+        router.observe(phase, conversation_history, response, local_response)
+
+    return response
+
+
+async def generateResponse(
+    phase_manager: PhaseManager,
+    conversation_history: str,
+    action: str,
+    action_reason: str,
+    phase: Phase | None = None,
+) -> str:
+    chain = getCompiledPhase(phase_manager, phase).getGeneratorChain()
+    conversation_history = await windowHistory(
+        phase_manager, "generator", conversation_history
     )
+    with timeSpan(TURN_STAGE_SECONDS, stage="generate"):
+        response = await chain.ainvoke(
+            {
+                "action": action,
+                "action_reason": action_reason,
+                "conversation_history": conversation_history + "\nAI: ",
+            }
+        )
 
-    chain = prompt_template | llm
-    response = await chain.ainvoke(
+    return response
+
+
+async def streamResponse(
+    phase_manager: PhaseManager,
+    conversation_history: str,
+    action: str,
+    action_reason: str,
+    phase: Phase | None = None,
+) -> AsyncIterator[str]:
+    chain = getCompiledPhase(phase_manager, phase).getGeneratorChain()
+    conversation_history = await windowHistory(
+        phase_manager, "generator", conversation_history
+    )
+    start = time.perf_counter()
+    first_token = True
+    async for chunk in chain.astream(
         {
-            "bot_name": bot_name,
-            "bot_desc": bot_desc,
-            "phase_name": phase_info["name"],
-            "phase_goal": phase_info["goal"],
             "action": action,
             "action_reason": action_reason,
             "conversation_history": conversation_history + "\nAI: ",
         }
+    ):
+        if chunk.content:
+            if first_token:
+                TURN_STAGE_SECONDS.observe(
+                    time.perf_counter() - start, stage="first_token"
+                )
+                first_token = False
+            yield chunk.content
+    TURN_STAGE_SECONDS.observe(time.perf_counter() - start, stage="stream")
+
+
+# select the action, route and generate the response in a single structured output call
+async def fuseTurn(
+    phase_manager: PhaseManager, conversation_history: str, phase: Phase | None = None
+) -> Any:
+    chain = getCompiledPhase(phase_manager, phase).getFusedChain()
+    # the response is the main output, so the generator window applies
+    conversation_history = await windowHistory(
+        phase_manager, "generator", conversation_history
     )
+    with timeSpan(TURN_STAGE_SECONDS, stage="fused"):
+        response = await chain.ainvoke({"conversation_history": conversation_history})
 
     return response
 
 
-async def executeChatbot(
+async def executeFusedChatbot(
+    phase_manager: PhaseManager, conversation_history: str, mode: str
+) -> tuple[str, bool]:
+    fused_response = await fuseTurn(phase_manager, conversation_history)
+    changed = phase_manager.goNextPhase(fused_response.next_phase)
+
+    # routed: a new phase that can answer makes its own response, terminal phases keep the last one
+    if mode == "routed" and changed and phase_manager.getCurrPhase().router_list:
+        conversation_history += f"\n\n[{phase_manager.getCurrPhase().getName()}]"
+        # the new phase has just started, so its own routing is left to the next turn
+        fused_response = await fuseTurn(phase_manager, conversation_history)
+
+    return fused_response.response, changed
+
+
+# route the turn before generating, so only the phase that answers generates a response
+async def executeRoutedChatbot(
     phase_manager: PhaseManager, conversation_history: str
 ) -> tuple[str, bool]:
+    answering_phase = phase_manager.getCurrPhase()
     selector_response = await selectTopic(phase_manager, conversation_history)
-    
+    changed = phase_manager.goNextPhase(selector_response.next_phase)
+
+    # terminal phases (e.g. FINISH) can't answer, so the previous phase says the last words
+    if changed and phase_manager.getCurrPhase().router_list:
+        answering_phase = phase_manager.getCurrPhase()
+        conversation_history += f"\n\n[{answering_phase.getName()}]"
+        # the new phase has just started, so its own routing is left to the next turn
+        selector_response = await selectTopic(phase_manager, conversation_history)
+
+    chatbot_response = await generateResponse(
+        phase_manager,
+        conversation_history,
+        phase_manager.getTopics(answering_phase)[selector_response.action],
+        selector_response.action_reason,
+        answering_phase,
+    )
+
+    return chatbot_response.content, changed
+
+
+async def executeDefaultChatbot(
+    phase_manager: PhaseManager, conversation_history: str
+) -> tuple[str, bool]:
+    selector_response = await selectTopic(phase_manager, conversation_history)
+
     # next_phase_info = ""
     # if selector_response.next_phase:
     #     next_phase_info += f"\n- next phase name: {selector_response.next_phase}"
     #     next_phase_info += f"\n- next phase reason: {selector_response.next_phase_reason}"
-        
+
     chatbot_response = await generateResponse(
         phase_manager,
         conversation_history,
@@ -111,3 +295,22 @@ async def executeChatbot(
     changed = phase_manager.goNextPhase(selector_response.next_phase)
 
     return chatbot_response.content, changed
+
+
+async def executeChatbot(
+    phase_manager: PhaseManager, conversation_history: str, mode: str = "default"
+) -> tuple[str, bool]:
+    # default: the current phase answers and the phase changes afterwards
+    # routed: the phase changes first and the new phase answers
+    if mode not in TURN_MODES:
+        raise ValueError(f"mode should be one of {TURN_MODES}.")
+
+    turn_mode = phase_manager.getTurnMode()
+    with timeSpan(TURN_SECONDS, mode=mode, turn_mode=turn_mode):
+        # fused: one call selects, routes and answers, instead of the selector and the generator
+        if turn_mode == "fused":
+            return await executeFusedChatbot(phase_manager, conversation_history, mode)
+        if mode == "routed":
+            return await executeRoutedChatbot(phase_manager, conversation_history)
+
+        return await executeDefaultChatbot(phase_manager, conversation_history)
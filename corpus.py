@@ -0,0 +1,54 @@
+import csv
+import os
+import threading
+
+
+class DialogueCorpus:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.dialogues = {}  # : dict[int, list[str]]
+        self.loaded_mtime = None  # : int
+        self.lock = threading.Lock()
+
+    def load(self):
+        # the file is parsed once, and again only if it has changed since
+        mtime = os.stat(self.filepath).st_mtime_ns
+        if mtime == self.loaded_mtime:
+            return
+
+        dialogues = {}
+        with open(self.filepath, mode="r", encoding="utf-8", newline="") as file:
+            reader = csv.DictReader(file)
+
+            for row in reader:
+                dialogues.setdefault(int(row["index"]), []).append(
+                    f"{row['role']}: {row['message']}"
+                )
+
+        self.dialogues = dialogues
+        self.loaded_mtime = mtime
+
+    def getDialogue(self, index: int) -> list[str]:
+        with self.lock:
+            self.load()
+
+        return list(self.dialogues.get(index, []))
+
+    def getIndices(self) -> list[int]:
+        with self.lock:
+            self.load()
+
+        return sorted(self.dialogues.keys())
+
+
+corpora = {}  # : dict[str, DialogueCorpus]
+corpora_lock = threading.Lock()
+
+
+def getCorpus(filepath: str) -> DialogueCorpus:
+    key = os.path.abspath(filepath)
+    with corpora_lock:
+        if key not in corpora:
+            corpora[key] = DialogueCorpus(filepath)
+
+        return corpora[key]
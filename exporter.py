@@ -0,0 +1,168 @@
+import json
+import os
+import time
+from typing import Iterator
+import DB
+from retention import getArchivePath
+
+
+EXPORT_FORMATS = ["jsonl", "parquet"]
+
+
+class JsonlWriter:
+    def __init__(self, filepath: str, append: bool):
+        self.filepath = filepath
+        self.file = open(filepath, mode="a" if append else "w", encoding="utf-8")
+
+    def write(self, rows: list[dict]):
+        self.file.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+class ParquetWriter:
+    def __init__(self, filepath: str, append: bool):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("parquet export needs pyarrow, install it with 'pip install pyarrow'")
+
+        self.filepath = filepath
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema(
+            [
+                ("session_id", pyarrow.string()),
+                ("turn", pyarrow.int64()),
+                ("message_id", pyarrow.int64()),
+                ("speaker", pyarrow.string()),
+                ("content", pyarrow.string()),
+                ("phase", pyarrow.string()),
+            ]
+        )
+        self.writer = pyarrow.parquet.ParquetWriter(filepath, self.schema)
+
+    # every batch becomes one row group, so only one batch is in memory at a time
+    def write(self, rows: list[dict]):
+        self.writer.write_table(self.pyarrow.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def loadExportState(state_path: str) -> dict:
+    if not os.path.exists(state_path):
+        return {"last_id": 0}
+
+    with open(state_path, mode="r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def saveExportState(state_path: str, state: dict):
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, mode="w", encoding="utf-8") as file:
+        json.dump(state, file, indent=2)
+    os.replace(temp_path, state_path)
+
+
+# one row per message after last_id, PHASE rows included, with the phase each message belongs to
+# and its turn number counted from where its session was left off; the archived rows are read as well,
+# the retention job moves conversations there whether they were exported or not
+def iterateExportRows(last_id: int, batch_size: int, archive_path: str | None = None) -> Iterator[list[dict]]:
+    session_id = None
+    turn = 0
+    phase = None
+    for rows in DB.streamMessages(last_id, batch_size, archive_path):
+        batch = []
+        for message_id, row_session_id, speaker, content in rows:
+            if row_session_id != session_id:
+                session_id = row_session_id
+                turn, phase = (
+                    DB.getSessionPosition(session_id, last_id, archive_path) if last_id else (0, None)
+                )
+            turn += 1
+            if speaker == "PHASE":
+                phase = content
+            batch.append(
+                {
+                    "session_id": session_id,
+                    "turn": turn,
+                    "message_id": message_id,
+                    "speaker": speaker,
+                    "content": content,
+                    "phase": phase,
+                }
+            )
+        yield batch
+
+
+# stream the conversations into a JSONL or Parquet file, only the rows added since the last export unless full
+def exportConversations(
+    filepath: str,
+    export_format: str | None = None,
+    batch_size: int = 10000,
+    state_path: str | None = None,
+    full: bool = False,
+    archive_path: str | None = None,
+) -> dict:
+    if export_format is None:
+        export_format = "parquet" if filepath.endswith(".parquet") else "jsonl"
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"export format should be one of {EXPORT_FORMATS}.")
+
+    start_time = time.perf_counter()
+    state_path = state_path or f"{filepath}.state.json"
+    archive_path = archive_path or getArchivePath()
+    last_id = 0 if full else loadExportState(state_path)["last_id"]
+    # an incremental export never overwrites what was exported before
+    append = last_id > 0
+    part = last_id + 1
+    if last_id > DB.getLastMessageId():
+        # the id sequence survives deletes and archiving, so only a replaced database is behind the mark
+        print(f"history ids restarted below {last_id}, exporting every conversation of the new database")
+        last_id = 0
+        part = f"restart-{int(time.time())}"
+
+    output_path = filepath
+    if export_format == "parquet" and append and os.path.exists(filepath):
+        # parquet files can't be appended, the new rows go to a part file next to it
+        root, extension = os.path.splitext(filepath)
+        output_path = f"{root}-{part}{extension}"
+    writer = (JsonlWriter if export_format == "jsonl" else ParquetWriter)(output_path, append)
+
+    row_count = 0
+    session_count = 0
+    session_id = None
+    new_last_id = last_id
+    try:
+        for batch in iterateExportRows(last_id, batch_size, archive_path):
+            writer.write(batch)
+            row_count += len(batch)
+            # rows come session by session, so counting the changes is enough
+            for row in batch:
+                if row["session_id"] != session_id:
+                    session_id = row["session_id"]
+                    session_count += 1
+                new_last_id = max(new_last_id, row["message_id"])
+    finally:
+        writer.close()
+
+    if export_format == "parquet" and row_count == 0 and output_path != filepath:
+        os.remove(output_path)
+
+    # the mark only moves once the rows are on disk
+    saveExportState(
+        state_path,
+        {"last_id": new_last_id, "exported_at": time.time(), "last_output": output_path},
+    )
+
+    return {
+        "output": output_path,
+        "rows": row_count,
+        "sessions": session_count,
+        "last_id": new_last_id,
+        "seconds": round(time.perf_counter() - start_time, 3),
+    }
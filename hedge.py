@@ -0,0 +1,241 @@
+import asyncio
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, AsyncIterator, Awaitable, Callable
+from pydantic import BaseModel
+from langchain_core.messages import AIMessageChunk
+from langchain_core.prompts import PromptTemplate
+from llm import PROVIDERS, ModelChain
+from metrics import LLM_CALL_SECONDS, LLM_REQUESTS, LLM_HEDGE_WINS, LLM_FAILOVERS
+
+
+# recent durations of the successful calls of each call site and model
+class LatencyTracker:
+    def __init__(self, window: int = 500):
+        self.samples = {}  # : dict[tuple[str, ...], deque[float]]
+        self.window = window
+        self.lock = threading.Lock()
+
+    def observe(self, key: tuple[str, ...], seconds: float):
+        with self.lock:
+            self.samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def getPercentile(self, key: tuple[str, ...], ratio: float, min_samples: int) -> float | None:
+        with self.lock:
+            samples = sorted(self.samples.get(key, ()))
+        if len(samples) < min_samples:
+            return None
+
+        return samples[min(len(samples) - 1, int(ratio * len(samples)))]
+
+
+latencies = LatencyTracker()
+# calls, hedged, hedge_wins, failovers and errors of each call site
+hedge_stats = {}  # : dict[str, Counter[str]]
+hedge_stats_lock = threading.Lock()
+
+
+def countHedgeStat(site: str, name: str):
+    with hedge_stats_lock:
+        hedge_stats.setdefault(site, Counter())[name] += 1
+
+
+def getHedgeStats() -> dict[str, dict[str, Any]]:
+    with hedge_stats_lock:
+        stats = {site: dict(counts) for site, counts in hedge_stats.items()}
+
+    for counts in stats.values():
+        calls = counts.get("calls", 0)
+        hedged = counts.get("hedged", 0)
+        counts["hedge_rate"] = round(hedged / calls, 4) if calls else 0.0
+        # share of the hedged calls answered by the duplicate
+        counts["win_rate"] = round(counts.get("hedge_wins", 0) / hedged, 4) if hedged else None
+
+    return stats
+
+
+# the same chain on several models: the primary answers unless it is slower than the hedge delay,
+# then a duplicate goes to the next model and the first valid result wins, failed calls fail over
+class HedgedChain:
+    def __init__(self, chains: list[ModelChain], route: "ModelRoute"):
+        self.chains = chains
+        self.route = route
+        self.site = chains[0].site or ""
+        self.schema = chains[0].schema
+
+    def getLatencyKey(self, chain: ModelChain, kind: str) -> tuple[str, ...]:
+
+        return (self.site, kind, chain.provider, chain.model)
+
+    # a percentile of the primary's latency, a fixed delay until enough calls are measured
+    def getHedgeDelay(self, kind: str) -> float:
+        delay = latencies.getPercentile(
+            self.getLatencyKey(self.chains[0], kind),
+            self.route.hedge_percentile,
+            self.route.hedge_min_samples,
+        )
+
+        return self.route.hedge_delay if delay is None else delay
+
+    # discard frees the result of a call that finished but lost, e.g. closes its stream
+    async def race(
+        self,
+        call: Callable[[ModelChain], Awaitable[Any]],
+        kind: str,
+        discard: Callable[[Any], Awaitable[None]] | None = None,
+    ) -> Any:
+        tasks = {}  # : dict[asyncio.Task, int], index of the chain each running call went to
+        next_index = 0
+        hedged = False
+        last_error = None
+
+        async def timedCall(chain: ModelChain) -> Any:
+            start = time.perf_counter()
+            output = await call(chain)
+            seconds = time.perf_counter() - start
+            latencies.observe(self.getLatencyKey(chain, kind), seconds)
+            LLM_CALL_SECONDS.observe(
+                seconds, site=self.site, provider=chain.provider, model=chain.model
+            )
+
+            return output
+
+        def launch():
+            nonlocal next_index
+            tasks[asyncio.create_task(timedCall(self.chains[next_index]))] = next_index
+            next_index += 1
+
+        countHedgeStat(self.site, "calls")
+        deadline = time.perf_counter() + self.getHedgeDelay(kind)
+        launch()
+        try:
+            while tasks:
+                timeout = None
+                if self.route.hedge and not hedged and next_index < len(self.chains):
+                    timeout = max(0.0, deadline - time.perf_counter())
+                done, _ = await asyncio.wait(
+                    tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    hedged = True
+                    countHedgeStat(self.site, "hedged")
+                    launch()
+                    continue
+
+                for task in done:
+                    index = tasks.pop(task)
+                    chain = self.chains[index]
+                    try:
+                        output = task.result()
+                    except Exception as e:
+                        last_error = e
+                        print(f"{self.site} call to {chain.provider}:{chain.model} failed: {e}")
+                        LLM_FAILOVERS.inc(site=self.site, provider=chain.provider, model=chain.model)
+                        countHedgeStat(self.site, "failovers")
+                        continue
+
+                    LLM_REQUESTS.inc(site=self.site, hedged=str(hedged).lower())
+                    if hedged:
+                        winner = "primary" if index == 0 else "secondary"
+                        LLM_HEDGE_WINS.inc(site=self.site, winner=winner)
+                        if index != 0:
+                            countHedgeStat(self.site, "hedge_wins")
+                    return output
+
+                # every running call failed, the next model takes over right away
+                if not tasks and next_index < len(self.chains):
+                    launch()
+        finally:
+            # the losers are cancelled, their connections go back to the pools
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.wait(tasks)
+            # a loser may have finished in the same round as the winner, or before it could be cancelled
+            for task in tasks:
+                if discard is not None and not task.cancelled() and task.exception() is None:
+                    await discard(task.result())
+
+        countHedgeStat(self.site, "errors")
+        raise last_error
+
+    async def ainvoke(self, inputs: dict) -> Any:
+
+        async def call(chain: ModelChain) -> Any:
+            output = await chain.ainvoke(inputs)
+            # structured outputs that failed to parse come back empty from some providers
+            if output is None or (self.schema is not None and not isinstance(output, self.schema)):
+                raise ValueError(f"no valid {self.site} output")
+
+            return output
+
+        return await self.race(call, "invoke")
+
+    # a stream is raced until its first chunk, the winner then streams alone
+    async def astream(self, inputs: dict) -> AsyncIterator[AIMessageChunk]:
+
+        async def call(chain: ModelChain) -> tuple[AIMessageChunk, AsyncIterator]:
+            iterator = chain.astream(inputs)
+            try:
+                return await iterator.__anext__(), iterator
+            except StopAsyncIteration:
+                raise ValueError(f"empty {self.site} stream")
+            except BaseException:
+                await iterator.aclose()
+                raise
+
+        async def discard(result: tuple[AIMessageChunk, AsyncIterator]):
+            await result[1].aclose()
+
+        first_chunk, iterator = await self.race(call, "first_chunk", discard)
+        try:
+            yield first_chunk
+            async for chunk in iterator:
+                yield chunk
+        finally:
+            await iterator.aclose()
+
+
+# the models the chains of a bot are called on, the first one is the primary
+class ModelRoute:
+    def __init__(
+        self,
+        models: list[tuple[str, str]],
+        hedge: bool = True,
+        hedge_percentile: float = 0.95,
+        hedge_min_samples: int = 20,
+        hedge_delay: float = 3.0,
+    ):
+        if not models:
+            raise ValueError("at least one model should be given.")
+        for provider, _ in models:
+            if provider not in PROVIDERS:
+                raise ValueError(f"provider should be one of {list(PROVIDERS.keys())}.")
+        if not 0 < hedge_percentile < 1:
+            raise ValueError("hedge percentile should be between 0 and 1.")
+        self.models = list(models)
+        # hedge: False only fails over, a secondary is then called after the primary fails
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_delay = hedge_delay  # : float, seconds, until the primary has hedge_min_samples calls
+
+    def makeChain(
+        self,
+        prompt: PromptTemplate,
+        temperature: float = 1,
+        schema: type[BaseModel] | None = None,
+        site: str | None = None,
+    ) -> ModelChain | HedgedChain:
+        chains = [
+            ModelChain(prompt, provider, model, temperature=temperature, schema=schema, site=site)
+            for provider, model in self.models
+        ]
+        if len(chains) == 1:
+            return chains[0]
+
+        return HedgedChain(chains, self)
+
+
+DEFAULT_MODEL_ROUTE = ModelRoute([("openai", "gpt-4o")])
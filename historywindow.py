@@ -0,0 +1,166 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from langchain_core.prompts import PromptTemplate
+from llm import ModelChain
+from ratelimit import estimateTextTokens
+
+
+SUMMARY_PROMPT = PromptTemplate.from_template(
+    """
+    [Task]
+    You are summarizing one finished phase of a conversation between a chatbot (AI) and a USER.
+    Summarize what the USER shared (emotions, situations, thoughts, desires, scores) and how the phase ended in 2-4 sentences.
+    Keep names, numbers and the USER's own key expressions. The summary MUST be in KOREAN.
+
+    [Context]
+    - phase name: {phase_name}
+    - phase conversation:
+    {phase_conversation}
+    """
+)
+
+# a phase marker is rendered as an empty line followed by "[phase name]"
+PHASE_MARKER = re.compile(r"(?:^|\n)\n\[([^\]\n]*)\](?=\n|$)")
+TURN_START = re.compile(r"\n(?=(?:USER|AI|SUMMARY): )")
+
+MAX_CACHED_SUMMARIES = 4096
+MAX_CACHED_COUNTS = 65536
+
+summary_chain = None  # : ModelChain
+encoding = None  # : tiktoken.Encoding
+encoding_failed = False
+summaries = OrderedDict()  # : OrderedDict[str, str]
+token_counts = OrderedDict()  # : OrderedDict[str, int]
+cache_lock = threading.Lock()
+
+
+def countTokens(text: str) -> int:
+    global encoding, encoding_failed
+
+    with cache_lock:
+        if text in token_counts:
+            token_counts.move_to_end(text)
+            return token_counts[text]
+
+    if encoding is None and not encoding_failed:
+        try:
+            import tiktoken
+
+            encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # the encoding file can't be fetched offline, so fall back to an estimate
+            encoding_failed = True
+
+    if encoding is not None:
+        count = len(encoding.encode(text))
+    else:
+        count = estimateTextTokens(text)
+
+    with cache_lock:
+        token_counts[text] = count
+        if len(token_counts) > MAX_CACHED_COUNTS:
+            token_counts.popitem(last=False)
+
+    return count
+
+
+# split a rendered history into (phase name, turns) segments
+def splitHistory(conversation_history: str) -> list[tuple[str | None, list[str]]]:
+    segments = []
+    position = 0
+    phase_name = None
+    for marker in PHASE_MARKER.finditer(conversation_history):
+        segments.append((phase_name, conversation_history[position : marker.start()]))
+        phase_name = marker.group(1)
+        position = marker.end()
+    segments.append((phase_name, conversation_history[position:]))
+
+    return [
+        (name, [turn for turn in TURN_START.split(text.strip("\n")) if turn])
+        for name, text in segments
+        if name is not None or text.strip("\n")
+    ]
+
+
+def renderSegment(phase_name: str | None, turns: list[str]) -> str:
+    lines = [] if phase_name is None else [f"\n[{phase_name}]"]
+
+    return "\n".join(lines + turns)
+
+
+async def summarizeSegment(phase_name: str | None, turns: list[str]) -> str:
+    text = "\n".join(turns)
+    key = hashlib.sha256(f"{phase_name}\n{text}".encode("utf-8")).hexdigest()
+
+    with cache_lock:
+        if key in summaries:
+            summaries.move_to_end(key)
+            return summaries[key]
+
+    global summary_chain
+    if summary_chain is None:
+        summary_chain = ModelChain(
+            SUMMARY_PROMPT, "openai", "gpt-4o-mini", temperature=0, site="summary"
+        )
+    response = await summary_chain.ainvoke(
+        {"phase_name": phase_name or "", "phase_conversation": text}
+    )
+    summary = f"SUMMARY: {response.content.strip()}"
+
+    with cache_lock:
+        summaries[key] = summary
+        if len(summaries) > MAX_CACHED_SUMMARIES:
+            summaries.popitem(last=False)
+
+    return summary
+
+
+class HistoryWindow:
+    def __init__(self, max_tokens: int, recent_turns: int = 6, summarize: bool = True):
+        self.max_tokens = max_tokens
+        self.recent_turns = recent_turns
+        self.summarize = summarize
+
+    # fit the history into max_tokens: recent turns stay verbatim, older phases become summaries
+    async def apply(self, conversation_history: str) -> str:
+        segments = splitHistory(conversation_history)
+        turn_counts = [[countTokens(turn) for turn in turns] for _, turns in segments]
+        if sum(map(sum, turn_counts)) <= self.max_tokens:
+            return conversation_history
+
+        # the current phase keeps its latest turns, at least recent_turns of them
+        phase_name, turns = segments[-1]
+        counts = turn_counts[-1]
+        budget = self.max_tokens
+        kept = 0
+        while kept < len(turns):
+            count = counts[-1 - kept]
+            if kept >= self.recent_turns and count > budget:
+                break
+            budget -= count
+            kept += 1
+        window = [renderSegment(phase_name, turns[len(turns) - kept :])]
+
+        # earlier phases stay verbatim while they fit, then they are summarized, and dropped when nothing fits
+        summarizing = False
+        for (phase_name, turns), counts in zip(
+            reversed(segments[:-1]), reversed(turn_counts[:-1])
+        ):
+            if budget <= 0:
+                break
+            if not summarizing and sum(counts) <= budget:
+                window.append(renderSegment(phase_name, turns))
+                budget -= sum(counts)
+            elif self.summarize and turns:
+                summarizing = True
+                summary = await summarizeSegment(phase_name, turns)
+                if countTokens(summary) > budget:
+                    break
+                window.append(renderSegment(phase_name, [summary]))
+                budget -= countTokens(summary)
+            else:
+                break
+
+        return "\n".join(reversed(window))
@@ -0,0 +1,148 @@
+import importlib
+import json
+import threading
+from contextlib import aclosing
+from typing import Any, AsyncIterator
+from pydantic import BaseModel
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.prompts import PromptTemplate
+from cache import LLMCache, getCache
+from backend import getBackend
+
+
+# provider name -> (module, chat model class), each integration takes about a second to import,
+# so it is only imported when a chain of the provider makes its first live call
+PROVIDERS = {
+    "openai": ("langchain_openai", "ChatOpenAI"),
+    "google": ("langchain_google_genai", "ChatGoogleGenerativeAI"),
+    "anthropic": ("langchain_anthropic", "ChatAnthropic"),
+}
+
+provider_classes = {}  # : dict[str, type[BaseChatModel]]
+# chat model clients keep their HTTP connection pools, so they are shared across turns
+clients = {}  # : dict[tuple[str, str, float], BaseChatModel]
+clients_lock = threading.Lock()
+
+
+def registerProvider(provider: str, module_name: str, class_name: str):
+    PROVIDERS[provider] = (module_name, class_name)
+    provider_classes.pop(provider, None)
+
+
+def getProviderClass(provider: str) -> type[BaseChatModel]:
+    if provider not in PROVIDERS:
+        raise ValueError(f"provider should be one of {list(PROVIDERS.keys())}.")
+
+    if provider not in provider_classes:
+        module_name, class_name = PROVIDERS[provider]
+        provider_classes[provider] = getattr(importlib.import_module(module_name), class_name)
+
+    return provider_classes[provider]
+
+
+def getChatModel(provider: str, model: str, temperature: float = 1) -> BaseChatModel:
+    key = (provider, model, temperature)
+    with clients_lock:
+        if key not in clients:
+            # retries are left to the rate limiter, which backs off for every call to the model
+            clients[key] = getProviderClass(provider)(
+                model=model, temperature=temperature, max_retries=0
+            )
+
+        return clients[key]
+
+
+class ModelChain:
+    def __init__(
+        self,
+        prompt: PromptTemplate,
+        provider: str,
+        model: str,
+        temperature: float = 1,
+        schema: type[BaseModel] | None = None,
+        site: str | None = None,
+    ):
+        if provider not in PROVIDERS:
+            raise ValueError(f"provider should be one of {list(PROVIDERS.keys())}.")
+        self.prompt = prompt
+        self.provider = provider
+        self.model = model
+        self.temperature = temperature
+        self.schema = schema
+        # call site name, used to switch caching on and to label recordings
+        self.site = site
+        self.llm = None  # : Runnable, created on the first live call
+        # structured outputs are only reused for the same response format
+        self.schema_id = (
+            ""
+            if schema is None
+            else json.dumps(schema.model_json_schema(), sort_keys=True, ensure_ascii=False)
+        )
+
+    def getLLM(self):
+        if self.llm is None:
+            llm = getChatModel(self.provider, self.model, self.temperature)
+            self.llm = llm if self.schema is None else llm.with_structured_output(self.schema)
+
+        return self.llm
+
+    def getCacheKey(self, rendered_prompt: str) -> str:
+
+        return LLMCache.makeKey(
+            f"{self.provider}:{self.model}",
+            {"temperature": self.temperature},
+            rendered_prompt,
+            self.schema_id,
+        )
+
+    def dumpOutput(self, output: Any) -> str:
+        if self.schema is None:
+            return output.content
+
+        return output.model_dump_json()
+
+    def loadOutput(self, value: str) -> Any:
+        if self.schema is None:
+            return AIMessage(content=value)
+
+        return self.schema.model_validate_json(value)
+
+    async def ainvoke(self, inputs: dict) -> Any:
+        rendered_prompt = self.prompt.format(**inputs)
+        cache = getCache(self.site)
+        if cache is None:
+            return await getBackend().invoke(self, rendered_prompt)
+
+        key = self.getCacheKey(rendered_prompt)
+        value = cache.get(key)
+        if value is not None:
+            return self.loadOutput(value)
+
+        output = await getBackend().invoke(self, rendered_prompt)
+        cache.put(key, self.dumpOutput(output))
+
+        return output
+
+    async def astream(self, inputs: dict) -> AsyncIterator[AIMessageChunk]:
+        rendered_prompt = self.prompt.format(**inputs)
+        cache = getCache(self.site)
+        if cache is None:
+            async with aclosing(getBackend().stream(self, rendered_prompt)) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+            return
+
+        # a cached response comes out as one chunk, a new one is cached once it is complete
+        key = self.getCacheKey(rendered_prompt)
+        value = cache.get(key)
+        if value is not None:
+            yield AIMessageChunk(content=value)
+            return
+
+        contents = []
+        async with aclosing(getBackend().stream(self, rendered_prompt)) as chunks:
+            async for chunk in chunks:
+                contents.append(chunk.content)
+                yield chunk
+        cache.put(key, "".join(contents))
@@ -1,155 +1,38 @@
+from __future__ import annotations
 import argparse
 from dotenv import load_dotenv
-from pydantic import BaseModel, ValidationError
-import yaml
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
-import uvicorn
+from pydantic import ValidationError
+from typing import TYPE_CHECKING
 import asyncio
 import csv
 import os
-
-from phasemanager import PhaseManager
-from phase import Phase
-from DB import initialize, addMessage, getHistory, reset, saveConversation
-from chatbot import executeChatbot
-from simulator import agentResponse, autoEvaluation
-
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # Initialize DB
-    initialize()
-
-    # reset DB
-    reset()
-
-    yield
-
-
-# Set FastAPI app
-app = FastAPI(lifespan=lifespan)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:5173"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+import time
+
+from DB import (
+    initialize,
+    addMessage,
+    getHistory,
+    reset,
+    saveConversation,
+    startWriter,
+    stopWriter,
 )
+from cache import CACHE_SITES, configureCache, getCacheStats
+from backend import BACKEND_MODES, configureBackend
+from exporter import EXPORT_FORMATS, exportConversations
+from retention import loadRetentionPolicy
+from ratelimit import setPriority
 
-
-class routerData(BaseModel):
-    criteria: str
-    next_phase: str
-
-
-class phaseData(BaseModel):
-    name: str
-    goal: str
-    action_list: list[str]
-    instruction: str
-    router_list: list[routerData]
-
-
-class actionData(BaseModel):
-    action_name: str
-    action_explanation: str
-
-
-class chatbotSettingData(BaseModel):
-    bot_name: str
-    bot_desc: str
-    start_phase: str
-    finish_phases: list[str]
-    phases: list[phaseData]
-    actions: list[actionData]
-
-
-class userInputData(BaseModel):
-    input: str
-
-
-# =================================================================================================================================================
-# API Server Code
-# =================================================================================================================================================
-
-# save chatbot setting
-@app.post("/save-settings")
-def saveSetting(data: chatbotSettingData):
-    phase_manager = PhaseManager(data.bot_name, data.bot_desc)
-    app.state.phase_manager = phase_manager
-    try:
-        for phase in data.phases:
-            print(f"{phase.name} adding...")
-            dict_router_list = [router.model_dump() for router in phase.router_list]
-            new_phase = Phase(
-                phase.name,
-                phase.goal,
-                phase.action_list,
-                phase.instruction,
-                dict_router_list,
-            )
-            phase_manager.addNewPhase(new_phase)
-
-        phase_manager.addNewPhase(Phase("FINISH", "", [], "", []))
-        phase_manager.setStartPhase(data.start_phase)
-        phase_manager.setCurrPhase(data.start_phase)
-        print(f"current phase: {data.start_phase}")
-        # reset DB for new chatbot
-        reset()
-        addMessage("PHASE", data.start_phase)
-
-        action_dict = {}
-        for action in data.actions:
-            action_dict[action.action_name] = action.action_explanation
-        print(phase_manager.updateTopics(action_dict))
-
-        return {
-            "status": "success",
-            "result": f"Chatbot named {data.bot_name} set completely.",
-        }
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-
-# execute one conversation with the user input
-@app.post("/execute")
-async def execute(user_input: userInputData):
-    phase_manager = app.state.phase_manager
-    if phase_manager == None:
-        raise HTTPException(status_code=400, detail="No Chatbot Saved.")
-    input = user_input.input
-    addMessage("USER", input)
-    conversation_history = getHistory()
-    try:
-        response, changed = await executeChatbot(phase_manager, conversation_history)
-        addMessage("AI", response)
-        if changed:
-            addMessage("PHASE", phase_manager.getCurrPhase().getName())
-        if phase_manager.getCurrPhase().getName() == "FINISH":
-            finished = True
-        else:
-            finished = False
-        return {"status": "success", "message": response, "finished": finished}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-
-# reset the conversation
-@app.post("/reset-DB")
-def resetDB():
-    try:
-        reset()
-        start_phase_name = app.state.phase_manager.getStartPhase().getName()
-        app.state.phase_manager.setCurrPhase(start_phase_name)
-        addMessage("PHASE", start_phase_name)
-        return {"status": "success", "result": "All chatbot setting initialized."}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+# the chatbot, the simulator and the server are imported by the modes that use them
+if TYPE_CHECKING:
+    from phasemanager import PhaseManager
+    from setting import chatbotSettingData
 
 
 def main():
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
+    import uvicorn
+
+    uvicorn.run("server:app", host="127.0.0.1", port=8000, reload=True)
 
     return
 
@@ -161,11 +44,11 @@ def main():
 
 # get setting data from yaml file
 def getTestSettingData() -> chatbotSettingData:
-    try:
-        with open("./LLM-Cumpa Specification.yaml", "r", encoding="utf-8") as file:
-            yaml_data = yaml.safe_load(file)
+    from setting import registry
 
-        data = chatbotSettingData.model_validate(yaml_data)
+    try:
+        # the validated json copy is read instead while the yaml file is unchanged
+        data, _ = registry.loadSpecFile("./LLM-Cumpa Specification.yaml")
 
     except FileNotFoundError:
         print("file not found")
@@ -178,107 +61,125 @@ def getTestSettingData() -> chatbotSettingData:
 
 # save chatbot setting for test
 def saveTestSetting(data: chatbotSettingData) -> PhaseManager:
-    phase_manager = PhaseManager(data.bot_name, data.bot_desc)
-
-    for phase in data.phases:
-        # print(f"{phase.name} adding...")
-        dict_router_list = [router.model_dump() for router in phase.router_list]
-        new_phase = Phase(
-            phase.name,
-            phase.goal,
-            phase.action_list,
-            phase.instruction,
-            dict_router_list,
-        )
-        phase_manager.addNewPhase(new_phase)
+    from phasemanager import PhaseManager
+    from setting import compileSetting
 
-    phase_manager.addNewPhase(Phase("FINISH", "", [], "", []))
-    phase_manager.setStartPhase(data.start_phase)
-    phase_manager.setCurrPhase(data.start_phase)
-    # print(f"current phase: {data.start_phase}")
+    graph = compileSetting(data)
     # reset DB for new chatbot
     reset()
     addMessage("PHASE", data.start_phase)
 
-    action_dict = {}
-    for action in data.actions:
-        action_dict[action.action_name] = action.action_explanation
-    # print(phase_manager.updateTopics(action_dict))
-    phase_manager.updateTopics(action_dict)
-
-    return phase_manager
-
-
-# automated testing with user agent
-async def autoTest(phase_manager: PhaseManager):
-    for index in range(1, 51):
-        while True:
-            # make chatbot response
-            response, changed = await executeChatbot(phase_manager, getHistory())
-            
-            # finish the dialogue if the next phase is FINISH
-            if phase_manager.getCurrPhase().getName() == "FINISH":
-                # print("AI: " + response)
-                addMessage("AI", response)
-                break
-            
-            # if there is no phase change, use generated output
-            if not changed:
-                # print("AI: " + response)
-                addMessage("AI", response)
-            
-            # if there is phase change, add phase change info to DB and regenerate output with new phase
-            else:
-                new_phase = phase_manager.getCurrPhase().getName()
-                addMessage("PHASE", new_phase)
-                print(f"conversation #{index} changed to {new_phase} phase")
-                continue
+    return PhaseManager(graph)
 
-            # user input from "user simulator"
-            user_input = await agentResponse(index, getHistory())
-            # print(f"User: {user_input}")
-            addMessage("USER", user_input)
 
-            # conversation finishing signal from user
-            if user_input in ("<COMPLETE_CONVERSATION>", "quit"):
-                break
+# one simulated dialogue, with its own phase cursor and its own session history
+async def autoTestDialogue(phase_manager: PhaseManager, index: int) -> str:
+    from chatbot import executeChatbot
+    from simulator import agentResponse
+
+    session = phase_manager.createSession()
+    session_id = f"autotest-{index}"
+    reset(session_id)
+    addMessage("PHASE", session.getStartPhase().getName(), session_id)
+
+    while True:
+        # make chatbot response, already generated by the new phase if the phase changes
+        response, changed = await executeChatbot(
+            session, getHistory(session_id), mode="routed"
+        )
+        new_phase = session.getCurrPhase().getName()
+
+        # finish the dialogue if the next phase is FINISH
+        if session.isFinished():
+            # print("AI: " + response)
+            addMessage("AI", response, session_id)
+            addMessage("PHASE", new_phase, session_id)
+            break
 
-        # save finished dialogue into csv file
-        saveConversation(index, "./llm dialogues.csv")
-        print(f"conversation #{index} saved...")
+        # if there is phase change, add phase change info to DB before the response of the new phase
+        if changed:
+            addMessage("PHASE", new_phase, session_id)
+            print(f"conversation #{index} changed to {new_phase} phase")
 
-        # set current phase to start phase
-        start_phase = phase_manager.getStartPhase().getName()
-        phase_manager.setCurrPhase(start_phase)
+        # print("AI: " + response)
+        addMessage("AI", response, session_id)
 
-        # reset DB for new chatbot
-        reset()
-        addMessage("PHASE", start_phase)
+        # user input from "user simulator"
+        user_input = await agentResponse(index, getHistory(session_id))
+        # print(f"User: {user_input}")
+        addMessage("USER", user_input, session_id)
 
-    return
+        # conversation finishing signal from user
+        if user_input in ("<COMPLETE_CONVERSATION>", "quit"):
+            break
+
+    return session_id
+
+
+# automated testing with user agent, running up to "concurrency" dialogues at once
+async def autoTest(phase_manager: PhaseManager, concurrency: int = 1):
+    # simulated dialogues give way to the server's interactive calls on the shared rate limits
+    setPriority("batch")
+    indices = list(range(1, 51))
+    semaphore = asyncio.Semaphore(concurrency)
+    finished = {}  # : dict[int, str | None], None for a failed dialogue
+    failures = {}  # : dict[int, Exception]
+    next_position = 0
+
+    # a failed dialogue is reported and skipped, the others go on and are saved
+    async def runDialogue(index: int):
+        nonlocal next_position
+        async with semaphore:
+            try:
+                finished[index] = await autoTestDialogue(phase_manager, index)
+            except Exception as e:
+                failures[index] = e
+                finished[index] = None
+                print(f"conversation #{index} failed: {e}")
+
+        # save finished dialogues into csv file in index order
+        while next_position < len(indices) and indices[next_position] in finished:
+            save_index = indices[next_position]
+            session_id = finished.pop(save_index)
+            next_position += 1
+            if session_id is None:
+                continue
+            # the session stays in the DB with its phases for --export, until the next test run
+            saveConversation(save_index, "./llm dialogues.csv", session_id)
+            print(f"conversation #{save_index} saved...")
+
+    async with asyncio.TaskGroup() as task_group:
+        for index in indices:
+            task_group.create_task(runDialogue(index))
+
+    if failures:
+        print(f"{len(failures)} conversations failed, not saved: {sorted(failures)}")
 
 
 # test with human input
 async def manualTest(phase_manager: PhaseManager):
+    from chatbot import executeChatbot
+
     while True:
-        # make chatbot response
-        response, changed = await executeChatbot(phase_manager, getHistory())
-        
+        # make chatbot response, already generated by the new phase if the phase changes
+        response, changed = await executeChatbot(
+            phase_manager, getHistory(), mode="routed"
+        )
+        new_phase = phase_manager.getCurrPhase().getName()
+
         # finish the dialogue if the next phase is FINISH
-        if phase_manager.getCurrPhase().getName() == "FINISH":
+        if phase_manager.isFinished():
             print("AI: " + response)
             addMessage("AI", response)
+            addMessage("PHASE", new_phase)
             break
-        
-        # if there is no phase change, use generated output
-        if not changed:
-            print("AI: " + response)
-            addMessage("AI", response)
-        
-        # if there is phase change, add phase change info to DB and regenerate output with new phase
-        else:
-            addMessage("PHASE", phase_manager.getCurrPhase().getName())
-            continue
+
+        # if there is phase change, add phase change info to DB before the response of the new phase
+        if changed:
+            addMessage("PHASE", new_phase)
+
+        print("AI: " + response)
+        addMessage("AI", response)
 
         # user input from the human
         user_input = input("USER: ")
@@ -288,42 +189,88 @@ async def manualTest(phase_manager: PhaseManager):
             addMessage("USER", user_input)
 
 
-# dialogue evaluation
-def eval():
-    for index in range(1, 51):
-        eval_result = autoEvaluation(index)
-
-        file_exists = os.path.exists("./evaluation results.csv")
-
-        with open(
-            "./evaluation results.csv", mode="a", newline="", encoding="utf-8"
-        ) as csv_file:
-            writer = csv.writer(csv_file)
-            if not file_exists:
-                writer.writerow(
-                    [
-                        "index",
-                        "intent score",
-                        "LLM score",
-                        "intent score reason",
-                        "LLM score reason",
-                    ]
-                )
+# dialogue evaluation, judging up to "concurrency" dialogue pairs at once, the rows are tagged with
+# the run name (e.g. the prompt variant) for analysis.py, a timestamp by default
+async def eval(concurrency: int = 1, run: str | None = None):
+    from simulator import autoEvaluation, getEvaluationIndices
+
+    run = run or time.strftime("%Y%m%d-%H%M%S")
+    setPriority("batch")
+    indices = getEvaluationIndices()
+    semaphore = asyncio.Semaphore(concurrency)
+    results = {}  # : dict[int, EvalOutput]
+    failures = {}  # : dict[int, Exception]
+    start_time = time.perf_counter()
+
+    # a failed judgment is reported, the others go on and are saved
+    async def evaluate(index: int):
+        async with semaphore:
+            try:
+                results[index] = await autoEvaluation(index)
+            except Exception as e:
+                failures[index] = e
+                print(f"evaluation {index} failed: {e}")
+                return
+
+        elapsed = time.perf_counter() - start_time
+        print(
+            f"evaluation {index} clear... "
+            f"({len(results)}/{len(indices)}, {len(results) / elapsed:.2f} evaluations/s)"
+        )
+
+    async with asyncio.TaskGroup() as task_group:
+        for index in indices:
+            task_group.create_task(evaluate(index))
+    indices = [index for index in indices if index in results]
+
+    # write every result at once, in index order
+    file_exists = os.path.exists("./evaluation results.csv")
+    # files started before the run column keep their columns, analysis.py tells their runs apart by the indices
+    with_run = True
+    if file_exists:
+        with open("./evaluation results.csv", mode="r", newline="", encoding="utf-8") as csv_file:
+            with_run = "run" in next(csv.reader(csv_file), [])
+
+    with open(
+        "./evaluation results.csv", mode="a", newline="", encoding="utf-8"
+    ) as csv_file:
+        writer = csv.writer(csv_file)
+        if not file_exists:
             writer.writerow(
                 [
-                    index,
-                    eval_result.score1,
-                    eval_result.score2,
-                    eval_result.reason1,
-                    eval_result.reason2,
+                    "index",
+                    "intent score",
+                    "LLM score",
+                    "intent score reason",
+                    "LLM score reason",
+                    "run",
                 ]
             )
+        writer.writerows(
+            [
+                index,
+                results[index].score1,
+                results[index].score2,
+                results[index].reason1,
+                results[index].reason2,
+            ]
+            + ([run] if with_run else [])
+            for index in indices
+        )
 
-        print(f"evaluation {index} clear...")
+    elapsed = time.perf_counter() - start_time
+    print(
+        f"{len(indices)} evaluations of run {run} saved in {elapsed:.1f}s "
+        f"({len(indices) / elapsed:.2f} evaluations/s)"
+    )
+    if failures:
+        print(f"{len(failures)} evaluations failed, not saved: {sorted(failures)}")
 
 
 # emotion recognition test
 async def emoRecogTest(phase_manager: PhaseManager):
+    from chatbot import executeChatbot
+
     while True:
         # make chatbot response
         response, changed = await executeChatbot(phase_manager, getHistory())
@@ -362,35 +309,137 @@ if __name__ == "__main__":
 
     # Check for test option
     parser = argparse.ArgumentParser()
-    parser.add_argument("--autotest", action="store_true", help="for auto test")
+    parser.add_argument(
+        "--autotest",
+        nargs="?",
+        type=int,
+        const=1,
+        metavar="CONCURRENCY",
+        help="for auto test, optionally running CONCURRENCY dialogues at once",
+    )
     parser.add_argument("--mantest", action="store_true", help="for manual test")
-    parser.add_argument("--eval", action="store_true", help="for evaluation")
+    parser.add_argument(
+        "--eval",
+        nargs="?",
+        type=int,
+        const=1,
+        metavar="CONCURRENCY",
+        help="for evaluation, optionally judging CONCURRENCY dialogue pairs at once",
+    )
+    parser.add_argument(
+        "--eval-run", metavar="NAME", help="run name of the evaluation results, e.g. the prompt variant (a timestamp if omitted)"
+    )
     parser.add_argument("--recog", action="store_true", help="for recognition test")
+    parser.add_argument(
+        "--backend",
+        choices=BACKEND_MODES,
+        help="LLM backend: live, record (save responses to the cassette), replay (serve them back) or fake",
+    )
+    parser.add_argument("--cassette", help="cassette file for the record and replay backends")
+    parser.add_argument(
+        "--cache",
+        metavar="SITES",
+        help=f"comma separated LLM call sites to cache, among {CACHE_SITES}",
+    )
+    parser.add_argument(
+        "--cache-path", help="SQLite file for the on-disk LLM cache (memory only if omitted)"
+    )
+    parser.add_argument(
+        "--cache-ttl", type=float, help="seconds before a cached LLM response expires"
+    )
+    parser.add_argument(
+        "--export",
+        metavar="FILE",
+        help="export the conversations with their phases to a JSONL or Parquet file (after the test run, if any)",
+    )
+    parser.add_argument(
+        "--export-format", choices=EXPORT_FORMATS, help="export format, by the file extension if omitted"
+    )
+    parser.add_argument(
+        "--export-full",
+        action="store_true",
+        help="export every conversation, not only the ones added since the last export",
+    )
+    parser.add_argument(
+        "--retention",
+        action="store_true",
+        help="archive finished and idle conversations, prune and compact the databases (after the export, if any)",
+    )
     args = parser.parse_args()
     ATEST, MTEST, EVAL, RECOG = False, False, False, False
-    if args.autotest:
+    if args.autotest is not None:
+        if args.autotest < 1:
+            parser.error("--autotest concurrency should be at least 1")
         ATEST = True
     elif args.mantest:
         MTEST = True
-    elif args.eval:
+    elif args.eval is not None:
+        if args.eval < 1:
+            parser.error("--eval concurrency should be at least 1")
         EVAL = True
     elif args.recog:
         RECOG = True
 
+    # Initialize DB (creates or migrates the history table)
+    initialize()
+
+    # select the LLM backend (CUMPA_LLM_BACKEND and CUMPA_LLM_CASSETTE work as well)
+    if args.backend:
+        configureBackend(args.backend, args.cassette)
+    elif args.cassette:
+        configureBackend(os.getenv("CUMPA_LLM_BACKEND", "live"), args.cassette)
+
+    # enable LLM response caching (CUMPA_LLM_CACHE* environment variables work as well)
+    if args.cache:
+        configureCache(
+            [site.strip() for site in args.cache.split(",") if site.strip()],
+            path=args.cache_path,
+            ttl=args.cache_ttl,
+        )
+
     # execute main function
     if ATEST:
         data = getTestSettingData()
         phase_manager = saveTestSetting(data)
-        asyncio.run(autoTest(phase_manager))
+        # concurrent dialogues queue their messages instead of committing each one on the event loop
+        startWriter()
+        try:
+            asyncio.run(autoTest(phase_manager, args.autotest))
+        finally:
+            stopWriter()
+        if phase_manager.getRouter() is not None:
+            print(f"local router: {phase_manager.getRouter().getStats()}")
     elif MTEST:
         data = getTestSettingData()
         phase_manager = saveTestSetting(data)
         asyncio.run(manualTest(phase_manager))
     elif EVAL:
-        eval()
+        asyncio.run(eval(args.eval, args.eval_run))
     elif RECOG:
         data = getTestSettingData()
         phase_manager = saveTestSetting(data)
         asyncio.run(emoRecogTest(phase_manager))
-    else:
+    elif not args.export and not args.retention:
         main()
+
+    if args.export:
+        summary = exportConversations(args.export, args.export_format, full=args.export_full)
+        print(
+            f"{summary['rows']} messages of {summary['sessions']} conversations exported to "
+            f"{summary['output']} in {summary['seconds']}s"
+        )
+
+    # one pass of the server's background retention job (CUMPA_ARCHIVE_* and CUMPA_MAX_* variables)
+    if args.retention:
+        retention_policy = loadRetentionPolicy()
+        # the one-time conversion of an older DB file locks it throughout, so only this run does it
+        summary, _ = retention_policy.run(convert=True)
+        print(
+            f"{summary['archived_rows']} messages of {summary['archived_sessions']} conversations archived to "
+            f"{retention_policy.archive_path}, {summary['pruned_rows']} pruned, {summary['freed_pages']} pages freed "
+            f"in {summary['seconds']}s"
+        )
+
+    # hit and miss counters of each cached call site
+    for site, stats in getCacheStats().items():
+        print(f"LLM cache [{site}]: {stats}")
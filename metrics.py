@@ -0,0 +1,245 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+# seconds, from a SQLite write up to a slow LLM generation
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def formatLabels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+
+    return "{" + ",".join(pairs) + "}"
+
+
+def formatValue(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.values = {}  # : dict[tuple[str, ...], ...], keyed by label values
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def getKey(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"labels of {self.name} should be {list(self.labelnames)}.")
+
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines += self.renderValue(dict(zip(self.labelnames, key)), value)
+
+        return lines
+
+    def renderValue(self, labels: dict[str, str], value) -> list[str]:
+
+        return [f"{self.name}{formatLabels(labels)} {formatValue(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.getKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self.getKey(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.getKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self.getKey(labels)
+        with self.lock:
+            # [count per bucket (non-cumulative, last one is +Inf), sum, count]
+            state = self.values.get(key)
+            if state is None:
+                state = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.values[key] = state
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def renderValue(self, labels: dict[str, str], value) -> list[str]:
+        bucket_counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+            cumulative += bucket_count
+            bucket_labels = formatLabels({**labels, "le": formatValue(float(bound))})
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{self.name}_sum{formatLabels(labels)} {formatValue(total)}")
+        lines.append(f"{self.name}_count{formatLabels(labels)} {count}")
+
+        return lines
+
+
+registry = []  # : list[Metric]
+
+
+# time the enclosed block into a histogram, e.g. with timeSpan(TURN_STAGE_SECONDS, stage="select")
+@contextmanager
+def timeSpan(histogram: Histogram, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+# every metric in the Prometheus text exposition format
+def renderMetrics() -> str:
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+
+    return "\n".join(lines) + "\n"
+
+
+TURN_SECONDS = Histogram(
+    "cumpa_turn_seconds", "Duration of a whole chatbot turn.", ("mode", "turn_mode")
+)
+TURN_STAGE_SECONDS = Histogram(
+    "cumpa_turn_stage_seconds",
+    "Duration of each stage of the chatbot turn pipeline.",
+    ("stage",),
+)
+DB_SECONDS = Histogram(
+    "cumpa_db_seconds", "Duration of conversation store operations.", ("operation",)
+)
+REQUEST_SECONDS = Histogram(
+    "cumpa_http_request_seconds",
+    "Duration of HTTP requests until the response starts.",
+    ("path", "method", "status"),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "cumpa_http_requests_in_flight", "HTTP requests being handled.", ("path",)
+)
+PHASE_TRANSITIONS = Counter(
+    "cumpa_phase_transitions_total", "Phase changes of conversations.", ("source", "target")
+)
+ROUTER_DECISIONS = Counter(
+    "cumpa_router_decisions_total",
+    "Selector turns decided by a local router rule, the local model or the LLM.",
+    ("source",),
+)
+ROUTER_AGREEMENT = Counter(
+    "cumpa_router_agreement_total",
+    "Local router decisions compared with the selector LLM in shadow mode.",
+    ("result",),
+)
+LLM_CALL_SECONDS = Histogram(
+    "cumpa_llm_call_seconds",
+    "Duration of successful LLM calls of hedged chains, up to the first chunk for streams.",
+    ("site", "provider", "model"),
+)
+LLM_REQUESTS = Counter(
+    "cumpa_llm_requests_total",
+    "Answered calls of hedged chains, and whether a duplicate was sent to a secondary model.",
+    ("site", "hedged"),
+)
+LLM_HEDGE_WINS = Counter(
+    "cumpa_llm_hedge_wins_total",
+    "Hedged calls by the model that answered first.",
+    ("site", "winner"),
+)
+LLM_FAILOVERS = Counter(
+    "cumpa_llm_failovers_total",
+    "Failed or invalid LLM calls of hedged chains, left to another model.",
+    ("site", "provider", "model"),
+)
+LLM_QUEUE_SECONDS = Histogram(
+    "cumpa_llm_queue_seconds",
+    "Time LLM calls waited for the rate limiter, by priority.",
+    ("provider", "model", "priority"),
+)
+LLM_CONCURRENCY_LIMIT = Gauge(
+    "cumpa_llm_concurrency_limit",
+    "Adaptive limit of concurrent calls to each provider model.",
+    ("provider", "model"),
+)
+LLM_THROTTLED = Counter(
+    "cumpa_llm_throttled_total",
+    "LLM calls rejected by the provider as rate limited or overloaded.",
+    ("provider", "model", "reason"),
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "cumpa_admission_queue_depth", "Turns waiting for an in-flight slot.", ()
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "cumpa_admission_wait_seconds", "Time turns waited for an in-flight slot.", ()
+)
+ADMISSION_REJECTED = Counter(
+    "cumpa_admission_rejected_total",
+    "Turns rejected by the admission control, with 429 or 503.",
+    ("reason",),
+)
+DB_WRITE_BATCH_ROWS = Histogram(
+    "cumpa_db_write_batch_rows",
+    "Operations committed together by the message writer.",
+    (),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+)
+DB_PENDING_WRITES = Gauge(
+    "cumpa_db_pending_writes", "Messages queued in the message writer, not yet committed.", ()
+)
+DB_WRITES_LOST = Counter(
+    "cumpa_db_writes_lost_total",
+    "Queued message writes dropped after a database error that retrying can't fix.",
+    (),
+)
+DB_ROWS = Gauge(
+    "cumpa_db_rows", "Messages in the hot history table and in the archive, after the last retention run.", ("table",)
+)
+RETENTION_ROWS = Counter(
+    "cumpa_retention_rows_total",
+    "Messages moved to the archive or deleted from it by the retention job.",
+    ("action",),
+)
@@ -16,6 +16,12 @@ class Phase:
         self.topic_list = topic_list
         self.instruction = instruction
         self.router_list = router_list
+        # runtime artifacts, built once when the chatbot is compiled
+        self.response_format = None  # : type[BaseModel]
+        self.fused_response_format = None  # : type[BaseModel]
+        self.selector_chain = None  # : Runnable
+        self.generator_chain = None  # : Runnable
+        self.fused_chain = None  # : Runnable
 
     def getInfo(self) -> dict:
 
@@ -27,6 +33,12 @@ class Phase:
         }
 
     def getResponseFormat(self) -> BaseModel:
+        if self.response_format is None:
+            self.response_format = self.buildResponseFormat()
+
+        return self.response_format
+
+    def buildResponseFormat(self) -> BaseModel:
         options = [router["next_phase"] for router in self.router_list]
         explanations = "\n".join(
             [
@@ -38,7 +50,7 @@ class Phase:
         format = create_model(
             "ResponseFormat",
             action=(
-                str,
+                Literal[tuple(self.topic_list)],
                 Field(
                     description="An action for generating current response. You should select one action from the available actions."
                 ),
@@ -65,6 +77,43 @@ class Phase:
 
         return format
 
+    # the response format of the fused mode, which also carries the chatbot response
+    def getFusedResponseFormat(self) -> BaseModel:
+        if self.fused_response_format is None:
+            self.fused_response_format = create_model(
+                "FusedResponseFormat",
+                __base__=self.getResponseFormat(),
+                response=(
+                    str,
+                    Field(
+                        description="The chatbot response for the current conversation turn, made with the selected action in the current phase. It MUST be in KOREAN and ask or respond about one subject at a time."
+                    ),
+                ),
+            )
+
+        return self.fused_response_format
+
+    def setChains(self, selector_chain, generator_chain, fused_chain=None):
+        self.selector_chain = selector_chain
+        self.generator_chain = generator_chain
+        self.fused_chain = fused_chain
+
+    def getSelectorChain(self):
+
+        return self.selector_chain
+
+    def getGeneratorChain(self):
+
+        return self.generator_chain
+
+    def getFusedChain(self):
+
+        return self.fused_chain
+
+    def isCompiled(self) -> bool:
+
+        return self.selector_chain is not None and self.generator_chain is not None
+
     def getName(self) -> str:
 
         return self.name
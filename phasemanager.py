@@ -1,71 +1,85 @@
+from types import MappingProxyType
 from phase import Phase
+from botgraph import BotGraph
+from historywindow import HistoryWindow
+from router import LocalRouter
+from metrics import PHASE_TRANSITIONS
 
 
+# the cursor of one conversation, everything else is shared through the compiled bot graph
 class PhaseManager:
-    def __init__(self, name: str, description: str):
-        self.phase_dict = {}  # : dict[str, Phase]
-        self.start_phase = None  # : Phase
-        self.current_phase = None  # : Phase
-        self.topics = {}  # : dict[str, str]
-        self.bot_name = name
-        self.bot_desc = description
-
-    def addNewPhase(self, phase: Phase) -> str:
-        if phase.name in self.phase_dict:
-            raise ValueError(f"Phase named {phase.name} is already added")
-        else:
-            self.phase_dict[phase.name] = phase
+    __slots__ = ("graph", "phase_index")
 
-        return f"Phase {phase.name} added successfully."
+    def __init__(self, graph: BotGraph, phase_name: str | None = None):
+        self.graph = graph
+        self.phase_index = graph.start_index  # : int, index of the current phase in graph.phases
+        if phase_name is not None:
+            self.setCurrPhase(phase_name)
 
-    def setStartPhase(self, name: str) -> str:
-        if name in self.phase_dict:
-            self.start_phase = self.phase_dict[name]
-            return f"Phase {name} is set to start phase."
-        else:
-            raise ValueError(f"Phase named {name} is not added.")
+    def getGraph(self) -> BotGraph:
+
+        return self.graph
 
     def getStartPhase(self) -> Phase:
 
-        return self.start_phase
+        return self.graph.getStartPhase()
 
     def setCurrPhase(self, name: str) -> str:
-        if name in self.phase_dict:
-            self.current_phase = self.phase_dict[name]
+        if name in self.graph.phase_index:
+            self.phase_index = self.graph.phase_index[name]
             return f"Phase {name} is set to current phase."
         else:
             raise ValueError(f"Phase named {name} is not added.")
 
     def getCurrPhase(self) -> Phase:
 
-        return self.current_phase
-    
+        return self.graph.phases[self.phase_index]
+
     def goNextPhase(self, next_phase: str | None) -> bool:
         if next_phase == None:
             # print(f"There is no phase result, keep track on current phase.")
             pass
         else:
-            if next_phase in self.phase_dict:
-                self.current_phase = self.phase_dict[next_phase]
+            next_phases = self.graph.adjacency[self.phase_index]
+            if next_phase in next_phases:
+                PHASE_TRANSITIONS.inc(source=self.getCurrPhase().name, target=next_phase)
+                self.phase_index = next_phases[next_phase]
                 return True
             else:
-                print(f"There is no such phase named '{next_phase}'")
+                print(f"There is no route from '{self.getCurrPhase().name}' to '{next_phase}'")
 
         return False
 
-    def updateTopics(self, topics: dict[str, str]) -> str:
-        self.topics = topics
-        names = list(topics.keys())
+    def isFinished(self) -> bool:
+
+        return self.phase_index == self.graph.finish_index
+
+    def getPhases(self) -> list[Phase]:
+
+        return self.graph.getPhases()
+
+    def getTopics(self, phase: Phase | None = None) -> MappingProxyType:
+        if phase is None:
+            return self.graph.phase_topics[self.phase_index]
+
+        return self.graph.getTopics(phase)
+
+    def createSession(self) -> "PhaseManager":
+
+        return PhaseManager(self.graph)
+
+    def getHistoryWindow(self, role: str) -> HistoryWindow | None:
+
+        return self.graph.getHistoryWindow(role)
+
+    def getTurnMode(self) -> str:
 
-        return f"Topics {names} are updated to the phase manager."
+        return self.graph.getTurnMode()
 
-    def getTopics(self) -> dict[str, str]:
-        available_topics = {}
-        for topic_name in self.current_phase.topic_list:
-            available_topics[topic_name] = self.topics[topic_name]
+    def getRouter(self) -> LocalRouter | None:
 
-        return available_topics
+        return self.graph.getRouter()
 
     def getBotInfo(self) -> tuple[str, str]:
 
-        return self.bot_name, self.bot_desc
+        return self.graph.getBotInfo()
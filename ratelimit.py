@@ -0,0 +1,427 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable
+from metrics import LLM_QUEUE_SECONDS, LLM_CONCURRENCY_LIMIT, LLM_THROTTLED
+
+
+# interactive calls (/execute) are always served before batch calls (autotest, eval)
+PRIORITIES = ["interactive", "batch"]
+# tokens a response is assumed to take until its usage is known
+OUTPUT_TOKEN_ESTIMATE = 256
+
+priority = ContextVar("llm_priority", default="interactive")
+
+
+# the priority of the LLM calls made from the current context and the tasks it starts
+def setPriority(name: str):
+    if name not in PRIORITIES:
+        raise ValueError(f"priority should be one of {PRIORITIES}.")
+    priority.set(name)
+
+
+# tokens of a text without a tokenizer, shared with historywindow.countTokens
+def estimateTextTokens(text: str) -> int:
+    # Korean text is about one token per two characters
+    return len(text) // 2 + 1
+
+
+# tokens a call is assumed to take, its prompt and the response
+def estimateTokens(text: str) -> int:
+
+    return estimateTextTokens(text) + OUTPUT_TOKEN_ESTIMATE
+
+
+# seconds the provider asked to wait, from the Retry-After header of the error response
+def getRetryAfter(error: BaseException) -> float | None:
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        return float(retry_after)
+
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+# "rate_limited" and "overloaded" errors are retried and shrink the concurrency, "connection" errors
+# (network failures the provider SDKs used to retry on their own) are retried as is, other errors are raised
+def classifyError(error: BaseException) -> str | None:
+    while error is not None:
+        status = getattr(error, "status_code", None) or getattr(error, "code", None)
+        name = type(error).__name__
+        if status == 429 or "RateLimit" in name or "ResourceExhausted" in name:
+            return "rate_limited"
+        if status in (500, 502, 503, 504, 529) or any(
+            word in name for word in ["Overloaded", "ServiceUnavailable", "InternalServer", "Timeout"]
+        ):
+            return "overloaded"
+        # e.g. openai.APIConnectionError, httpx.ConnectError or ReadError (httpx.TransportError)
+        if "Connection" in name or any(cls.__name__ == "TransportError" for cls in type(error).__mro__):
+            return "connection"
+        # provider errors are often wrapped by the integrations
+        error = error.__cause__
+
+    return None
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst_seconds: float = 10):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def getWait(self, amount: float, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # a call larger than the bucket waits for a full one and leaves it in debt
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+
+        return (needed - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        self.tokens -= amount
+
+
+class Waiter:
+    __slots__ = ("cost", "priority", "loop", "future", "granted", "cancelled", "epoch", "queued_at")
+
+    def __init__(self, cost: int, priority: str):
+        self.cost = cost
+        self.priority = priority
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.granted = False
+        self.cancelled = False
+        self.epoch = 0  # : int, congestion epoch the call started in
+        self.queued_at = time.monotonic()
+
+
+def resolveWaiter(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+# requests and tokens per minute of one provider model, and a concurrency limit adapted AIMD-style:
+# +1 for every limit successful calls, halved once per congestion event
+class ModelLimiter:
+    def __init__(
+        self,
+        provider: str,
+        model: str,
+        requests_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        max_concurrency: int = 32,
+        min_concurrency: int = 1,
+        initial_concurrency: int = 8,
+        max_retries: int = 4,
+    ):
+        self.provider = provider
+        self.model = model
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(min(initial_concurrency, max_concurrency))
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self.blocked_until = 0.0  # : float, monotonic time until which the provider asked to wait
+        # calls that started before the last decrease don't decrease the limit again
+        self.epoch = 0
+        self.waiters = []  # : list[tuple[int, int, Waiter]], heap by priority then arrival
+        self.sequence = itertools.count()
+        self.timer_at = None  # : float, when the pending dispatch timer fires
+        self.stats = {"calls": 0, "retries": 0, "rate_limited": 0, "overloaded": 0, "connection": 0}
+        self.lock = threading.Lock()
+        LLM_CONCURRENCY_LIMIT.set(self.limit, provider=provider, model=model)
+
+    async def acquire(self, cost: int) -> Waiter:
+        waiter = Waiter(cost, priority.get())
+        with self.lock:
+            heapq.heappush(
+                self.waiters, (PRIORITIES.index(waiter.priority), next(self.sequence), waiter)
+            )
+        self.dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self.lock:
+                waiter.cancelled = True
+                granted = waiter.granted
+            if granted:
+                self.release(waiter, "cancelled")
+            raise
+        LLM_QUEUE_SECONDS.observe(
+            time.monotonic() - waiter.queued_at,
+            provider=self.provider,
+            model=self.model,
+            priority=waiter.priority,
+        )
+
+        return waiter
+
+    # start the waiting calls the limits allow, in priority order
+    def dispatch(self):
+        granted = []
+        retry_in = None
+        with self.lock:
+            now = time.monotonic()
+            while self.waiters:
+                waiter = self.waiters[0][2]
+                if waiter.cancelled:
+                    heapq.heappop(self.waiters)
+                    continue
+                if self.in_flight >= int(self.limit):
+                    break
+                wait = self.blocked_until - now
+                if self.request_bucket is not None:
+                    wait = max(wait, self.request_bucket.getWait(1, now))
+                if self.token_bucket is not None:
+                    wait = max(wait, self.token_bucket.getWait(waiter.cost, now))
+                if wait > 0:
+                    retry_in = wait
+                    break
+
+                heapq.heappop(self.waiters)
+                if self.request_bucket is not None:
+                    self.request_bucket.take(1)
+                if self.token_bucket is not None:
+                    self.token_bucket.take(waiter.cost)
+                self.in_flight += 1
+                self.stats["calls"] += 1
+                waiter.granted = True
+                waiter.epoch = self.epoch
+                granted.append(waiter)
+
+            # the head of the queue waits for the buckets or the Retry-After, checked again then
+            # (a timer that is already due may belong to a closed loop, so it doesn't count)
+            if retry_in is not None and (
+                self.timer_at is None or self.timer_at <= now or now + retry_in < self.timer_at
+            ):
+                self.timer_at = now + retry_in
+                timer_loop = waiter.loop
+            else:
+                retry_in = None
+
+        for waiter in granted:
+            self.callSoon(waiter.loop, resolveWaiter, waiter.future)
+        if retry_in is not None:
+            self.callSoon(timer_loop, timer_loop.call_later, retry_in, self.fireTimer)
+
+    def fireTimer(self):
+        with self.lock:
+            self.timer_at = None
+        self.dispatch()
+
+    def callSoon(self, loop: asyncio.AbstractEventLoop, callback: Callable, *args):
+        try:
+            loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # the loop of the waiter has been closed, and its calls with it
+            pass
+
+    def release(
+        self,
+        waiter: Waiter,
+        outcome: str = "success",
+        retry_after: float | None = None,
+        used_tokens: int | None = None,
+    ):
+        with self.lock:
+            self.in_flight -= 1
+            if used_tokens is not None and self.token_bucket is not None:
+                self.token_bucket.take(used_tokens - waiter.cost)
+            if outcome == "success":
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            elif outcome in ["rate_limited", "overloaded"]:
+                self.stats[outcome] += 1
+                if retry_after is not None:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                if waiter.epoch == self.epoch:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self.epoch += 1
+            elif outcome == "connection":
+                # the provider didn't push back, the limit stays
+                self.stats[outcome] += 1
+            limit = self.limit
+        if outcome in ["rate_limited", "overloaded"]:
+            LLM_THROTTLED.inc(provider=self.provider, model=self.model, reason=outcome)
+        LLM_CONCURRENCY_LIMIT.set(limit, provider=self.provider, model=self.model)
+        self.dispatch()
+
+    # seconds before retrying a failed call, the Retry-After of the provider holds every call anyway
+    def getBackoff(self, attempt: int, retry_after: float | None) -> float:
+        if retry_after is not None:
+            return retry_after
+
+        return random.uniform(0, min(30.0, 0.5 * 2**attempt))
+
+    async def call(self, cost: int, call: Callable[[], Awaitable[Any]]) -> Any:
+        attempt = 0
+        while True:
+            waiter = await self.acquire(cost)
+            try:
+                output = await call()
+            except asyncio.CancelledError:
+                self.release(waiter, "cancelled")
+                raise
+            except Exception as e:
+                outcome = classifyError(e)
+                retry_after = getRetryAfter(e)
+                self.release(waiter, outcome or "error", retry_after)
+                if outcome is None or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.countRetry()
+                await asyncio.sleep(self.getBackoff(attempt, retry_after))
+                continue
+
+            self.release(waiter, "success", used_tokens=getUsedTokens(output))
+            return output
+
+    # the slot is held for the whole stream, which is only retried before its first chunk
+    async def stream(self, cost: int, open: Callable[[], AsyncIterator]) -> AsyncIterator:
+        attempt = 0
+        while True:
+            waiter = await self.acquire(cost)
+            started = False
+            iterator = open()
+            try:
+                async for chunk in iterator:
+                    started = True
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                self.release(waiter, "cancelled")
+                raise
+            except Exception as e:
+                outcome = classifyError(e)
+                retry_after = getRetryAfter(e)
+                self.release(waiter, outcome or "error", retry_after)
+                if outcome is None or started or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.countRetry()
+                await asyncio.sleep(self.getBackoff(attempt, retry_after))
+                continue
+            finally:
+                await iterator.aclose()
+
+            self.release(waiter, "success")
+            return
+
+    def countRetry(self):
+        with self.lock:
+            self.stats["retries"] += 1
+
+    def getStats(self) -> dict[str, Any]:
+        with self.lock:
+            queued = sum(1 for _, _, waiter in self.waiters if not waiter.cancelled)
+
+            return {
+                **self.stats,
+                "concurrency_limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "queued": queued,
+                "blocked_for": round(max(0.0, self.blocked_until - time.monotonic()), 3),
+            }
+
+
+def getUsedTokens(output: Any) -> int | None:
+    usage = getattr(output, "usage_metadata", None)
+    if not usage:
+        return None
+
+    return usage.get("total_tokens")
+
+
+# "provider:model" -> (requests per minute, tokens per minute), e.g. from
+# CUMPA_RATE_LIMITS="openai:gpt-4o=500/800000,anthropic:claude-3-5-sonnet-latest=50/"
+def parseRateLimits(value: str) -> dict[str, tuple[float | None, float | None]]:
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        key, _, rates = item.strip().rpartition("=")
+        if not key or ":" not in key:
+            raise ValueError(f"rate limit should be 'provider:model=requests/tokens', got '{item}'.")
+        requests, _, tokens = rates.partition("/")
+        limits[key] = (
+            float(requests) if requests.strip() else None,
+            float(tokens) if tokens.strip() else None,
+        )
+
+    return limits
+
+
+limiters = {}  # : dict[str, ModelLimiter], keyed by "provider:model"
+limits = None  # : dict[str, tuple[float | None, float | None]]
+max_concurrency = 32
+limiters_lock = threading.Lock()
+
+
+def configureRateLimits(
+    rate_limits: dict[str, tuple[float | None, float | None]] | None = None,
+    concurrency: int | None = None,
+):
+    global limits, max_concurrency
+
+    # e.g. CUMPA_RATE_LIMITS="openai:gpt-4o=500/800000" CUMPA_LLM_CONCURRENCY=32
+    if rate_limits is None:
+        rate_limits = parseRateLimits(os.getenv("CUMPA_RATE_LIMITS", ""))
+    if concurrency is None:
+        concurrency = int(os.getenv("CUMPA_LLM_CONCURRENCY", "32"))
+    with limiters_lock:
+        limits = rate_limits
+        max_concurrency = concurrency
+        limiters.clear()
+
+
+def getLimiter(provider: str, model: str) -> ModelLimiter:
+    if limits is None:
+        configureRateLimits()
+
+    key = f"{provider}:{model}"
+    with limiters_lock:
+        if key not in limiters:
+            requests_per_minute, tokens_per_minute = limits.get(key, (None, None))
+            limiters[key] = ModelLimiter(
+                provider,
+                model,
+                requests_per_minute,
+                tokens_per_minute,
+                max_concurrency,
+                initial_concurrency=min(8, max_concurrency),
+            )
+
+        return limiters[key]
+
+
+def getRateLimitStats() -> dict[str, dict[str, Any]]:
+    with limiters_lock:
+        current = dict(limiters)
+
+    return {key: limiter.getStats() for key, limiter in current.items()}
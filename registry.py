@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+import yaml
+from pydantic import BaseModel
+from botgraph import BotGraph
+
+
+DEFAULT_BOT = "default"
+
+
+class BotVersion:
+    __slots__ = ("bot_id", "version", "spec_hash", "graph", "source", "loaded_at")
+
+    def __init__(
+        self, bot_id: str, version: int, spec_hash: str, graph: BotGraph, source: str | None
+    ):
+        self.bot_id = bot_id
+        self.version = version
+        self.spec_hash = spec_hash
+        self.graph = graph
+        self.source = source  # : str, spec file of the version, None if saved through the API
+        self.loaded_at = time.time()
+
+    def getInfo(self) -> dict[str, Any]:
+
+        return {
+            "version": self.version,
+            "hash": self.spec_hash,
+            "source": self.source,
+            "loaded_at": self.loaded_at,
+        }
+
+
+# bots by id and version, every version compiled once per spec content
+class BotRegistry:
+    def __init__(
+        self,
+        model: type[BaseModel],
+        compile: Callable[[BaseModel], BotGraph],
+        cache_dir: str = "./.spec_cache",
+        max_compiled: int = 32,
+        max_versions: int = 10,
+    ):
+        self.model = model
+        self.compile = compile
+        self.cache_dir = cache_dir
+        self.max_compiled = max_compiled
+        # older versions are forgotten, their running sessions still hold their graph
+        self.max_versions = max_versions
+        self.compiled = OrderedDict()  # : OrderedDict[str, BotGraph], keyed by spec hash
+        self.versions = {}  # : dict[str, list[BotVersion]], oldest first
+        self.watched = {}  # : dict[str, tuple[str, int]], bot id -> (spec file, mtime)
+        self.lock = threading.RLock()
+
+    def hashSpec(self, data: BaseModel) -> str:
+        payload = json.dumps(data.model_dump(mode="json"), sort_keys=True, ensure_ascii=False)
+
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def getCachePath(self, path: str) -> str:
+        name = hashlib.sha256(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+
+        return os.path.join(self.cache_dir, f"{name}.json")
+
+    # parse a yaml spec, or its validated json copy if the yaml file hasn't changed since
+    def loadSpecFile(self, path: str) -> tuple[BaseModel, str]:
+        stat = os.stat(path)
+        cache_path = self.getCachePath(path)
+        try:
+            with open(cache_path, mode="r", encoding="utf-8") as file:
+                cached = json.load(file)
+            if cached["mtime_ns"] == stat.st_mtime_ns and cached["size"] == stat.st_size:
+                return self.model.model_validate(cached["spec"]), cached["hash"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        with open(path, mode="r", encoding="utf-8") as file:
+            data = self.model.model_validate(yaml.safe_load(file))
+        spec_hash = self.hashSpec(data)
+
+        cached = {
+            "source": os.path.abspath(path),
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "hash": spec_hash,
+            "spec": data.model_dump(mode="json"),
+        }
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # written aside and renamed, so a reader never sees half a file
+            temp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(temp_path, mode="w", encoding="utf-8") as file:
+                json.dump(cached, file, ensure_ascii=False)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            print(f"spec cache of {path} not saved: {e}")
+
+        return data, spec_hash
+
+    def getGraph(self, data: BaseModel, spec_hash: str) -> BotGraph:
+        with self.lock:
+            graph = self.compiled.get(spec_hash)
+            if graph is not None:
+                self.compiled.move_to_end(spec_hash)
+                return graph
+
+        graph = self.compile(data)
+        with self.lock:
+            self.compiled[spec_hash] = graph
+            if len(self.compiled) > self.max_compiled:
+                self.compiled.popitem(last=False)
+
+        return graph
+
+    # the same spec content as the latest version keeps that version
+    def register(
+        self,
+        bot_id: str,
+        data: BaseModel,
+        spec_hash: str | None = None,
+        source: str | None = None,
+    ) -> BotVersion:
+        spec_hash = spec_hash or self.hashSpec(data)
+        with self.lock:
+            versions = self.versions.get(bot_id, [])
+            if versions and versions[-1].spec_hash == spec_hash:
+                return versions[-1]
+
+        graph = self.getGraph(data, spec_hash)
+        with self.lock:
+            versions = self.versions.setdefault(bot_id, [])
+            version = BotVersion(
+                bot_id, versions[-1].version + 1 if versions else 1, spec_hash, graph, source
+            )
+            versions.append(version)
+            del versions[: -self.max_versions]
+
+        return version
+
+    def watch(self, bot_id: str, path: str) -> BotVersion:
+        mtime = os.stat(path).st_mtime_ns
+        data, spec_hash = self.loadSpecFile(path)
+        version = self.register(bot_id, data, spec_hash, path)
+        with self.lock:
+            self.watched[bot_id] = (path, mtime)
+
+        return version
+
+    # register a new version of every watched spec file that has changed
+    def refresh(self) -> list[BotVersion]:
+        with self.lock:
+            watched = list(self.watched.items())
+
+        reloaded = []
+        for bot_id, (path, mtime) in watched:
+            try:
+                current_mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            if current_mtime == mtime:
+                continue
+
+            try:
+                reloaded.append(self.watch(bot_id, path))
+            except Exception as e:
+                # an invalid edit keeps the previous version running
+                print(f"spec {path} of bot {bot_id} not reloaded: {e}")
+                with self.lock:
+                    self.watched[bot_id] = (path, current_mtime)
+
+        return reloaded
+
+    def get(self, bot_id: str, version: int | None = None) -> BotVersion | None:
+        with self.lock:
+            versions = self.versions.get(bot_id)
+            if not versions:
+                return None
+            if version is None:
+                return versions[-1]
+            for bot_version in versions:
+                if bot_version.version == version:
+                    return bot_version
+
+        return None
+
+    def getBots(self) -> dict[str, list[dict[str, Any]]]:
+        with self.lock:
+            return {
+                bot_id: [version.getInfo() for version in versions]
+                for bot_id, versions in self.versions.items()
+            }
@@ -0,0 +1,319 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+import DB
+from metrics import DB_SECONDS, DB_ROWS, RETENTION_ROWS, timeSpan
+
+
+ARCHIVE_PATH = "conversation_archive.db"
+# the same as botgraph.FINISH_PHASE, botgraph isn't imported so the CLI maintenance run starts fast
+FINISH_PHASE = "FINISH"
+
+# the last run of the background job, for /retention-stats
+retention_stats = {"runs": 0, "last_run": None}  # : dict[str, Any]
+retention_stats_lock = threading.Lock()
+
+
+def getRetentionStats() -> dict[str, Any]:
+    with retention_stats_lock:
+        return {"runs": retention_stats["runs"], "last_run": retention_stats["last_run"]}
+
+
+# a connection of its own with the archive file attached, in autocommit so every batch is a short transaction
+def connectStore(archive_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(DB.pool.path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+    # only takes effect while the archive file is empty
+    conn.execute("PRAGMA archive.auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA archive.journal_mode=WAL")
+    conn.execute("PRAGMA archive.synchronous=NORMAL")
+    # the same columns as the history table, so the archive file can be exported like the store
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS archive.history (
+            id INTEGER PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            speaker TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at REAL,
+            archived_at REAL NOT NULL
+        )
+    """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS archive.idx_history_session ON history (session_id, id)"
+    )
+
+    return conn
+
+
+# row count, last activity, last row id and last phase of every session of the hot table, in one scan
+def listSessions(conn: sqlite3.Connection) -> list[tuple[str, int, float, int, str | None]]:
+
+    return conn.execute(
+        """
+        SELECT s.session_id, s.row_count, s.last_at, s.last_id, p.content
+        FROM (
+            SELECT session_id, COUNT(*) AS row_count, MAX(COALESCE(created_at, 0)) AS last_at,
+                MAX(id) AS last_id, MAX(CASE WHEN speaker = 'PHASE' THEN id END) AS phase_id
+            FROM main.history GROUP BY session_id
+        ) AS s
+        LEFT JOIN main.history AS p ON p.id = s.phase_id
+    """
+    ).fetchall()
+
+
+# finished conversations move to the archive, idle and oversized history is pruned from the hot table
+# into it, and the space freed in both files is given back a few pages at a time
+class RetentionPolicy:
+    def __init__(
+        self,
+        archive_path: str = ARCHIVE_PATH,
+        archive_after: float = 300.0,
+        max_idle: float | None = 30 * 86400.0,
+        max_hot_rows: int | None = 1000000,
+        archive_max_age: float | None = None,
+        archive_max_rows: int | None = None,
+        batch_sessions: int = 100,
+        vacuum_pages: int = 256,
+        pause: float = 0.01,
+    ):
+        if archive_after < 0:
+            raise ValueError("archive_after should be at least 0.")
+        self.archive_path = archive_path
+        self.archive_after = archive_after  # : float, seconds since a finished conversation's last message
+        self.max_idle = max_idle  # : float, seconds without a message before an unfinished conversation is archived
+        self.max_hot_rows = max_hot_rows  # : int, past this, the longest idle conversations are archived
+        self.archive_max_age = archive_max_age  # : float, seconds before an archived conversation is deleted
+        self.archive_max_rows = archive_max_rows  # : int, past this, the oldest archived conversations are deleted
+        # every transaction holds the write lock for at most batch_sessions conversations or vacuum_pages pages,
+        # and pause seconds are left between them for the message writer
+        self.batch_sessions = batch_sessions
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause
+        self.convert_hinted = False
+
+    # (session, last id) pairs to archive, with the reason of each
+    def selectSessions(
+        self, sessions: list[tuple[str, int, float, int, str | None]], now: float
+    ) -> tuple[list[tuple[str, int]], dict[str, int]]:
+        with DB.transcripts_lock:
+            # their latest rows are only in the writer's queue
+            pending = set(DB.pending_sessions)
+
+        selected = []
+        reasons = {"finished": 0, "idle": 0, "size": 0}
+        kept = []
+        hot_rows = 0
+        for session_id, row_count, last_at, last_id, phase in sessions:
+            if session_id in pending:
+                hot_rows += row_count
+                continue
+            idle = now - last_at
+            if phase == FINISH_PHASE and idle >= self.archive_after:
+                reason = "finished"
+            elif self.max_idle is not None and idle >= self.max_idle:
+                reason = "idle"
+            else:
+                hot_rows += row_count
+                kept.append((last_at, session_id, row_count, last_id))
+                continue
+            selected.append((session_id, last_id))
+            reasons[reason] += 1
+
+        if self.max_hot_rows is not None and hot_rows > self.max_hot_rows:
+            kept.sort()
+            for _, session_id, row_count, last_id in kept:
+                if hot_rows <= self.max_hot_rows:
+                    break
+                selected.append((session_id, last_id))
+                reasons["size"] += 1
+                hot_rows -= row_count
+
+        return selected, reasons
+
+    # copy, then delete, up to the last id seen, so messages added meanwhile stay in the hot table;
+    # a copy left by a crash in between is skipped by the next run
+    def archiveSessions(self, conn: sqlite3.Connection, sessions: list[tuple[str, int]]) -> int:
+        archived_rows = 0
+        for start in range(0, len(sessions), self.batch_sessions):
+            batch = sessions[start : start + self.batch_sessions]
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO archive.history
+                    SELECT id, session_id, speaker, content, created_at, ?
+                    FROM main.history WHERE session_id = ? AND id <= ?
+                """,
+                    [(now, session_id, last_id) for session_id, last_id in batch],
+                )
+                cursor = conn.executemany(
+                    "DELETE FROM main.history WHERE session_id = ? AND id <= ?", batch
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            archived_rows += cursor.rowcount
+            # the batch is checkpointed here, not by the next commit of the message writer
+            conn.execute("PRAGMA main.wal_checkpoint(PASSIVE)").fetchall()
+
+            # the archived rows are dropped from memory as well, unless the session has new writes queued
+            with DB.transcripts_lock:
+                for session_id, _ in batch:
+                    if session_id not in DB.pending_sessions:
+                        DB.transcripts.pop(session_id, None)
+            time.sleep(self.pause)
+
+        RETENTION_ROWS.inc(archived_rows, action="archived")
+
+        return archived_rows
+
+    # delete archived conversations past archive_max_age, then the oldest ones past archive_max_rows
+    def pruneArchive(self, conn: sqlite3.Connection, now: float) -> int:
+        if self.archive_max_age is None and self.archive_max_rows is None:
+            return 0
+
+        sessions = conn.execute(
+            """
+            SELECT session_id, COUNT(*), MAX(COALESCE(created_at, archived_at)) AS last_at
+            FROM archive.history GROUP BY session_id ORDER BY last_at
+        """
+        ).fetchall()
+        total_rows = sum(row_count for _, row_count, _ in sessions)
+        expired = []
+        for session_id, row_count, last_at in sessions:
+            too_old = self.archive_max_age is not None and now - last_at >= self.archive_max_age
+            too_many = self.archive_max_rows is not None and total_rows > self.archive_max_rows
+            if not too_old and not too_many:
+                break
+            expired.append((session_id,))
+            total_rows -= row_count
+
+        pruned_rows = 0
+        for start in range(0, len(expired), self.batch_sessions):
+            cursor = conn.executemany(
+                "DELETE FROM archive.history WHERE session_id = ?",
+                expired[start : start + self.batch_sessions],
+            )
+            pruned_rows += cursor.rowcount
+            time.sleep(self.pause)
+        RETENTION_ROWS.inc(pruned_rows, action="pruned")
+
+        return pruned_rows
+
+    # give the free pages back to the file system, vacuum_pages per transaction; a file created before
+    # incremental vacuuming is converted once with a full VACUUM, the only step that locks it throughout,
+    # when convert is set (main.py --retention)
+    def compact(self, conn: sqlite3.Connection, schema: str, convert: bool = False) -> int:
+        if conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] != 2:
+            if schema != "main":
+                return 0
+            if not convert:
+                # the server never runs the full VACUUM, its freed pages wait for the maintenance run
+                if not self.convert_hinted:
+                    print("the history database predates incremental vacuum, run 'main.py --retention' once to convert it")
+                    self.convert_hinted = True
+                return 0
+            print("converting the history database to incremental vacuum, once")
+            conn.execute("PRAGMA main.auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM main")
+
+        freed_pages = 0
+        while True:
+            free_pages = conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+            if free_pages == 0:
+                break
+            # the pragma only runs as far as its rows are read
+            conn.execute(f"PRAGMA {schema}.incremental_vacuum({self.vacuum_pages})").fetchall()
+            freed_pages += min(free_pages, self.vacuum_pages)
+            time.sleep(self.pause)
+        conn.execute(f"PRAGMA {schema}.wal_checkpoint(PASSIVE)").fetchall()
+
+        return freed_pages
+
+    # one pass of the job, returns its summary and the archived sessions
+    def run(self, everything: bool = False, convert: bool = False) -> tuple[dict[str, Any], list[str]]:
+        start_time = time.perf_counter()
+        now = time.time()
+        with timeSpan(DB_SECONDS, operation="retention"):
+            conn = connectStore(self.archive_path)
+            try:
+                sessions = listSessions(conn)
+                # what the writer committed during the scan is checkpointed here, not by its next commit
+                conn.execute("PRAGMA main.wal_checkpoint(PASSIVE)").fetchall()
+                if everything:
+                    # e.g. at server start, the conversations left from the previous run
+                    with DB.transcripts_lock:
+                        pending = set(DB.pending_sessions)
+                    selected = [
+                        (session_id, last_id)
+                        for session_id, _, _, last_id, _ in sessions
+                        if session_id not in pending
+                    ]
+                    reasons = {"all": len(selected)}
+                else:
+                    selected, reasons = self.selectSessions(sessions, now)
+                archived_rows = self.archiveSessions(conn, selected)
+                pruned_rows = self.pruneArchive(conn, now)
+                freed_pages = self.compact(conn, "main", convert) + self.compact(conn, "archive")
+
+                hot_rows = conn.execute("SELECT COUNT(*) FROM main.history").fetchone()[0]
+                archive_rows = conn.execute("SELECT COUNT(*) FROM archive.history").fetchone()[0]
+            finally:
+                conn.close()
+        DB_ROWS.set(hot_rows, table="history")
+        DB_ROWS.set(archive_rows, table="archive")
+
+        summary = {
+            "archived_sessions": len(selected),
+            "archived_by": reasons,
+            "archived_rows": archived_rows,
+            "pruned_rows": pruned_rows,
+            "freed_pages": freed_pages,
+            "hot_rows": hot_rows,
+            "archive_rows": archive_rows,
+            "finished_at": time.time(),
+            "seconds": round(time.perf_counter() - start_time, 3),
+        }
+        with retention_stats_lock:
+            retention_stats["runs"] += 1
+            retention_stats["last_run"] = summary
+
+        return summary, [session_id for session_id, _ in selected]
+
+
+# the archive file of the background job, also read by the exporter
+def getArchivePath() -> str:
+
+    return os.getenv("CUMPA_ARCHIVE_PATH", ARCHIVE_PATH)
+
+
+def getOptionalFloat(name: str, default: str) -> float | None:
+    value = os.getenv(name, default).strip()
+
+    return float(value) if value else None
+
+
+# e.g. CUMPA_ARCHIVE_PATH=./conversation_archive.db CUMPA_ARCHIVE_AFTER=300 CUMPA_MAX_IDLE_DAYS=30
+# CUMPA_MAX_HOT_ROWS=1000000 CUMPA_ARCHIVE_MAX_DAYS= CUMPA_ARCHIVE_MAX_ROWS=, an empty value turns a limit off
+def loadRetentionPolicy() -> RetentionPolicy:
+    max_idle_days = getOptionalFloat("CUMPA_MAX_IDLE_DAYS", "30")
+    max_hot_rows = getOptionalFloat("CUMPA_MAX_HOT_ROWS", "1000000")
+    archive_max_days = getOptionalFloat("CUMPA_ARCHIVE_MAX_DAYS", "")
+    archive_max_rows = getOptionalFloat("CUMPA_ARCHIVE_MAX_ROWS", "")
+
+    return RetentionPolicy(
+        getArchivePath(),
+        float(os.getenv("CUMPA_ARCHIVE_AFTER", "300")),
+        None if max_idle_days is None else max_idle_days * 86400,
+        None if max_hot_rows is None else int(max_hot_rows),
+        None if archive_max_days is None else archive_max_days * 86400,
+        None if archive_max_rows is None else int(archive_max_rows),
+    )
@@ -0,0 +1,295 @@
+import math
+import re
+import threading
+from collections import Counter
+from typing import Any, Iterable
+from phase import Phase
+from corpus import getCorpus
+from metrics import ROUTER_DECISIONS, ROUTER_AGREEMENT
+
+
+# the end of a user message, either the AI response or the marker of a phase that has just started
+TURN_END = re.compile(r"\n(AI: |\n\[)")
+# label of the user messages after which the phase stays the same
+STAY = ""
+
+
+# the last user message of the history, and whether a phase has started after it
+def parseLastTurn(conversation_history: str) -> tuple[str | None, bool]:
+    if conversation_history.startswith("USER: "):
+        position = 0
+    else:
+        position = conversation_history.rfind("\nUSER: ")
+        if position == -1:
+            return None, False
+        position += 1
+
+    rest = conversation_history[position + len("USER: ") :]
+    match = TURN_END.search(rest)
+    if match is None:
+        return rest.strip(), False
+
+    return rest[: match.start()].strip(), match.group(1) == "\n["
+
+
+# (phase, user message, next phase or None) for every user message of one conversation
+def extractTransitions(rows: list[tuple[str, str]]) -> list[tuple[str, str, str | None]]:
+    transitions = []
+    phase_name = None
+    pending = None  # : tuple[str, str], the user message waiting for its label
+    for speaker, content in rows:
+        if speaker == "PHASE":
+            if pending is not None:
+                transitions.append((*pending, content))
+                pending = None
+            phase_name = content
+        elif speaker == "USER":
+            if pending is not None:
+                transitions.append((*pending, None))
+            pending = (phase_name, content) if phase_name is not None else None
+    if pending is not None:
+        transitions.append((*pending, None))
+
+    return transitions
+
+
+# multinomial naive bayes over character n-grams, which suit short Korean messages
+class NaiveBayes:
+    def __init__(self, ngram_sizes: tuple[int, ...] = (1, 2, 3), alpha: float = 0.5):
+        self.ngram_sizes = ngram_sizes
+        self.alpha = alpha
+        self.label_counts = Counter()  # : Counter[str]
+        self.feature_counts = {}  # : dict[str, Counter[str]]
+        self.feature_totals = Counter()  # : Counter[str]
+        self.vocabulary = set()  # : set[str]
+
+    def getFeatures(self, text: str) -> list[str]:
+        text = f" {' '.join(text.lower().split())} "
+        features = []
+        for size in self.ngram_sizes:
+            features += [text[index : index + size] for index in range(len(text) - size + 1)]
+
+        return features
+
+    def add(self, text: str, label: str):
+        features = self.getFeatures(text)
+        self.label_counts[label] += 1
+        self.feature_counts.setdefault(label, Counter()).update(features)
+        self.feature_totals[label] += len(features)
+        self.vocabulary.update(features)
+
+    def predict(self, text: str) -> tuple[str | None, float]:
+        features = self.getFeatures(text)
+        if not self.label_counts or not features:
+            return None, 0.0
+
+        total = sum(self.label_counts.values())
+        vocabulary_size = len(self.vocabulary) + 1
+        scores = {}
+        for label, count in self.label_counts.items():
+            counts = self.feature_counts[label]
+            denominator = math.log(self.feature_totals[label] + self.alpha * vocabulary_size)
+            likelihood = sum(
+                math.log(counts[feature] + self.alpha) - denominator for feature in features
+            )
+            # the joint log probability per n-gram, prior included, otherwise long messages get a near
+            # certain posterior
+            scores[label] = (math.log(count / total) + likelihood) / len(features)
+
+        best = max(scores, key=scores.get)
+        normalizer = sum(math.exp(score - scores[best]) for score in scores.values())
+
+        return best, 1.0 / normalizer
+
+    def __len__(self) -> int:
+
+        return sum(self.label_counts.values())
+
+
+class RouterRule:
+    def __init__(
+        self,
+        pattern: str,
+        action: str,
+        next_phase: str | None = None,
+        phases: list[str] = (),
+    ):
+        self.pattern = re.compile(pattern, re.IGNORECASE)
+        self.action = action
+        self.next_phase = next_phase
+        self.phases = list(phases)  # : list[str], every phase if empty
+
+    # the rule only applies where its action and its next phase exist
+    def matches(self, phase: Phase, message: str, just_started: bool) -> bool:
+        if self.phases and phase.name not in self.phases:
+            return False
+        if self.action not in phase.topic_list:
+            return False
+        options = [router["next_phase"] for router in phase.router_list]
+        if self.next_phase is not None and not just_started and self.next_phase not in options:
+            return False
+
+        return self.pattern.search(message) is not None
+
+
+# decides the action and the next phase locally when it is confident, the selector LLM answers the rest
+class LocalRouter:
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        shadow: bool = False,
+        min_examples: int = 20,
+        rules: list[RouterRule] = (),
+    ):
+        self.threshold = threshold
+        # shadow: decide locally but still call the LLM, only to measure the agreement
+        self.shadow = shadow
+        self.min_examples = min_examples
+        self.rules = list(rules)  # : list[RouterRule]
+        self.phase_models = {}  # : dict[str, NaiveBayes], next phase per source phase
+        self.action_models = {}  # : dict[str, NaiveBayes], action per phase
+        self.stats = Counter()  # : Counter[str]
+        self.lock = threading.Lock()
+
+    def addTransition(self, phase_name: str, message: str, next_phase: str | None):
+        with self.lock:
+            self.phase_models.setdefault(phase_name, NaiveBayes()).add(
+                message, next_phase or STAY
+            )
+
+    def addAction(self, phase_name: str, message: str, action: str):
+        with self.lock:
+            self.action_models.setdefault(phase_name, NaiveBayes()).add(message, action)
+
+    def trainFromRows(self, rows: list[tuple[str, str]]) -> int:
+        transitions = extractTransitions(rows)
+        for phase_name, message, next_phase in transitions:
+            self.addTransition(phase_name, message, next_phase)
+
+        return len(transitions)
+
+    # (id, session, speaker, content) batches in session order, one conversation in memory at a time
+    def trainFromStream(self, batches: Iterable[list[tuple[int, str, str, str]]]) -> int:
+        count = 0
+        session_id = None
+        rows = []
+        for batch in batches:
+            for _, row_session_id, speaker, content in batch:
+                if row_session_id != session_id:
+                    count += self.trainFromRows(rows)
+                    session_id = row_session_id
+                    rows = []
+                rows.append((speaker, content))
+
+        return count + self.trainFromRows(rows)
+
+    # dialogue csv files only have labels if they were saved with their PHASE rows
+    def trainFromFile(self, filepath: str) -> int:
+        corpus = getCorpus(filepath)
+        count = 0
+        for index in corpus.getIndices():
+            rows = [tuple(line.split(": ", 1)) for line in corpus.getDialogue(index)]
+            count += self.trainFromRows(rows)
+
+        return count
+
+    def predict(self, models: dict[str, NaiveBayes], phase_name: str, message: str):
+        with self.lock:
+            model = models.get(phase_name)
+            if model is None or len(model) < self.min_examples:
+                return None, 0.0
+            return model.predict(message)
+
+    # a response in the format of the selector, or None to leave the turn to the LLM
+    def route(self, phase: Phase, conversation_history: str) -> Any:
+        message, just_started = parseLastTurn(conversation_history)
+        if message is None:
+            return None
+        self.countStat("turns")
+
+        for rule in self.rules:
+            if rule.matches(phase, message, just_started):
+                ROUTER_DECISIONS.inc(source="rule")
+                self.countStat("rule")
+                return self.makeResponse(
+                    phase,
+                    rule.action,
+                    None if just_started else rule.next_phase,
+                    f"The user message matched the rule '{rule.pattern.pattern}'.",
+                )
+
+        action, action_confidence = self.predict(self.action_models, phase.name, message)
+        next_phase, phase_confidence = STAY, 1.0
+        # the routing of a phase that has just started is left to the next turn
+        if not just_started:
+            next_phase, phase_confidence = self.predict(self.phase_models, phase.name, message)
+        if action is None or next_phase is None:
+            ROUTER_DECISIONS.inc(source="llm")
+            return None
+        if min(action_confidence, phase_confidence) < self.threshold:
+            ROUTER_DECISIONS.inc(source="llm")
+            return None
+
+        ROUTER_DECISIONS.inc(source="model")
+        self.countStat("model")
+        return self.makeResponse(
+            phase,
+            action,
+            next_phase or None,
+            "Similar user messages in this phase were answered with this action.",
+        )
+
+    def makeResponse(
+        self, phase: Phase, action: str, next_phase: str | None, reason: str
+    ) -> Any:
+
+        return phase.getResponseFormat()(
+            action=action,
+            action_reason=reason,
+            next_phase=next_phase,
+            next_phase_reason=None if next_phase is None else reason,
+        )
+
+    # learn from the selector LLM, and compare it with the local decision made for the same turn
+    def observe(
+        self,
+        phase: Phase,
+        conversation_history: str,
+        llm_response: Any,
+        local_response: Any = None,
+    ):
+        message, just_started = parseLastTurn(conversation_history)
+        if message is None:
+            return
+
+        self.addAction(phase.name, message, llm_response.action)
+        if not just_started:
+            self.addTransition(phase.name, message, llm_response.next_phase)
+
+        if local_response is not None:
+            agreed = local_response.action == llm_response.action and (
+                just_started or local_response.next_phase == llm_response.next_phase
+            )
+            ROUTER_AGREEMENT.inc(result="agree" if agreed else "disagree")
+            self.countStat("compared")
+            if agreed:
+                self.countStat("agreed")
+
+    def countStat(self, name: str):
+        with self.lock:
+            self.stats[name] += 1
+
+    def getStats(self) -> dict[str, Any]:
+        with self.lock:
+            stats = dict(self.stats)
+        turns = stats.get("turns", 0)
+        decided = stats.get("rule", 0) + stats.get("model", 0)
+        compared = stats.get("compared", 0)
+
+        return {
+            **stats,
+            "shadow": self.shadow,
+            # in shadow mode no call is skipped, the rate is what would have been skipped
+            "skip_rate": round(decided / turns, 4) if turns else 0.0,
+            "agreement": round(stats.get("agreed", 0) / compared, 4) if compared else None,
+        }
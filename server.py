@@ -0,0 +1,416 @@
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from starlette.routing import Match
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from contextlib import asynccontextmanager
+from pydantic import BaseModel
+import asyncio
+import json
+import os
+import time
+
+from phasemanager import PhaseManager
+from registry import DEFAULT_BOT
+from setting import chatbotSettingData, registry
+from DB import (
+    initialize,
+    isWriterBacklogged,
+    addMessage,
+    getHistory,
+    reset,
+    startWriter,
+    stopWriter,
+    DEFAULT_SESSION,
+)
+from chatbot import (
+    executeChatbot,
+    selectTopic,
+    streamResponse,
+    fuseTurn,
+)
+from cache import getCacheStats
+from hedge import getHedgeStats
+from ratelimit import getRateLimitStats
+from admission import AdmissionController, Overloaded
+from retention import RetentionPolicy, getRetentionStats, loadRetentionPolicy
+from metrics import REQUEST_SECONDS, REQUESTS_IN_FLIGHT, renderMetrics
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Initialize DB
+    initialize()
+
+    # the conversations left from the previous run move to the archive instead of being deleted
+    retention_policy = loadRetentionPolicy()
+    summary, _ = await asyncio.to_thread(retention_policy.run, True)
+    if summary["archived_sessions"]:
+        print(f"{summary['archived_sessions']} conversations archived to {retention_policy.archive_path}")
+
+    # the handlers only queue their messages, a writer thread commits them in batches
+    # e.g. CUMPA_DB_BATCH_SIZE=256 CUMPA_DB_FLUSH_INTERVAL=0.05
+    startWriter(
+        int(os.getenv("CUMPA_DB_BATCH_SIZE", "256")),
+        float(os.getenv("CUMPA_DB_FLUSH_INTERVAL", "0.05")),
+    )
+
+    # conversations are tracked per session by their cursor, on the bot version they started with
+    app.state.sessions = {}  # : dict[str, PhaseManager]
+    app.state.session_bots = {}  # : dict[str, str]
+    # e.g. CUMPA_MAX_IN_FLIGHT=64 CUMPA_MAX_QUEUE=256 CUMPA_SESSION_QUEUE=4 CUMPA_QUEUE_TIMEOUT=10
+    app.state.admission = AdmissionController(
+        int(os.getenv("CUMPA_MAX_IN_FLIGHT", "64")),
+        int(os.getenv("CUMPA_MAX_QUEUE", "256")),
+        int(os.getenv("CUMPA_SESSION_QUEUE", "4")),
+        float(os.getenv("CUMPA_QUEUE_TIMEOUT", "10")),
+        isWriterBacklogged,
+    )
+
+    # spec files served and hot reloaded, e.g. CUMPA_BOT_SPECS="default=./LLM-Cumpa Specification.yaml,b=./b.yaml"
+    for entry in os.getenv("CUMPA_BOT_SPECS", "").split(","):
+        if entry.strip():
+            bot_id, path = entry.split("=", 1)
+            bot_version = registry.watch(bot_id.strip(), path.strip())
+            print(f"bot {bot_version.bot_id} v{bot_version.version} loaded from {path.strip()}")
+    watcher = asyncio.create_task(watchSpecs(float(os.getenv("CUMPA_SPEC_POLL", "2"))))
+    # finished, idle and oversized history is archived in the background, e.g. CUMPA_RETENTION_INTERVAL=600 (0 turns it off)
+    retention_interval = float(os.getenv("CUMPA_RETENTION_INTERVAL", "600"))
+    retention = None
+    if retention_interval > 0:
+        retention = asyncio.create_task(runRetention(retention_policy, retention_interval))
+
+    try:
+        yield
+    finally:
+        watcher.cancel()
+        if retention is not None:
+            retention.cancel()
+        # every queued message is committed before the process exits
+        await asyncio.to_thread(stopWriter)
+
+
+# reload the changed spec files, new sessions start on the new version
+async def watchSpecs(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        for bot_version in await asyncio.to_thread(registry.refresh):
+            print(f"bot {bot_version.bot_id} reloaded as v{bot_version.version}")
+
+
+async def runRetention(policy: RetentionPolicy, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            summary, session_ids = await asyncio.to_thread(policy.run)
+        except Exception as e:
+            print(f"retention run failed: {e}")
+            continue
+        # archived conversations start over on their next turn, unless a turn of theirs is running
+        for session_id in session_ids:
+            if session_id not in app.state.admission.session_locks:
+                app.state.sessions.pop(session_id, None)
+                app.state.session_bots.pop(session_id, None)
+        if summary["archived_rows"] or summary["pruned_rows"]:
+            print(f"retention: {summary}")
+
+
+# Set FastAPI app
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost:5173"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+# track in-flight requests and their duration, labeled by route so unknown paths share one label
+@app.middleware("http")
+async def trackRequests(request: Request, call_next):
+    path = "other"
+    for route in app.routes:
+        if route.matches(request.scope)[0] == Match.FULL:
+            path = route.path
+            break
+    REQUESTS_IN_FLIGHT.inc(path=path)
+    start = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec(path=path)
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - start, path=path, method=request.method, status=status
+        )
+
+
+# shed load right away, clients retry after the expected wait
+@app.exception_handler(Overloaded)
+async def overloaded(request: Request, error: Overloaded):
+
+    return JSONResponse(
+        {"detail": error.detail},
+        status_code=error.status_code,
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+
+class userInputData(BaseModel):
+    input: str
+    session_id: str = DEFAULT_SESSION
+    # bot of a new conversation, the default bot if omitted
+    bot_id: str | None = None
+
+
+class sessionData(BaseModel):
+    session_id: str = DEFAULT_SESSION
+    bot_id: str | None = None
+
+
+# =================================================================================================================================================
+# API Server Code
+# =================================================================================================================================================
+
+# get the phase manager of the session, starting a new conversation on the latest bot version if needed
+def getSession(session_id: str, bot_id: str | None = None) -> PhaseManager:
+    sessions = app.state.sessions
+    session_bot = app.state.session_bots.get(session_id)
+    if bot_id is not None and session_bot is not None and bot_id != session_bot:
+        raise HTTPException(
+            status_code=400, detail=f"Conversation {session_id} is with bot {session_bot}."
+        )
+
+    if session_id not in sessions:
+        bot_id = bot_id or DEFAULT_BOT
+        bot_version = registry.get(bot_id)
+        if bot_version is None:
+            detail = "No Chatbot Saved." if bot_id == DEFAULT_BOT else f"No chatbot named {bot_id}."
+            raise HTTPException(status_code=400, detail=detail)
+        session = PhaseManager(bot_version.graph)
+        sessions[session_id] = session
+        app.state.session_bots[session_id] = bot_id
+        reset(session_id)
+        addMessage("PHASE", session.getStartPhase().getName(), session_id)
+
+    return sessions[session_id]
+
+
+def endSession(session_id: str):
+    app.state.sessions.pop(session_id, None)
+    app.state.session_bots.pop(session_id, None)
+    reset(session_id)
+
+
+# save chatbot setting
+@app.post("/save-settings")
+async def saveSetting(data: chatbotSettingData, bot_id: str = DEFAULT_BOT, keep_sessions: bool = False):
+    try:
+        # compiling (and training the local router) doesn't hold up the running turns
+        bot_version = await asyncio.to_thread(registry.register, bot_id, data)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # the previous version is kept if the new setting is invalid
+    graph = bot_version.graph
+    print(f"bot {bot_id} v{bot_version.version}: {len(graph.phases)} phases compiled, start phase: {data.start_phase}")
+    if graph.getRouter() is not None:
+        print(f"local router set (threshold {graph.getRouter().threshold}, shadow {graph.getRouter().shadow})")
+    # conversations with this bot restart from the start phase on their next turn, other bots keep theirs;
+    # with keep_sessions they stay on the version they started with, like after a spec file reload
+    if not keep_sessions:
+        for session_id, session_bot in list(app.state.session_bots.items()):
+            if session_bot == bot_id:
+                # a running turn finishes first, on the version it started with
+                async with app.state.admission.lockSession(session_id, bounded=False):
+                    endSession(session_id)
+
+    return {
+        "status": "success",
+        "result": f"Chatbot named {data.bot_name} set completely.",
+        "bot_id": bot_id,
+        "version": bot_version.version,
+    }
+
+# execute one conversation with the user input
+@app.post("/execute")
+async def execute(user_input: userInputData):
+    session_id = user_input.session_id
+    # turns of a conversation run one at a time, in the order they arrived
+    async with app.state.admission.admit(session_id):
+        phase_manager = getSession(session_id, user_input.bot_id)
+        input = user_input.input
+        addMessage("USER", input, session_id)
+        conversation_history = getHistory(session_id)
+        try:
+            response, changed = await executeChatbot(phase_manager, conversation_history)
+            addMessage("AI", response, session_id)
+            if changed:
+                addMessage("PHASE", phase_manager.getCurrPhase().getName(), session_id)
+            if phase_manager.isFinished():
+                finished = True
+            else:
+                finished = False
+            return {"status": "success", "message": response, "finished": finished}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+# format one Server-Sent Event
+def serverSentEvent(data: dict, event: str | None = None) -> str:
+    message = f"event: {event}\n" if event else ""
+
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# execute one conversation with the user input, streaming the response tokens as they are generated
+@app.post("/execute/stream")
+async def executeStream(user_input: userInputData):
+    session_id = user_input.session_id
+    admission = app.state.admission
+    # the turn holds its session until the streamed response is saved
+    ticket = await admission.enter(session_id)
+    try:
+        phase_manager = getSession(session_id, user_input.bot_id)
+        addMessage("USER", user_input.input, session_id)
+        conversation_history = getHistory(session_id)
+        try:
+            if phase_manager.getTurnMode() == "fused":
+                # the fused response arrives in one piece, so it is sent as a single token
+                fused_response = await fuseTurn(phase_manager, conversation_history)
+                next_phase = fused_response.next_phase
+
+                async def generateTokens():
+                    yield fused_response.response
+
+                token_stream = generateTokens()
+            else:
+                selector_response = await selectTopic(phase_manager, conversation_history)
+                next_phase = selector_response.next_phase
+                token_stream = streamResponse(
+                    phase_manager,
+                    conversation_history,
+                    phase_manager.getTopics()[selector_response.action],
+                    selector_response.action_reason,
+                )
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        admission.release(ticket)
+        raise
+
+    async def events():
+        try:
+            tokens = []
+            try:
+                async for token in token_stream:
+                    tokens.append(token)
+                    yield serverSentEvent({"token": token})
+            except Exception as e:
+                yield serverSentEvent({"detail": str(e)}, event="error")
+                return
+
+            response = "".join(tokens)
+            changed = phase_manager.goNextPhase(next_phase)
+            phase_name = phase_manager.getCurrPhase().getName()
+            try:
+                yield serverSentEvent(
+                    {
+                        "status": "success",
+                        "finished": phase_manager.isFinished(),
+                        "changed": changed,
+                        "phase": phase_name,
+                    },
+                    event="done",
+                )
+            finally:
+                # the full response is saved even if the client leaves after the last token
+                addMessage("AI", response, session_id)
+                if changed:
+                    addMessage("PHASE", phase_name, session_id)
+        finally:
+            admission.release(ticket)
+
+    # also released if the client leaves before the stream starts
+    return StreamingResponse(
+        events(), media_type="text/event-stream", background=BackgroundTask(admission.release, ticket)
+    )
+
+
+# stage latency histograms, in-flight requests and phase transitions in the Prometheus format
+@app.get("/metrics")
+def metrics():
+
+    return PlainTextResponse(renderMetrics(), media_type="text/plain; version=0.0.4")
+
+
+# hit and miss counters of the LLM response caches
+@app.get("/cache-stats")
+def cacheStats():
+
+    return {"status": "success", "result": getCacheStats()}
+
+
+# per call site: how often a call was duplicated to a secondary model, and how often the duplicate won
+@app.get("/hedge-stats")
+def hedgeStats():
+
+    return {"status": "success", "result": getHedgeStats()}
+
+
+# running and queued turns, rejections and queue waits of the admission control
+@app.get("/admission-stats")
+def admissionStats():
+
+    return {"status": "success", "result": app.state.admission.getStats()}
+
+
+# adaptive concurrency limit, queue and provider rejections of every model called so far
+@app.get("/rate-limits")
+def rateLimits():
+
+    return {"status": "success", "result": getRateLimitStats()}
+
+
+# messages archived and pruned by the last retention run, and the rows left in the hot table and the archive
+@app.get("/retention-stats")
+def retentionStats():
+
+    return {"status": "success", "result": getRetentionStats()}
+
+
+# skip rate of the local router, and its agreement with the selector LLM in shadow mode
+@app.get("/router-stats")
+def routerStats(bot_id: str = DEFAULT_BOT):
+    bot_version = registry.get(bot_id)
+    if bot_version is None or bot_version.graph.getRouter() is None:
+        raise HTTPException(status_code=400, detail="No local router set.")
+
+    return {"status": "success", "result": bot_version.graph.getRouter().getStats()}
+
+
+# every bot with its versions, the last one is used by new conversations
+@app.get("/bots")
+def bots():
+
+    return {"status": "success", "result": registry.getBots()}
+
+
+# reset the conversation
+@app.post("/reset-DB")
+async def resetDB(data: sessionData | None = None):
+    session_id = data.session_id if data else DEFAULT_SESSION
+    # waits for the running turn of the conversation, then restarts it with the same bot, on its latest version
+    async with app.state.admission.lockSession(session_id):
+        bot_id = data.bot_id if data and data.bot_id else app.state.session_bots.get(session_id)
+        try:
+            endSession(session_id)
+            getSession(session_id, bot_id)
+            return {"status": "success", "result": f"Conversation {session_id} initialized."}
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
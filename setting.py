@@ -0,0 +1,149 @@
+from pydantic import BaseModel
+from typing import Literal
+
+from phase import Phase
+from botgraph import BotGraph
+from registry import BotRegistry
+from historywindow import HistoryWindow
+from router import LocalRouter, RouterRule
+from hedge import ModelRoute
+from DB import getLastMessageId, streamMessages
+from chatbot import compileChatbot
+
+
+class routerData(BaseModel):
+    criteria: str
+    next_phase: str
+
+
+class phaseData(BaseModel):
+    name: str
+    goal: str
+    action_list: list[str]
+    instruction: str
+    router_list: list[routerData]
+
+
+class actionData(BaseModel):
+    action_name: str
+    action_explanation: str
+
+
+class windowData(BaseModel):
+    max_tokens: int
+    recent_turns: int = 6
+    summarize: bool = True
+
+
+class historyWindowData(BaseModel):
+    selector: windowData | None = None
+    generator: windowData | None = None
+
+
+class routerRuleData(BaseModel):
+    pattern: str
+    action: str
+    next_phase: str | None = None
+    phases: list[str] = []
+
+
+class localRouterData(BaseModel):
+    threshold: float = 0.9
+    shadow: bool = False
+    min_examples: int = 20
+    rules: list[routerRuleData] = []
+    train_files: list[str] = []
+    train_messages: int = 100000
+
+
+class modelData(BaseModel):
+    provider: str
+    model: str
+
+
+class modelRouteData(BaseModel):
+    primary: modelData = modelData(provider="openai", model="gpt-4o")
+    secondaries: list[modelData] = []
+    hedge: bool = True
+    hedge_percentile: float = 0.95
+    hedge_min_samples: int = 20
+    hedge_delay: float = 3.0
+
+
+class chatbotSettingData(BaseModel):
+    bot_name: str
+    bot_desc: str
+    start_phase: str
+    finish_phases: list[str]
+    phases: list[phaseData]
+    actions: list[actionData]
+    history_window: historyWindowData = historyWindowData()
+    turn_mode: Literal["two_call", "fused"] = "two_call"
+    router: localRouterData | None = None
+    models: modelRouteData = modelRouteData()
+
+
+# local router of the chatbot, trained on the phase transitions logged so far
+def buildRouter(data: localRouterData) -> LocalRouter:
+    router = LocalRouter(
+        data.threshold,
+        data.shadow,
+        data.min_examples,
+        [RouterRule(**rule.model_dump()) for rule in data.rules],
+    )
+    # only the newest messages, a compile does not read the whole history
+    after_id = max(0, getLastMessageId() - data.train_messages)
+    count = router.trainFromStream(streamMessages(after_id))
+    for filepath in data.train_files:
+        count += router.trainFromFile(filepath)
+    print(f"local router trained on {count} logged user messages")
+
+    return router
+
+
+# compile the chatbot setting into the validated bot graph, shared by every session of the chatbot
+def compileSetting(data: chatbotSettingData) -> BotGraph:
+    phases = [
+        Phase(
+            phase.name,
+            phase.goal,
+            phase.action_list,
+            phase.instruction,
+            [router.model_dump() for router in phase.router_list],
+        )
+        for phase in data.phases
+    ]
+    topics = {action.action_name: action.action_explanation for action in data.actions}
+    history_windows = {
+        role: HistoryWindow(**window.model_dump())
+        for role, window in data.history_window
+        if window is not None
+    }
+    # the router learns from the previous conversations, so it is built before the DB is reset
+    router = buildRouter(data.router) if data.router is not None else None
+    model_route = ModelRoute(
+        [(model.provider, model.model) for model in [data.models.primary, *data.models.secondaries]],
+        data.models.hedge,
+        data.models.hedge_percentile,
+        data.models.hedge_min_samples,
+        data.models.hedge_delay,
+    )
+
+    graph = BotGraph(
+        data.bot_name,
+        data.bot_desc,
+        phases,
+        data.start_phase,
+        data.finish_phases,
+        topics,
+        data.turn_mode,
+        history_windows,
+        router,
+        model_route,
+    )
+    compileChatbot(graph)
+
+    return graph
+
+
+registry = BotRegistry(chatbotSettingData, compileSetting)
@@ -1,68 +1,114 @@
 from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_anthropic import ChatAnthropic
-import pandas as pd
 from pydantic import BaseModel, Field
-import csv
+import os
+from corpus import getCorpus
+from llm import ModelChain
 
 
-def getExampleDialogue(index: int) -> str:
-    pass
+AGENT_PROMPT = PromptTemplate.from_template(
+    """
+    [Task]
+    You are a USER chatting with a chatbot.
+    Your role is to make a USER response to continue the "current conversation".
+    You should behave like a USER of the "example dialogue".
+    You MUST answer in KOREAN.
+    
+    [Context]
+    - example dialogue: 
+    {example_dialogue}
+    - current conversation: 
+    {conversation_history}
+    """
+)
+
+EVAL_PROMPT = PromptTemplate.from_template(
+    """
+    [Task]
+    You are an evaluator for testing naturalness of the chatbot responses.
+    Given the following dialogues between chatbot and user, evaluate the naturalness of each chatbot.
+    
+    [Instruction]
+    This metric measures the resemblance to humans.
+    Based on the criteria below, evaluate the chatbot’s overall performance and assign a score from 1 to 5, where 5 represents most likely to be human.
+    Additionally, provide a brief explanation for your rating.
+    
+    Evaluation Criteria:
+    1: The speaker continuously repeats itself, typical robotic behavior. Or the speech is hard to understand.
+    2: The speaker repeats itself occasionally, the vocabulary is limited, like a robot.
+    3: The speaker does not have repeated behaviors (unless for verifying information). Vocabulary is enough to communicate effectively, speech is easy to understand. But I am confident that humans rarely speak like this.
+    4: The speaker is likely to be a human. There is rarely logical inconsistency. But from some details I feel like the utterance is a bit weird and somewhat resembles AI.
+    5: Can not really tell if this is AI or human. Human could probably say the same thing in real life. 
+  
+    Make sure that you are NOT evaluating USER's response. You are only evaluating AI's response.
+    You MUST answer in ENGLISH.
+    
+    [Context]
+    - Dialogue 1:
+    {dialogue1}
+    - Dialogue 2:
+    {dialogue2}
+    """
+)
 
-def getIntentDialogue(index: int) -> str:
-    dialogue_lines = []
 
-    with open("./intent dialogues.csv", mode="r", encoding="utf-8") as file:
-        reader = csv.DictReader(file)
+def getExampleDialogue(index: int) -> str:
+    if not os.path.exists("./example dialogues.csv"):
+        return ""
 
-        for row in reader:
-            if int(row["index"]) == index:
-                dialogue_lines.append(f"{row['role']}: {row['message']}")
+    # simulated dialogues cycle through the example dialogues
+    corpus = getCorpus("./example dialogues.csv")
+    indices = corpus.getIndices()
+    if not indices:
+        return ""
+    dialogue_lines = corpus.getDialogue(indices[(index - 1) % len(indices)])
 
     dialogue_lines.append("USER: <COMPLETE_CONVERSATION>")
 
     return "\n".join(dialogue_lines)
 
 
-def getLLMDialogue(index: int) -> str:
-    dialogue_lines = []
+def getIntentDialogue(index: int) -> str:
+    dialogue_lines = getCorpus("./intent dialogues.csv").getDialogue(index)
 
-    with open("./llm dialogues.csv", mode="r", encoding="utf-8") as file:
-        reader = csv.DictReader(file)
+    dialogue_lines.append("USER: <COMPLETE_CONVERSATION>")
+
+    return "\n".join(dialogue_lines)
 
-        for row in reader:
-            if int(row["index"]) == index:
-                dialogue_lines.append(f"{row['role']}: {row['message']}")
+
+def getLLMDialogue(index: int) -> str:
+    dialogue_lines = getCorpus("./llm dialogues.csv").getDialogue(index)
 
     dialogue_lines.append("USER: <COMPLETE_CONVERSATION>")
 
     return "\n".join(dialogue_lines)
 
 
-async def agentResponse(index: int, conversation_history: str) -> str:
-    example_dialogue = getExampleDialogue(index) # implement the function that fits to your example dialogue file
+# the dialogue pairs to judge: the indices found in both dialogue files
+def getEvaluationIndices() -> list[int]:
+    intent_indices = set(getCorpus("./intent dialogues.csv").getIndices())
 
-    llm = ChatOpenAI(model="gpt-4o", temperature=1)
+    return sorted(intent_indices & set(getCorpus("./llm dialogues.csv").getIndices()))
 
-    prompt_template = PromptTemplate.from_template(
-        """
-    [Task]
-    You are a USER chatting with a chatbot.
-    Your role is to make a USER response to continue the "current conversation".
-    You should behave like a USER of the "example dialogue".
-    You MUST answer in KOREAN.
-    
-    [Context]
-    - example dialogue: 
-    {example_dialogue}
-    - current conversation: 
-    {conversation_history}
-    """
-    )
 
-    chain = prompt_template | llm
-    response = chain.invoke(
+# the simulator chains are built on first use and shared afterwards
+agent_chain = None  # : ModelChain
+eval_chain = None  # : ModelChain
+
+
+def getAgentChain() -> ModelChain:
+    global agent_chain
+    if agent_chain is None:
+        agent_chain = ModelChain(
+            AGENT_PROMPT, "openai", "gpt-4o", temperature=1, site="agent"
+        )
+
+    return agent_chain
+
+
+async def agentResponse(index: int, conversation_history: str) -> str:
+    example_dialogue = getExampleDialogue(index)
+
+    response = await getAgentChain().ainvoke(
         {
             "example_dialogue": example_dialogue,
             "conversation_history": conversation_history + "\nUSER: ",
@@ -87,50 +133,35 @@ class EvalOutput(BaseModel):
     )
 
 
-def autoEvaluation(index) -> EvalOutput:
-    dialogue1 = getIntentDialogue(index)
-    dialogue2 = getLLMDialogue(index)
+def getEvalChain() -> ModelChain:
+    global eval_chain
+    if eval_chain is None:
+        # eval_chain = ModelChain(EVAL_PROMPT, "openai", "gpt-4o", temperature=1, schema=EvalOutput, site="evaluation")
+        # eval_chain = ModelChain(EVAL_PROMPT, "google", "gemini-2.0-flash", temperature=1, schema=EvalOutput, site="evaluation")
+        eval_chain = ModelChain(
+            EVAL_PROMPT,
+            "anthropic",
+            "claude-3-5-sonnet-20241022",
+            temperature=1,
+            schema=EvalOutput,
+            site="evaluation",
+        )
 
-    # llm = ChatOpenAI(model="gpt-4o", temperature=1)
-    # llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=1)
-    llm = ChatAnthropic(model="claude-3-5-sonnet-20241022", temperature=1)
-    llm = llm.with_structured_output(EvalOutput)
+    return eval_chain
 
-    prompt_template = PromptTemplate.from_template(
-        """
-    [Task]
-    You are an evaluator for testing naturalness of the chatbot responses.
-    Given the following dialogues between chatbot and user, evaluate the naturalness of each chatbot.
-    
-    [Instruction]
-    This metric measures the resemblance to humans.
-    Based on the criteria below, evaluate the chatbot’s overall performance and assign a score from 1 to 5, where 5 represents most likely to be human.
-    Additionally, provide a brief explanation for your rating.
-    
-    Evaluation Criteria:
-    1: The speaker continuously repeats itself, typical robotic behavior. Or the speech is hard to understand.
-    2: The speaker repeats itself occasionally, the vocabulary is limited, like a robot.
-    3: The speaker does not have repeated behaviors (unless for verifying information). Vocabulary is enough to communicate effectively, speech is easy to understand. But I am confident that humans rarely speak like this.
-    4: The speaker is likely to be a human. There is rarely logical inconsistency. But from some details I feel like the utterance is a bit weird and somewhat resembles AI.
-    5: Can not really tell if this is AI or human. Human could probably say the same thing in real life. 
-  
-    Make sure that you are NOT evaluating USER's response. You are only evaluating AI's response.
-    You MUST answer in ENGLISH.
-    
-    [Context]
-    - Dialogue 1:
-    {dialogue1}
-    - Dialogue 2:
-    {dialogue2}
-    """
-    )
 
-    chain = prompt_template | llm
-    response = chain.invoke(
+async def autoEvaluation(index) -> EvalOutput:
+    dialogue1 = getIntentDialogue(index)
+    dialogue2 = getLLMDialogue(index)
+
+    response = await getEvalChain().ainvoke(
         {
             "dialogue1": dialogue1,
             "dialogue2": dialogue2,
         }
     )
+    # a structured output that failed to parse comes back empty
+    if response is None:
+        raise ValueError(f"no evaluation output for dialogue pair {index}")
 
     return response
@@ -0,0 +1,56 @@
+class Turn:
+    __slots__ = ("speaker", "content")
+
+    def __init__(self, speaker: str, content: str):
+        self.speaker = speaker
+        self.content = content
+
+    def render(self) -> str:
+        if self.speaker == "PHASE":
+            return f"\n[{self.content}]"
+
+        return f"{self.speaker}: {self.content}"
+
+
+class Transcript:
+    __slots__ = ("turns", "rendered", "rendered_count")
+
+    def __init__(self, rows: list[tuple[str, str]] = ()):
+        self.turns = [Turn(speaker, content) for speaker, content in rows]  # : list[Turn]
+        self.rendered = ""  # rendered text of turns[:rendered_count]
+        self.rendered_count = 0
+
+    def append(self, speaker: str, content: str):
+        self.turns.append(Turn(speaker, content))
+
+    def render(self) -> str:
+        # only the turns added since the last call are formatted
+        if self.rendered_count < len(self.turns):
+            new_text = "\n".join(
+                turn.render() for turn in self.turns[self.rendered_count :]
+            )
+            if self.rendered_count == 0:
+                self.rendered = new_text
+            else:
+                self.rendered = f"{self.rendered}\n{new_text}"
+            self.rendered_count = len(self.turns)
+
+        return self.rendered
+
+    # the first of the last `within` turns with this speaker and content, e.g. a row that was never written
+    def remove(self, speaker: str, content: str, within: int):
+        for index in range(max(0, len(self.turns) - within), len(self.turns)):
+            turn = self.turns[index]
+            if turn.speaker == speaker and turn.content == content:
+                del self.turns[index]
+                self.rendered = ""
+                self.rendered_count = 0
+                return
+
+    def getRows(self) -> list[tuple[str, str]]:
+
+        return [(turn.speaker, turn.content) for turn in self.turns]
+
+    def __len__(self) -> int:
+
+        return len(self.turns)